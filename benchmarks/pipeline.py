@@ -0,0 +1,339 @@
+"""
+Benchmark of the pipeline stages on synthetic corpora, with pandas and Dask and with different numbers of workers.
+
+The following operations are timed on the same corpus:
+- det: language detection of every document with utils.det
+- do_pipeline: Pipe.do_pipeline called on every document (pandas only)
+- preproc: Pipe.preproc, i.e., batched lemmatization and n-grams detection. With pandas, the number of workers is the number of spaCy processes (--n_process in nlpipe.py); with Dask, the number of Dask workers (--nw)
+- embeddings: EmbeddingsManager.bert_embeddings_from_df on the raw text
+- save_parquet: utils.save_parquet of the corpus together with a column of embeddings
+
+Corpora are generated by synthetic.make_corpus, and spaCy and SentenceTransformer stubs are built for their vocabulary (see synthetic.py), so the benchmark runs offline; trained models can be given with --spacy_model and --sbert_model. Corpora and stubs are cached in --workdir. Dask runs start a new pool of worker processes, which load their models, in every repetition, as nlpipe.py does in every run.
+
+Every operation is repeated --repeat times, and the best and median wall times are reported, together with the throughput (documents per second of the best time) and the speedup over the pandas run of the same operation. Results can be saved with --output (JSON, including the machine and the configuration, or CSV) and compared with those of a previous run with --baseline, e.g., of another machine or commit.
+
+Usage:
+    python benchmarks/pipeline.py [--langs en es] [--n_docs 2000] [--backends pandas dask] [--workers 1 2 4] [--output results.json]
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import statistics
+import sys
+import time
+from typing import Callable, Dict, List
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, pathlib.Path(__file__).resolve().parents[1].as_posix())
+
+from src.pipe import Pipe  # noqa: E402
+from src.utils import dask_compute_kwargs, det, save_parquet  # noqa: E402
+from synthetic import (LENGTH_DISTRIBUTIONS, build_sbert_stub,  # noqa: E402
+                       build_spacy_stub, make_corpus)
+
+BENCHMARKS = ("det", "do_pipeline", "preproc", "embeddings", "save_parquet")
+
+# Operations that can only be run with pandas in a single process
+_SINGLE_PROCESS = {"do_pipeline"}
+
+
+def load_corpus(args: argparse.Namespace, lang: str) -> pd.DataFrame:
+    """Generates the corpus of the given language, or reads it from the cache of the working folder"""
+
+    corpus_file = pathlib.Path(args.workdir).joinpath(
+        "corpora", f"{lang}_{args.n_docs}_{args.doc_len}_{args.length_dist}_{args.sigma}_{args.vocabulary_size}_{args.seed}.parquet")
+    if corpus_file.is_file():
+        return pd.read_parquet(corpus_file)
+
+    corpus_df = make_corpus(lang, args.n_docs, doc_len=args.doc_len,
+                            length_dist=args.length_dist, sigma=args.sigma,
+                            vocabulary_size=args.vocabulary_size, seed=args.seed)
+    corpus_file.parent.mkdir(parents=True, exist_ok=True)
+    corpus_df.to_parquet(corpus_file, index=False)
+    return corpus_df
+
+
+def make_pipe(args: argparse.Namespace, lang: str, spacy_model: str) -> Pipe:
+    """Creates the Pipe of nlpipe.py for the given language, without lemma cache"""
+
+    stw_files = [entry for entry in pathlib.Path(args.stw_path).joinpath(lang).iterdir()
+                 if entry.as_posix().endswith("txt")]
+    return Pipe(stw_files=stw_files,
+                spaCy_model=spacy_model,
+                language=lang,
+                max_length=args.max_doc_length,
+                raw_text_cols=["raw_text"],
+                logger=logging.getLogger('benchmark'))
+
+
+def add_random_embeddings(df: pd.DataFrame, dim: int) -> pd.DataFrame:
+    """Adds a column of random embeddings of dimension dim to a DataFrame (or a Dask partition of it)"""
+
+    rnd = np.random.default_rng(len(df))
+    return df.assign(embeddings=list(rnd.standard_normal((len(df), dim), dtype=np.float32)))
+
+
+def operations(args: argparse.Namespace,
+               lang: str,
+               corpus_df: pd.DataFrame) -> Dict[str, Callable[[bool, int], None]]:
+    """
+    Returns the operations to be timed, as functions of whether Dask is used and the number of workers. Models and stubs are built beforehand, so that they are not timed
+    """
+
+    ops = {}
+    benchmarks = set(args.benchmarks)
+    out_path = pathlib.Path(args.workdir).joinpath("output")
+
+    def to_dask(df, nw):
+        return dd.from_pandas(df, npartitions=max(1, nw) * args.partitions_per_worker)
+
+    if "det" in benchmarks:
+        def run_det(use_dask, nw):
+            if use_dask:
+                to_dask(corpus_df, nw)["raw_text"].apply(
+                    det, meta=("raw_text", "str")).compute(**dask_compute_kwargs(nw))
+            else:
+                corpus_df["raw_text"].apply(det)
+        ops["det"] = run_det
+
+    if benchmarks & {"do_pipeline", "preproc"}:
+        pipe = make_pipe(args, lang, args.spacy_model or build_spacy_stub(
+            lang, pathlib.Path(args.workdir).joinpath("models"),
+            vocabulary_size=args.vocabulary_size, seed=args.seed))
+
+        def run_do_pipeline(use_dask, nw):
+            for text in corpus_df["raw_text"]:
+                pipe.do_pipeline(text)
+
+        def run_preproc(use_dask, nw):
+            if use_dask:
+                pipe.preproc(to_dask(corpus_df, nw), use_dask=True, nw=nw,
+                             batch_size=args.batch_size).compute(**dask_compute_kwargs(nw))
+            else:
+                pipe.preproc(corpus_df.copy(), batch_size=args.batch_size, n_process=nw)
+
+        if "do_pipeline" in benchmarks:
+            ops["do_pipeline"] = run_do_pipeline
+        if "preproc" in benchmarks:
+            ops["preproc"] = run_preproc
+
+    if "embeddings" in benchmarks:
+        # Imported here, since it requires sentence-transformers
+        from src.embeddings_manager import EmbeddingsManager
+
+        sbert_model = args.sbert_model or build_sbert_stub(
+            lang, pathlib.Path(args.workdir).joinpath("models"),
+            dim=args.stub_dim, vocabulary_size=args.vocabulary_size, seed=args.seed)
+        em = EmbeddingsManager(logger=logging.getLogger('benchmark'))
+
+        def run_embeddings(use_dask, nw):
+            if use_dask:
+                em.bert_embeddings_from_df(to_dask(corpus_df[["raw_text"]], nw), ["raw_text"],
+                                           sbert_model, batch_size=args.sbert_batch_size,
+                                           use_dask=True).compute(**dask_compute_kwargs(nw))
+            else:
+                em.bert_embeddings_from_df(corpus_df[["raw_text"]].copy(), ["raw_text"],
+                                           sbert_model, batch_size=args.sbert_batch_size)
+        ops["embeddings"] = run_embeddings
+
+    if "save_parquet" in benchmarks:
+        # Float32 embeddings column, as saved by nlpipe.py (see EmbeddingsManager.get_embeddings_schema)
+        schema = {"embeddings": pa.list_(pa.float32(), args.stub_dim)}
+        output_df = add_random_embeddings(corpus_df, args.stub_dim)
+
+        def run_save_parquet(use_dask, nw):
+            outFile = out_path.joinpath(f"{lang}_{'dask' if use_dask else 'pandas'}_{nw}.parquet")
+            outFile.parent.mkdir(parents=True, exist_ok=True)
+            if use_dask:
+                # Embeddings are added by the tasks, since Dask converts object columns of in-memory DataFrames to strings
+                save_parquet(outFile, to_dask(corpus_df, nw).map_partitions(
+                    add_random_embeddings, args.stub_dim, meta=output_df.head(0)),
+                    use_dask=True, nw=nw, schema=schema)
+            else:
+                save_parquet(outFile, output_df, schema=schema)
+        ops["save_parquet"] = run_save_parquet
+
+    return ops
+
+
+def time_operation(operation: Callable[[bool, int], None],
+                   use_dask: bool,
+                   nw: int,
+                   repeat: int) -> List[float]:
+    """Runs an operation repeat times and returns the wall time of each run"""
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        operation(use_dask, nw)
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def machine_info() -> dict:
+    """Describes the machine and software versions, so that results of different runs can be compared"""
+
+    import dask
+    import spacy
+
+    return {"platform": platform.platform(),
+            "processor": platform.processor(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "spacy": spacy.__version__,
+            "dask": dask.__version__,
+            "pandas": pd.__version__,
+            "pyarrow": pa.__version__}
+
+
+def print_table(results: List[dict], baseline: Dict[tuple, dict] = None) -> None:
+    """Prints the results as a table, with the speedup over the single-process pandas run of each operation and, if given, over the same run of a baseline (above 1x means faster than the baseline)"""
+
+    reference = {(r["lang"], r["benchmark"]): r["best"] for r in results
+                 if r["backend"] == "pandas" and r["workers"] == 1}
+    header = f"{'lang':<6}{'benchmark':<14}{'backend':<9}{'workers':>8}{'docs':>8}{'best (s)':>11}{'median (s)':>12}{'docs/sec':>11}{'speedup':>9}"
+    if baseline:
+        header += f"{'vs baseline':>13}"
+    print(header)
+    for r in results:
+        ref = reference.get((r["lang"], r["benchmark"]))
+        row = (f"{r['lang']:<6}{r['benchmark']:<14}{r['backend']:<9}{r['workers']:>8}{r['n_docs']:>8}"
+               f"{r['best']:>11.3f}{r['median']:>12.3f}{r['docs_per_sec']:>11.1f}"
+               f"{(ref / r['best'] if ref else float('nan')):>8.2f}x")
+        if baseline:
+            base = baseline.get(_result_key(r))
+            row += f"{(base['best'] / r['best'] if base else float('nan')):>12.2f}x"
+        print(row)
+
+
+def _result_key(result: dict) -> tuple:
+    return (result["lang"], result["benchmark"], result["backend"], result["workers"], result["n_docs"])
+
+
+def save_results(output: pathlib.Path, results: List[dict], config: dict) -> None:
+    """Saves the results in CSV (one row per run) or JSON (with the machine and configuration) format, according to the extension of output"""
+
+    output = pathlib.Path(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    if output.suffix == ".csv":
+        with output.open("w", newline="", encoding="utf8") as fout:
+            writer = csv.DictWriter(fout, fieldnames=[k for k in results[0] if k != "times"])
+            writer.writeheader()
+            writer.writerows({k: v for k, v in r.items() if k != "times"} for r in results)
+    else:
+        with output.open("w", encoding="utf8") as fout:
+            json.dump({"machine": machine_info(), "config": config, "results": results},
+                      fout, indent=2)
+
+
+def load_baseline(path: pathlib.Path) -> Dict[tuple, dict]:
+    """Reads the results of a previous run (JSON or CSV, see save_results), indexed by operation, backend, workers and corpus"""
+
+    path = pathlib.Path(path)
+    if path.suffix == ".csv":
+        with path.open("r", encoding="utf8") as fin:
+            results = [dict(r, workers=int(r["workers"]), n_docs=int(r["n_docs"]), best=float(r["best"]))
+                       for r in csv.DictReader(fin)]
+    else:
+        with path.open("r", encoding="utf8") as fin:
+            results = json.load(fin)["results"]
+    return {_result_key(r): r for r in results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the pipeline stages on synthetic corpora, with pandas and Dask")
+    parser.add_argument("--langs", type=str, nargs="+", default=["en", "es"],
+                        required=False, help="Languages of the corpora (en/es)")
+    parser.add_argument("--n_docs", type=int, default=2000,
+                        required=False, help="Number of documents per corpus")
+    parser.add_argument("--doc_len", type=int, default=200,
+                        required=False, help="Typical number of words per document (median with lognormal lengths)")
+    parser.add_argument("--length_dist", type=str, default="lognormal", choices=LENGTH_DISTRIBUTIONS,
+                        required=False, help="Distribution of the document lengths")
+    parser.add_argument("--sigma", type=float, default=0.8,
+                        required=False, help="Standard deviation of the log-lengths with lognormal lengths")
+    parser.add_argument("--vocabulary_size", type=int, default=20000,
+                        required=False, help="Number of distinct content words of the corpora")
+    parser.add_argument("--seed", type=int, default=0,
+                        required=False, help="Seed of the corpora and model stubs")
+    parser.add_argument("--benchmarks", type=str, nargs="+", default=list(BENCHMARKS), choices=BENCHMARKS,
+                        required=False, help="Operations to be timed")
+    parser.add_argument("--backends", type=str, nargs="+", default=["pandas", "dask"], choices=["pandas", "dask"],
+                        required=False, help="Backends to be compared")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4],
+                        required=False, help="Numbers of workers to be compared (Dask workers, or spaCy processes for preproc with pandas)")
+    parser.add_argument("--partitions_per_worker", type=int, default=2,
+                        required=False, help="Number of Dask partitions per worker")
+    parser.add_argument("--repeat", type=int, default=3,
+                        required=False, help="Number of timed repetitions of each operation")
+    parser.add_argument("--stw_path", type=str, default="data/stw_lists",
+                        required=False, help="Folder path for stopwords")
+    parser.add_argument("--spacy_model", type=str, default=None,
+                        required=False, help="Trained spaCy model to be used instead of the stub (only with a single language)")
+    parser.add_argument("--max_doc_length", type=int, default=1000000,
+                        required=False, help="Maximum number of characters processed by spaCy at once")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        required=False, help="Number of texts buffered by spaCy in each batch")
+    parser.add_argument("--sbert_model", type=str, default=None,
+                        required=False, help="SentenceTransformer model to be used instead of the stub")
+    parser.add_argument("--sbert_batch_size", type=int, default=32,
+                        required=False, help="Batch size of the embeddings")
+    parser.add_argument("--stub_dim", type=int, default=64,
+                        required=False, help="Dimension of the SentenceTransformer stub and of the saved embeddings")
+    parser.add_argument("--workdir", type=str, default="benchmarks/.work",
+                        required=False, help="Folder in which corpora, model stubs and outputs are kept")
+    parser.add_argument("--output", type=str, default=None,
+                        required=False, help="Path to save the results (.json or .csv)")
+    parser.add_argument("--baseline", type=str, default=None,
+                        required=False, help="Results of a previous run (.json or .csv) to compare with")
+    args = parser.parse_args()
+
+    if args.spacy_model and len(args.langs) > 1:
+        parser.error("--spacy_model can only be given with a single language")
+
+    logging.basicConfig(level='WARNING')
+
+    results = []
+    for lang in args.langs:
+        corpus_df = load_corpus(args, lang)
+        print(f"{lang}: {len(corpus_df)} docs, {corpus_df['raw_text'].str.split().str.len().sum()} words")
+        for benchmark, operation in operations(args, lang, corpus_df).items():
+            for backend in args.backends:
+                for nw in args.workers:
+                    if benchmark in _SINGLE_PROCESS and (backend == "dask" or nw > 1):
+                        continue
+                    if backend == "pandas" and nw > 1 and benchmark != "preproc":
+                        continue
+                    times = time_operation(operation, backend == "dask", nw, args.repeat)
+                    best = min(times)
+                    results.append({"lang": lang,
+                                    "benchmark": benchmark,
+                                    "backend": backend,
+                                    "workers": nw,
+                                    "n_docs": len(corpus_df),
+                                    "best": best,
+                                    "median": statistics.median(times),
+                                    "docs_per_sec": len(corpus_df) / best,
+                                    "times": times})
+
+    print()
+    print_table(results, load_baseline(args.baseline) if args.baseline else None)
+
+    if args.output:
+        save_results(args.output, results, vars(args))
+
+    shutil.rmtree(pathlib.Path(args.workdir).joinpath("output"), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Benchmark of the spaCy profiles of Pipe (see pipe.spacy_exclude) on synthetic corpora.
+
+For each configuration (the "full" profile, the "lemma" profile, and the "lemma" profile without word vectors), a new process loads the spaCy model and lemmatizes the corpus with Pipe.do_pipeline_batch. The following are reported:
+- the components loaded and the shape of the word vectors
+- the load time of the model and the peak RSS it adds to the process
+- the peak RSS of the process after lemmatizing the corpus
+- the throughput (documents per second of the best of --repeat runs) and the speedup over the "full" profile
+
+The lemmas of every configuration are compared with those of the "full" profile, and the benchmark fails if they differ.
+
+As in pipeline.py, corpora are generated by synthetic.make_corpus and a spaCy stub is built for their vocabulary, with components and vectors that the "lemma" profile does not load, so the benchmark runs offline; a trained model can be given with --spacy_model.
+
+Usage:
+    python benchmarks/spacy_profiles.py [--langs en es] [--n_docs 2000] [--spacy_model en_core_web_md] [--output results.json]
+"""
+import argparse
+import hashlib
+import logging
+import multiprocessing
+import pathlib
+import resource
+import sys
+import time
+from typing import List
+
+sys.path.insert(0, pathlib.Path(__file__).resolve().parents[1].as_posix())
+
+from src.pipe import Pipe, load_nlp, spacy_exclude  # noqa: E402
+from pipeline import load_corpus, save_results  # noqa: E402
+from synthetic import LENGTH_DISTRIBUTIONS, build_spacy_stub  # noqa: E402
+
+# (profile, whether the word vectors are loaded)
+CONFIGURATIONS = (("full", True), ("lemma", True), ("lemma", False))
+
+
+def run_configuration(args: argparse.Namespace,
+                      lang: str,
+                      profile: str,
+                      vectors: bool,
+                      texts: List[str]) -> dict:
+    """Loads the spaCy model with a configuration and lemmatizes the texts. Run in a new process, so that the model is loaded from scratch and the RSS is only that of the configuration"""
+
+    logging.basicConfig(level='WARNING')
+    logger = logging.getLogger('benchmark')
+
+    # The stub is already built by the main process: this only adds it to the import path of this process
+    spacy_model = args.spacy_model or build_spacy_stub(
+        lang, pathlib.Path(args.workdir).joinpath("models"), args.vocabulary_size, args.seed)
+
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    exclude = spacy_exclude(spacy_model, profile, vectors, logger)
+    nlp = load_nlp(spacy_model, exclude, logger)
+    load_time = time.perf_counter() - start
+    rss_load = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    stw_files = [entry for entry in pathlib.Path(args.stw_path).joinpath(lang).iterdir()
+                 if entry.as_posix().endswith("txt")]
+    pipe = Pipe(stw_files=stw_files,
+                spaCy_model=spacy_model,
+                language=lang,
+                max_length=args.max_doc_length,
+                raw_text_cols=["raw_text"],
+                spacy_profile=profile,
+                spacy_vectors=vectors,
+                logger=logger)
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        lemmas = pipe.do_pipeline_batch(texts, batch_size=args.batch_size)
+        times.append(time.perf_counter() - start)
+
+    digest = hashlib.sha1("\n".join(" ".join(doc) for doc in lemmas).encode("utf8")).hexdigest()
+
+    return {"lang": lang,
+            "profile": profile,
+            "vectors": vectors,
+            "components": " ".join(nlp.pipe_names),
+            "vectors_shape": "x".join(str(d) for d in nlp.vocab.vectors.shape),
+            "n_docs": len(texts),
+            "load_time": load_time,
+            "load_rss_mb": (rss_load - rss_start) / 1024,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "best": min(times),
+            "docs_per_sec": len(texts) / min(times),
+            "lemmas_sha1": digest,
+            "times": times}
+
+
+def print_table(results: List[dict]) -> None:
+    """Prints the results as a table, with the speedup over the "full" profile of the same language"""
+
+    reference = {r["lang"]: r["best"] for r in results if r["profile"] == "full"}
+    print(f"{'lang':<6}{'profile':<9}{'vectors':<9}{'vectors shape':<15}{'load (s)':>10}{'load RSS (MB)':>15}"
+          f"{'peak RSS (MB)':>15}{'docs/sec':>11}{'speedup':>9}  components")
+    for r in results:
+        ref = reference.get(r["lang"])
+        print(f"{r['lang']:<6}{r['profile']:<9}{str(r['vectors']):<9}{r['vectors_shape']:<15}{r['load_time']:>10.2f}"
+              f"{r['load_rss_mb']:>15.1f}{r['peak_rss_mb']:>15.1f}{r['docs_per_sec']:>11.1f}"
+              f"{(ref / r['best'] if ref else float('nan')):>8.2f}x  {r['components']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the load time, memory and throughput of the spaCy profiles of Pipe")
+    parser.add_argument("--langs", type=str, nargs="+", default=["en", "es"],
+                        required=False, help="Languages of the corpora (en/es)")
+    parser.add_argument("--n_docs", type=int, default=2000,
+                        required=False, help="Number of documents per corpus")
+    parser.add_argument("--doc_len", type=int, default=200,
+                        required=False, help="Typical number of words per document (median with lognormal lengths)")
+    parser.add_argument("--length_dist", type=str, default="lognormal", choices=LENGTH_DISTRIBUTIONS,
+                        required=False, help="Distribution of the document lengths")
+    parser.add_argument("--sigma", type=float, default=0.8,
+                        required=False, help="Shape of the lognormal distribution of document lengths")
+    parser.add_argument("--vocabulary_size", type=int, default=20000,
+                        required=False, help="Number of distinct content words of each corpus")
+    parser.add_argument("--seed", type=int, default=0,
+                        required=False, help="Seed of the corpora and stubs")
+    parser.add_argument("--repeat", type=int, default=3,
+                        required=False, help="Number of runs of the lemmatization of each configuration")
+    parser.add_argument("--stw_path", type=str, default="data/stw_lists",
+                        required=False, help="Folder with the stopword lists of each language")
+    parser.add_argument("--spacy_model", type=str, default=None,
+                        required=False, help="spaCy model to be used instead of the stub (a single language only)")
+    parser.add_argument("--max_doc_length", type=int, default=1000000,
+                        required=False, help="Maximum document length in characters for spaCy")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        required=False, help="Batch size of nlp.pipe")
+    parser.add_argument("--workdir", type=str, default="benchmarks/.work",
+                        required=False, help="Folder where corpora and stubs are cached")
+    parser.add_argument("--output", type=str, default=None,
+                        required=False, help="Path to save the results (.json or .csv)")
+    args = parser.parse_args()
+
+    if args.spacy_model and len(args.langs) > 1:
+        parser.error("--spacy_model can only be given with a single language")
+
+    logging.basicConfig(level='WARNING')
+
+    # Each configuration runs in a new process, which does not inherit the models loaded by the previous ones. Processes are forked from a server started before corpora and stubs are loaded, as the peak RSS of a process includes that of the process it was forked from
+    pool = multiprocessing.get_context("forkserver").Pool(1, maxtasksperchild=1)
+
+    results = []
+    for lang in args.langs:
+        corpus_df = load_corpus(args, lang)
+        texts = corpus_df["raw_text"].tolist()
+        print(f"{lang}: {len(texts)} docs, {corpus_df['raw_text'].str.split().str.len().sum()} words")
+        if not args.spacy_model:
+            build_spacy_stub(lang, pathlib.Path(args.workdir).joinpath("models"),
+                             args.vocabulary_size, args.seed)
+        for profile, vectors in CONFIGURATIONS:
+            results.append(pool.apply(run_configuration,
+                                      (args, lang, profile, vectors, texts)))
+    pool.close()
+    pool.join()
+
+    print()
+    print_table(results)
+
+    if args.output:
+        save_results(args.output, results, vars(args))
+
+    mismatches = [r for r in results
+                  if r["lemmas_sha1"] != next(f["lemmas_sha1"] for f in results
+                                              if f["lang"] == r["lang"] and f["profile"] == "full")]
+    if mismatches:
+        print("\nLemmas differ from those of the full profile: " +
+              ", ".join(f"{r['lang']} {r['profile']} (vectors={r['vectors']})" for r in mismatches))
+        sys.exit(1)
+    print("\nLemmas are identical with every configuration")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+Startup budget of nlpipe.py for each mode of the CLI.
+
+nlpipe.py only imports the standard library at load time, and every heavy library is imported by the stage that needs it. For each mode, nlpipe.py is run in a new interpreter on a small synthetic corpus, and the following are checked:
+- after argument parsing, none of the HEAVY_MODULES is loaded, and importing nlpipe and parsing the arguments takes at most --budget seconds
+- by the end of the run, none of the modules that the mode does not need (see MODES) is loaded, e.g., spaCy and gensim when only the embeddings are calculated, sentence-transformers and torch when only the preprocessing is carried out, or when every embedding is in the embeddings store, or in the Dask client process, whose workers encode the texts
+
+The wall time of each process (including the interpreter startup), the time to import nlpipe and parse the arguments, and the heavy modules loaded after parsing and by the end of the run are reported, and the benchmark fails if any mode exceeds its budget.
+
+With --parse_only, only the first check is carried out: nlpipe.py is not run, so neither a corpus nor models (or the libraries needed to build their stubs) are required, and the check takes a few seconds. It is the check to run after changing the imports of nlpipe.py or of the modules it loads before parsing.
+
+As in pipeline.py, a spaCy stub and a SentenceTransformer stub are built for the vocabulary of the corpus (see synthetic.py), so the benchmark runs offline; trained models can be given with --spacy_model and --sbert_model.
+
+Usage:
+    python benchmarks/startup.py [--modes help preproc embeddings] [--budget 0.25] [--parse_only] [--output results.json]
+"""
+import argparse
+import json
+import logging
+import os
+import pathlib
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+ROOT = pathlib.Path(__file__).resolve().parents[1]
+sys.path.insert(0, ROOT.as_posix())
+
+from pipeline import save_results  # noqa: E402
+from synthetic import build_sbert_stub, build_spacy_stub, make_corpus  # noqa: E402
+
+# Top-level packages whose import is slow or memory hungry
+HEAVY_MODULES = ("dask", "distributed", "pandas", "numpy", "pyarrow", "pyfiglet",
+                 "spacy", "gensim", "langdetect", "sentence_transformers", "transformers", "torch")
+
+_EMBEDDINGS_MODULES = ["sentence_transformers", "transformers", "torch"]
+_PREPROC_MODULES = ["spacy", "gensim"]
+
+# Mode: (arguments of nlpipe.py besides the source, destination and models, whether the pipeline is run, heavy modules that must not be loaded by the end of the run)
+MODES = {
+    "help": (["--help"], False, list(HEAVY_MODULES)),
+    "invalid": (["--no_preproc"], True, list(HEAVY_MODULES)),
+    "preproc": ([], True, _EMBEDDINGS_MODULES),
+    "preproc_dask": (["--use_dask", "True", "--nw", "2"], True, _EMBEDDINGS_MODULES),
+    "stream": (["--stream", "--chunk_size", "50"], True, _EMBEDDINGS_MODULES),
+    "embeddings": (["--no_preproc", "--do_embeddings"], True, _PREPROC_MODULES),
+    "embeddings_store": (["--no_preproc", "--do_embeddings"], True, _PREPROC_MODULES + _EMBEDDINGS_MODULES),
+    "embeddings_dask": (["--no_preproc", "--do_embeddings", "--use_dask", "True", "--nw", "2"], True,
+                        _PREPROC_MODULES + _EMBEDDINGS_MODULES),
+    "preproc_embeddings": (["--do_embeddings"], True, []),
+}
+
+# Modes run with an embeddings store, which is filled by a first run that is not measured, so that every embedding is found in it
+_STORE_MODES = {"embeddings_store"}
+
+# Run in a new interpreter: imports nlpipe, parses the arguments and, if required, runs the pipeline, recording the heavy modules loaded at each point
+_CHILD = """
+import json, sys, time
+start = time.perf_counter()
+result_file, argv, run, heavy = sys.argv[1], json.loads(sys.argv[2]), sys.argv[3] == "1", json.loads(sys.argv[4])
+sys.argv = ["nlpipe.py"] + argv
+loaded = lambda: sorted(m for m in heavy if m in sys.modules)
+import nlpipe
+try:
+    nlpipe.parse_args()
+except SystemExit:
+    run = False
+result = {"parse_time": time.perf_counter() - start, "after_parse": loaded()}
+if run:
+    try:
+        nlpipe.main()
+    except SystemExit:
+        pass
+result.update(run_time=time.perf_counter() - start, after_run=loaded())
+with open(result_file, "w") as fout:
+    json.dump(result, fout)
+"""
+
+
+def mode_arguments(args: argparse.Namespace,
+                   mode: str,
+                   source_path: pathlib.Path,
+                   config_file: pathlib.Path,
+                   spacy_model: str,
+                   sbert_model: str) -> List[str]:
+    """Returns the arguments of nlpipe.py for a mode"""
+
+    destination_path = pathlib.Path(args.workdir).joinpath("startup", f"output_{mode}.parquet")
+    argv = ["--source_path", source_path.as_posix(),
+            "--source", "startup",
+            "--config_file", config_file.as_posix(),
+            "--destination_path", destination_path.as_posix(),
+            "--lang", args.lang,
+            "--stw_path", ROOT.joinpath("data", "stw_lists").as_posix(),
+            "--spacy_model", spacy_model]
+    if sbert_model is not None:
+        argv += ["--embeddings_model", sbert_model]
+        if not args.sbert_model:
+            argv += ["--max_sequence_length", str(args.stub_seq_length)]
+    if mode in _STORE_MODES:
+        argv += ["--embeddings_store", pathlib.Path(args.workdir).joinpath("startup", f"store_{mode}").as_posix()]
+    return argv + MODES[mode][0]
+
+
+def run_mode(args: argparse.Namespace, mode: str, argv: List[str]) -> Dict:
+    """Runs nlpipe.py in a new interpreter --repeat times, and returns the best times and the heavy modules loaded"""
+
+    _, run, forbidden = MODES[mode]
+    run = run and not args.parse_only
+    output_dir = pathlib.Path(args.workdir).joinpath("startup")
+    warm_up = run and mode in _STORE_MODES
+    if warm_up:
+        shutil.rmtree(output_dir.joinpath(f"store_{mode}"), ignore_errors=True)
+    runs = []
+    for _ in range(args.repeat + warm_up):
+        for output in output_dir.glob(f"output_{mode}*"):
+            shutil.rmtree(output) if output.is_dir() else output.unlink()
+        with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as tmp:
+            result_file = tmp.name
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", _CHILD, result_file, json.dumps(argv),
+                        "1" if run else "0", json.dumps(HEAVY_MODULES)],
+                       cwd=ROOT, stdout=subprocess.DEVNULL,
+                       stderr=None if args.verbose else subprocess.DEVNULL, check=True)
+        wall_time = time.perf_counter() - start
+        with open(result_file) as fin:
+            runs.append(dict(json.load(fin), wall_time=wall_time))
+        os.unlink(result_file)
+    runs = runs[warm_up:]
+
+    result = {"mode": mode,
+              "wall_time": min(r["wall_time"] for r in runs),
+              "parse_time": min(r["parse_time"] for r in runs),
+              "after_parse": runs[0]["after_parse"],
+              "after_run": runs[0]["after_run"]}
+    errors = []
+    if result["after_parse"]:
+        errors.append(f"loaded after parsing: {', '.join(result['after_parse'])}")
+    if result["parse_time"] > args.budget:
+        errors.append(f"import and parsing took {result['parse_time']:.3f}s > {args.budget}s")
+    unexpected = [m for m in result["after_run"] if m in forbidden]
+    if unexpected:
+        errors.append(f"loaded by the end of the run: {', '.join(unexpected)}")
+    result["errors"] = "; ".join(errors)
+    return result
+
+
+def print_table(results: List[dict]) -> None:
+    """Prints the results as a table"""
+
+    print(f"{'mode':<20}{'wall (s)':>10}{'parse (s)':>11}  {'loaded after parsing':<22}{'status':<8}loaded by the end of the run")
+    for r in results:
+        print(f"{r['mode']:<20}{r['wall_time']:>10.3f}{r['parse_time']:>11.3f}  {' '.join(r['after_parse']) or '-':<22}"
+              f"{'FAIL' if r['errors'] else 'OK':<8}{' '.join(r['after_run']) or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Startup budget of nlpipe.py for each mode of the CLI")
+    parser.add_argument("--modes", type=str, nargs="+", default=list(MODES), choices=list(MODES),
+                        required=False, help="Modes of nlpipe.py to be run")
+    parser.add_argument("--budget", type=float, default=0.25,
+                        required=False, help="Maximum time in seconds to import nlpipe and parse the arguments")
+    parser.add_argument("--lang", type=str, default="en",
+                        required=False, help="Language of the corpus (en/es)")
+    parser.add_argument("--n_docs", type=int, default=200,
+                        required=False, help="Number of documents of the corpus")
+    parser.add_argument("--vocabulary_size", type=int, default=20000,
+                        required=False, help="Number of distinct content words of the corpus")
+    parser.add_argument("--seed", type=int, default=0,
+                        required=False, help="Seed of the corpus and stubs")
+    parser.add_argument("--repeat", type=int, default=3,
+                        required=False, help="Number of runs of each mode")
+    parser.add_argument("--spacy_model", type=str, default=None,
+                        required=False, help="spaCy model to be used instead of the stub")
+    parser.add_argument("--sbert_model", type=str, default=None,
+                        required=False, help="SentenceTransformer model to be used instead of the stub")
+    parser.add_argument("--stub_dim", type=int, default=64,
+                        required=False, help="Hidden size of the SentenceTransformer stub")
+    parser.add_argument("--stub_seq_length", type=int, default=256,
+                        required=False, help="Context of the SentenceTransformer stub")
+    parser.add_argument("--workdir", type=str, default="benchmarks/.work",
+                        required=False, help="Folder where the corpus, stubs and outputs are saved")
+    parser.add_argument("--parse_only", default=False, required=False,
+                        action="store_true", help="Flag to only check the imports and parsing of nlpipe.py, without running it (no corpus or models are needed)")
+    parser.add_argument("--verbose", default=False, required=False,
+                        action="store_true", help="Flag to show the logs of nlpipe.py")
+    parser.add_argument("--output", type=str, default=None,
+                        required=False, help="Path to save the results (.json or .csv)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level='WARNING')
+
+    workdir = pathlib.Path(args.workdir).resolve()
+    args.workdir = workdir.as_posix()
+    startup_dir = workdir.joinpath("startup")
+    startup_dir.mkdir(parents=True, exist_ok=True)
+
+    source_path = startup_dir.joinpath(f"corpus_{args.lang}_{args.n_docs}_{args.vocabulary_size}_{args.seed}.parquet")
+    config_file = startup_dir.joinpath("config.json")
+    if args.parse_only:
+        # The arguments are only parsed, so the corpus and models they refer to need not exist
+        spacy_model = args.spacy_model or "en_core_web_md"
+        sbert_model = args.sbert_model or "all-mpnet-base-v2"
+    else:
+        if not source_path.is_file():
+            make_corpus(args.lang, args.n_docs, vocabulary_size=args.vocabulary_size,
+                        seed=args.seed).to_parquet(source_path, index=False)
+        # The corpus is declared monolingual, as synthetic words are not detected as any language
+        config_file.write_text(json.dumps(
+            {"startup": {"id": "id", "raw_text": "raw_text", "title": "", "lang": args.lang}}))
+
+        # Stubs are added to the import path of the processes started afterwards
+        spacy_model = args.spacy_model or build_spacy_stub(
+            args.lang, workdir.joinpath("models"), args.vocabulary_size, args.seed)
+        sbert_model = None
+        if any("--do_embeddings" in MODES[mode][0] for mode in args.modes):
+            sbert_model = args.sbert_model or build_sbert_stub(
+                args.lang, workdir.joinpath("models"), dim=args.stub_dim, max_seq_length=args.stub_seq_length,
+                vocabulary_size=args.vocabulary_size, seed=args.seed)
+
+    results = []
+    for mode in args.modes:
+        argv = mode_arguments(args, mode, source_path, config_file, spacy_model, sbert_model)
+        results.append(run_mode(args, mode, argv))
+
+    print_table(results)
+
+    if args.output:
+        save_results(args.output, results, vars(args))
+
+    for output in list(startup_dir.glob("output_*")) + list(startup_dir.glob("store_*")):
+        shutil.rmtree(output) if output.is_dir() else output.unlink()
+
+    failed = [r for r in results if r["errors"]]
+    if failed:
+        print("\nStartup budget exceeded: " + "; ".join(f"{r['mode']} ({r['errors']})" for r in failed))
+        sys.exit(1)
+    print("\nEvery mode is within its startup budget")
+
+
+if __name__ == "__main__":
+    main()
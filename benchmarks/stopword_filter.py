@@ -0,0 +1,113 @@
+"""
+Microbenchmark of the per-token filtering step of Pipe.do_pipeline.
+
+It compares the former filter (stopwords kept as a list, POS tags compared as strings and the set of valid POS tags rebuilt on every call) with Pipe._filter_doc (frozenset of stopword hashes and precomputed POS symbols) on a fixed, seeded corpus sample. Documents are tokenized and annotated once beforehand, so only the filtering cost is measured.
+
+By default, a blank spaCy pipeline with a deterministic POS/lemma annotator is used, so the benchmark runs offline; a trained model can be given with --spacy_model.
+
+Usage:
+    python benchmarks/stopword_filter.py [--lang en] [--n_docs 2000] [--repeat 5]
+"""
+import argparse
+import logging
+import pathlib
+import random
+import sys
+import time
+
+import spacy
+from spacy.language import Language
+
+sys.path.insert(0, pathlib.Path(__file__).resolve().parents[1].as_posix())
+
+from src.pipe import Pipe  # noqa: E402
+
+_POS_CYCLE = ['NOUN', 'VERB', 'ADJ', 'PROPN', 'DET', 'ADP', 'NOUN', 'PUNCT']
+
+
+@Language.component("bench_annotator")
+def bench_annotator(doc):
+    """Assigns deterministic POS tags and lemmas, in lieu of a trained model"""
+    for i, token in enumerate(doc):
+        token.pos_ = _POS_CYCLE[i % len(_POS_CYCLE)]
+        token.lemma_ = token.lower_
+    return doc
+
+
+def make_corpus(stw_list, n_docs, doc_len, seed=0):
+    """Builds a fixed corpus sample mixing stopwords and content words"""
+    rnd = random.Random(seed)
+    stopwords = [w for w in stw_list if isinstance(w, str) and w.isalpha()]
+    content = ["".join(rnd.choice("abcdefghijklmnopqrstuvwxyz")
+                       for _ in range(rnd.randint(3, 10))) for _ in range(5000)]
+    return [" ".join(rnd.choice(stopwords) if rnd.random() < 0.4 else rnd.choice(content)
+                     for _ in range(doc_len)) for _ in range(n_docs)]
+
+
+def legacy_filter(doc, stw_list):
+    """Token filter as implemented before the stopword index"""
+    valid_POS = set(['VERB', 'NOUN', 'ADJ', 'PROPN'])
+    lemmatized = [token.lemma_ for token in doc
+                  if token.is_alpha
+                  and token.pos_ in valid_POS
+                  and not token.is_stop
+                  and token.lemma_ not in stw_list]
+    return [token.lower() for token in lemmatized]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Microbenchmark of the stopword filtering in Pipe.do_pipeline")
+    parser.add_argument("--lang", type=str, default="en",
+                        required=False, help="Language of the stopword lists (en/es)")
+    parser.add_argument("--stw_path", type=str, default="data/stw_lists",
+                        required=False, help="Folder path for stopwords")
+    parser.add_argument("--spacy_model", type=str, default=None,
+                        required=False, help="Trained spaCy model to annotate the sample (optional)")
+    parser.add_argument("--n_docs", type=int, default=2000,
+                        required=False, help="Number of documents in the sample")
+    parser.add_argument("--doc_len", type=int, default=200,
+                        required=False, help="Number of words per document")
+    parser.add_argument("--repeat", type=int, default=5,
+                        required=False, help="Number of timed repetitions (best is reported)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level='WARNING')
+
+    stw_files = [entry for entry in pathlib.Path(args.stw_path).joinpath(args.lang).iterdir()
+                 if entry.as_posix().endswith("txt")]
+
+    # Only the stopword state of the pipeline is needed
+    pipe = Pipe.__new__(Pipe)
+    pipe._logger = logging.getLogger('benchmark')
+    pipe._loadSTW(stw_files)
+    stw_list = list(pipe._stw_set)
+
+    if args.spacy_model:
+        nlp = spacy.load(args.spacy_model, exclude=['parser', 'ner'])
+    else:
+        nlp = spacy.blank(args.lang)
+        nlp.add_pipe("bench_annotator")
+
+    docs = list(nlp.pipe(make_corpus(stw_list, args.n_docs, args.doc_len)))
+    n_tokens = sum(len(doc) for doc in docs)
+
+    filters = [("list + str POS (before)", lambda doc: legacy_filter(doc, stw_list)),
+               ("hash set + POS ids (after)", pipe._filter_doc)]
+
+    reference = [filters[0][1](doc) for doc in docs]
+    print(f"{len(stw_list)} stopwords, {len(docs)} docs, {n_tokens} tokens")
+    print(f"{'filter':<30}{'total (s)':>12}{'ns/token':>12}")
+    for name, filter_fn in filters:
+        assert [filter_fn(doc) for doc in docs] == reference
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            for doc in docs:
+                filter_fn(doc)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:<30}{best:>12.4f}{1e9 * best / n_tokens:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,312 @@
+"""
+Synthetic corpora and local model stubs for the offline benchmarks.
+
+Corpora are generated deterministically from a seed. Documents are paragraphs of sentences that mix the language's stopwords with content words drawn from a Zipf-distributed vocabulary of pronounceable pseudo-words. Some content words are inflected, and acronyms (and, in English, contractions) are sprinkled in, so that every step of Pipe.do_pipeline has work to do. Document lengths, in words, follow a configurable distribution (lognormal, uniform or fixed), so that the long tail of real corpora can be reproduced.
+
+Two model stubs are provided, so that no model has to be downloaded:
+- build_spacy_stub saves a spaCy pipeline as an importable package, which is how spaCy models are loaded by Pipe (see pipe.load_nlp). The pipeline is a blank tokenizer plus an attribute ruler that tags the vocabulary of the corpus and a lookup lemmatizer that undoes its inflections. Because it is loaded by name, Dask and spaCy worker processes can load it too.
+- build_sbert_stub saves a SentenceTransformer made of a small randomly initialized BERT and a word-level fast tokenizer over the same vocabulary. It runs the same code paths as a real model, e.g., tokenizer offsets for pooled windows. It requires torch, transformers and tokenizers.
+"""
+import os
+import pathlib
+import string
+import sys
+import tempfile
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, pathlib.Path(__file__).resolve().parents[1].as_posix())
+
+from src.acronyms import en_acronyms_list, es_acronyms_list  # noqa: E402
+
+LENGTH_DISTRIBUTIONS = ("lognormal", "uniform", "fixed")
+
+_LANGS = {
+    "en": {"onsets": ["b", "c", "d", "f", "g", "h", "l", "m", "n", "p", "r", "s", "t", "v", "w",
+                      "br", "cl", "cr", "dr", "fl", "gr", "pl", "pr", "sh", "st", "th", "tr"],
+           "vowels": ["a", "e", "i", "o", "u", "ea", "ai", "oo", "ou"],
+           "codas": ["", "", "n", "r", "s", "t", "nd", "st", "ck", "ng"],
+           "suffixes": ["s", "ed", "ing"],
+           "acronyms": en_acronyms_list,
+           "contractions": ["don't", "it's", "can't", "we're", "they've", "isn't", "won't", "I'm"]},
+    "es": {"onsets": ["b", "c", "d", "f", "g", "j", "l", "m", "n", "p", "r", "s", "t", "v", "ll",
+                      "ch", "br", "cr", "pl", "pr", "tr"],
+           "vowels": ["a", "e", "i", "o", "u", "ia", "ie", "ue", "io"],
+           "codas": ["", "", "", "n", "r", "s", "l"],
+           "suffixes": ["s", "es", "ado", "ando"],
+           "acronyms": es_acronyms_list,
+           "contractions": []},
+}
+
+# Part of speech of the content words, cycled over the vocabulary. Adverbs are dropped by Pipe's filter
+_POS_CYCLE = ["NOUN", "NOUN", "VERB", "ADJ", "NOUN", "PROPN", "VERB", "ADV"]
+
+
+def make_vocabulary(lang: str,
+                    size: int = 20000,
+                    seed: int = 0) -> List[str]:
+    """
+    Generates a vocabulary of distinct pronounceable pseudo-words of the given language, ordered by their rank in the Zipf distribution from which they are drawn
+    """
+
+    rnd = np.random.default_rng(seed)
+    spec = _LANGS[lang]
+    onsets, vowels, codas = spec["onsets"], spec["vowels"], spec["codas"]
+    vocabulary, seen = [], set()
+    while len(vocabulary) < size:
+        n_syllables = rnd.integers(1, 5, size)
+        syllables = rnd.integers(0, [len(onsets), len(vowels)], (size, 4, 2))
+        coda = rnd.integers(0, len(codas), size)
+        for n, syl, c in zip(n_syllables, syllables, coda):
+            word = "".join(onsets[o] + vowels[v] for o, v in syl[:n]) + codas[c]
+            if len(word) > 2 and word not in seen and len(vocabulary) < size:
+                seen.add(word)
+                vocabulary.append(word)
+    return vocabulary
+
+
+def _stopwords(lang: str) -> List[str]:
+    if lang == "es":
+        from spacy.lang.es.stop_words import STOP_WORDS
+    else:
+        from spacy.lang.en.stop_words import STOP_WORDS
+    return sorted(w for w in STOP_WORDS if w.isalpha())
+
+
+def _doc_lengths(rnd: np.random.Generator,
+                 n_docs: int,
+                 doc_len: int,
+                 length_dist: str,
+                 sigma: float) -> np.ndarray:
+    if length_dist == "lognormal":
+        # Median doc_len; sigma controls the tail of long documents
+        lengths = rnd.lognormal(np.log(doc_len), sigma, n_docs)
+    elif length_dist == "uniform":
+        lengths = rnd.uniform(doc_len / 2, 3 * doc_len / 2, n_docs)
+    elif length_dist == "fixed":
+        lengths = np.full(n_docs, doc_len)
+    else:
+        raise ValueError(
+            f"Unsupported length distribution: {length_dist}. Available: {', '.join(LENGTH_DISTRIBUTIONS)}")
+    return np.maximum(np.round(lengths), 1).astype(int)
+
+
+def make_corpus(lang: str,
+                n_docs: int,
+                doc_len: int = 200,
+                length_dist: str = "lognormal",
+                sigma: float = 0.8,
+                vocabulary_size: int = 20000,
+                seed: int = 0) -> pd.DataFrame:
+    """
+    Generates a synthetic corpus
+
+    Parameters
+    ----------
+    lang: str
+        Language of the corpus (en/es)
+    n_docs: int
+        Number of documents
+    doc_len: int
+        Typical number of words per document: median of the lognormal distribution, center of the uniform one or length of every document
+    length_dist: str
+        Distribution of the document lengths (lognormal, uniform or fixed)
+    sigma: float
+        Standard deviation of the logarithm of the lengths, with the lognormal distribution
+    vocabulary_size: int
+        Number of distinct content words
+    seed: int
+        Seed of the generator; the same arguments always give the same corpus
+
+    Returns
+    -------
+    corpus_df: pd.DataFrame
+        Corpus with columns id and raw_text
+    """
+
+    rnd = np.random.default_rng(seed)
+    spec = _LANGS[lang]
+    vocabulary = np.array(make_vocabulary(lang, vocabulary_size, seed))
+    stopwords = np.array(_stopwords(lang))
+    acronyms = np.array([pattern.replace(r"\b", "") for pattern, _ in spec["acronyms"]])
+    contractions = np.array(spec["contractions"] or stopwords)
+    suffixes = np.array(spec["suffixes"])
+    # Content words are drawn by rank from a Zipf distribution, through its cumulative distribution
+    cdf = np.cumsum(1 / np.arange(1, len(vocabulary) + 1) ** 1.1)
+    cdf /= cdf[-1]
+    # Share of stopwords, acronyms, contractions and inflected content words; the rest are base content words
+    shares = np.cumsum([0.42, 0.01, 0.01 if spec["contractions"] else 0.0, 0.18])
+
+    texts = []
+    for length in _doc_lengths(rnd, n_docs, doc_len, length_dist, sigma):
+        kinds = np.searchsorted(shares, rnd.random(length), side="right")
+        content = vocabulary[np.searchsorted(cdf, rnd.random(length), side="right")]
+        words = np.where(kinds == 3, np.char.add(content, suffixes[rnd.integers(0, len(suffixes), length)]),
+                         content).astype(object)
+        words[kinds == 0] = stopwords[rnd.integers(0, len(stopwords), (kinds == 0).sum())]
+        words[kinds == 1] = acronyms[rnd.integers(0, len(acronyms), (kinds == 1).sum())]
+        words[kinds == 2] = contractions[rnd.integers(0, len(contractions), (kinds == 2).sum())]
+        words = words.tolist()
+
+        # Sentences of 5 to 30 words, grouped in paragraphs of 2 to 6 sentences
+        paragraphs, sentences, start = [], [], 0
+        while start < length:
+            end = min(start + int(rnd.integers(5, 31)), length)
+            sentence = " ".join(words[start:end])
+            sentences.append(sentence[:1].upper() + sentence[1:] + rnd.choice([".", ".", ".", "?", "!"]))
+            if len(sentences) >= rnd.integers(2, 7):
+                paragraphs.append(" ".join(sentences))
+                sentences = []
+            start = end
+        if sentences:
+            paragraphs.append(" ".join(sentences))
+        texts.append("\n\n".join(paragraphs))
+
+    return pd.DataFrame({"id": [f"{lang}_{i}" for i in range(n_docs)],
+                         "raw_text": texts})
+
+
+def _tagged_vocabulary(lang: str,
+                       vocabulary_size: int,
+                       seed: int) -> Dict[str, List[str]]:
+    """
+    Returns the surface forms of the content words (base and inflected, lowercase and capitalized), grouped by part of speech, and the lemma of every inflected form
+    """
+
+    spec = _LANGS[lang]
+    forms = {pos: [] for pos in _POS_CYCLE}
+    lemmas = {}
+    for i, word in enumerate(make_vocabulary(lang, vocabulary_size, seed)):
+        for form in [word] + [word + suffix for suffix in spec["suffixes"]]:
+            for variant in (form, form.capitalize()):
+                forms[_POS_CYCLE[i % len(_POS_CYCLE)]].append(variant)
+                if form != word:
+                    lemmas[variant] = word
+    # Expansions of the acronyms are tagged as nouns
+    expansions = {word for _, expansion in spec["acronyms"]
+                  for word in expansion.split() if word.isalpha()}
+    forms["NOUN"].extend(sorted(expansions))
+    return {"forms": forms, "lemmas": lemmas}
+
+
+def build_spacy_stub(lang: str,
+                     models_path: pathlib.Path,
+                     vocabulary_size: int = 20000,
+                     seed: int = 0) -> str:
+    """
+    Saves a spaCy stub for the vocabulary of make_corpus(lang, ..., vocabulary_size, seed) as an importable package in models_path, which is added to the import path of the current process and of the processes it starts.
+
+    Besides the components needed for lemmatization (attribute_ruler and lemmatizer), the stub has word vectors, a sentencizer and an entity_ruler, as the components that the "lemma" spaCy profile of Pipe does not load
+
+    Returns
+    -------
+    spacy_model: str
+        Name of the package, to be given to Pipe as spaCy model
+    """
+
+    import numpy as np
+    import spacy
+    import srsly
+    from spacy.lookups import Lookups
+
+    models_path = pathlib.Path(models_path).resolve()
+    name = f"nlpipe_bench_{lang}_{vocabulary_size}_{seed}"
+    package = models_path.joinpath(name)
+
+    if not (package.joinpath("__init__.py").is_file() and package.joinpath("meta.json").is_file()):
+        tagged = _tagged_vocabulary(lang, vocabulary_size, seed)
+        nlp = spacy.blank(lang)
+        ruler = nlp.add_pipe("attribute_ruler")
+        for pos, forms in tagged["forms"].items():
+            ruler.add([[{"ORTH": {"IN": forms}}]], {"POS": pos})
+        ruler.add([[{"IS_PUNCT": True}]], {"POS": "PUNCT"})
+        lookups = Lookups()
+        lookups.add_table("lemma_lookup", tagged["lemmas"])
+        nlp.add_pipe("lemmatizer", config={"mode": "lookup"}).initialize(lookups=lookups)
+        nlp.add_pipe("sentencizer")
+        nlp.add_pipe("entity_ruler").add_patterns(
+            [{"label": "ORG", "pattern": form} for form in tagged["forms"]["PROPN"]])
+        words = [form for forms in tagged["forms"].values() for form in forms]
+        vectors = np.random.default_rng(seed).standard_normal((len(words), 96), dtype=np.float32)
+        for word, vector in zip(words, vectors):
+            nlp.vocab.set_vector(word, vector)
+        nlp.meta["name"] = name
+        nlp.meta["version"] = "0.0.0"
+        package.mkdir(parents=True, exist_ok=True)
+        nlp.to_disk(package.joinpath("model"))
+        # Installed spaCy packages list their components in a meta.json next to their __init__.py
+        srsly.write_json(package.joinpath("meta.json"), nlp.meta)
+        package.joinpath("__init__.py").write_text(
+            "from pathlib import Path\n\n"
+            "from spacy.util import load_model_from_path\n\n\n"
+            "def load(**overrides):\n"
+            "    return load_model_from_path(Path(__file__).parent / 'model', **overrides)\n",
+            encoding="utf8")
+
+    # Dask's and spaCy's worker processes inherit the environment
+    if models_path.as_posix() not in sys.path:
+        sys.path.insert(0, models_path.as_posix())
+        os.environ["PYTHONPATH"] = os.pathsep.join(
+            [models_path.as_posix()] + [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p])
+
+    return name
+
+
+def build_sbert_stub(lang: str,
+                     models_path: pathlib.Path,
+                     dim: int = 64,
+                     num_layers: int = 2,
+                     max_seq_length: int = 256,
+                     vocabulary_size: int = 20000,
+                     seed: int = 0) -> str:
+    """
+    Saves a SentenceTransformer stub (a randomly initialized BERT with mean pooling) for the vocabulary of make_corpus(lang, ..., vocabulary_size, seed) in models_path
+
+    Returns
+    -------
+    sbert_model: str
+        Path of the model, to be given to EmbeddingsManager as model name
+    """
+
+    model_path = pathlib.Path(models_path).resolve().joinpath(
+        f"sbert_stub_{lang}_{vocabulary_size}_{seed}_{dim}x{num_layers}")
+    if model_path.joinpath("modules.json").is_file():
+        return model_path.as_posix()
+
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from sentence_transformers import models as st_models
+    from tokenizers import Tokenizer, normalizers, pre_tokenizers, processors
+    from tokenizers.models import WordLevel
+    from transformers import BertConfig, BertModel, PreTrainedTokenizerFast
+
+    special = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    words = {form.lower() for forms in _tagged_vocabulary(lang, vocabulary_size, seed)["forms"].values()
+             for form in forms}
+    words.update(w.lower() for w in _stopwords(lang))
+    vocab = {token: i for i, token in enumerate(special + sorted(words) + list(string.punctuation))}
+
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=True, strip_accents=False)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]", pair="[CLS] $A [SEP] $B [SEP]",
+        special_tokens=[("[CLS]", vocab["[CLS]"]), ("[SEP]", vocab["[SEP]"])])
+    hf_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, model_max_length=max_seq_length,
+        unk_token="[UNK]", pad_token="[PAD]", cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]")
+
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=len(vocab), hidden_size=dim, num_hidden_layers=num_layers,
+                        num_attention_heads=max(1, dim // 32), intermediate_size=4 * dim,
+                        max_position_embeddings=max_seq_length)
+    with tempfile.TemporaryDirectory() as transformer_path:
+        BertModel(config).save_pretrained(transformer_path)
+        hf_tokenizer.save_pretrained(transformer_path)
+        transformer = st_models.Transformer(transformer_path, max_seq_length=max_seq_length)
+        pooling = st_models.Pooling(transformer.get_word_embedding_dimension(), pooling_mode="mean")
+        SentenceTransformer(modules=[transformer, pooling]).save(model_path.as_posix())
+
+    return model_path.as_posix()
@@ -1,27 +1,506 @@
+from __future__ import annotations
+
 import argparse
 import json
 import logging
 import pathlib
+import shutil
 import sys
+import tempfile
 import time
+from typing import TYPE_CHECKING, List, Tuple, Union
+
+from src.profiling import STAGES, RunProfiler, profile_stage
+
+# Heavy libraries (dask, pandas, pyarrow, spaCy, gensim, sentence-transformers) are imported by the stages that need them, so that the CLI starts fast and each run only loads the libraries of the stages it carries out (see benchmarks/startup.py)
+if TYPE_CHECKING:
+    import dask.dataframe as dd
+    import pandas as pd
+
+    from src.embeddings_manager import EmbeddingsManager
+    from src.lang_detection import LanguageDetection
+    from src.pipe import Pipe
+
+
+def read_field_mappings(config_file: str,
+                        source: str,
+                        logger: logging.Logger) -> Tuple[str, Union[str, List[str]], str, str]:
+    """
+    Reads the id, raw text and title fields associated with the dataset under preprocessing from the configuration file, as well as its language if the dataset is declared monolingual (optional "lang" field). Exits if the dataset is unknown.
+
+    Parameters
+    ----------
+    config_file : str
+        Path to the configuration file
+    source : str
+        Name of the dataset
+    logger : logging.Logger
+        Logger object
+
+    Returns
+    -------
+    id_fld, raw_text_fld, title_fld, dataset_lang : Tuple[str, Union[str, List[str]], str, str]
+        Fields of the dataset, and its language (None if not declared)
+    """
+
+    with open(config_file) as f:
+        field_mappings = json.load(f)
+
+    if source in field_mappings:
+        mapping = field_mappings[source]
+        logger.info(f"-- -- Reading from {source}...")
+        id_fld = mapping["id"]
+        raw_text_fld = mapping["raw_text"]
+        title_fld = mapping["title"]
+        dataset_lang = mapping.get("lang")
+    else:
+        logger.error(f"Unknown source: {source}. Exiting...")
+        sys.exit()
 
-import dask.dataframe as dd
-import numpy as np
-import pandas as pd
-import pyarrow.parquet as pq
-from pyfiglet import figlet_format
-from termcolor import cprint
+    return id_fld, raw_text_fld, title_fld, dataset_lang
+
+
+def get_source_columns(id_fld: str,
+                       raw_text_fld: Union[str, List[str]],
+                       title_fld: str) -> List[str]:
+    """
+    Returns the columns of the source dataset that are used by the pipeline, so that only those are read
+
+    Parameters
+    ----------
+    id_fld : str
+        Name of the id field
+    raw_text_fld : Union[str, List[str]]
+        Name of the raw text field, or list of fields to be preprocessed separately
+    title_fld : str
+        Name of the title field ("" if not available)
+
+    Returns
+    -------
+    columns : List[str]
+        Names of the columns to read
+    """
+
+    columns = [id_fld]
+    if isinstance(raw_text_fld, list):
+        columns += raw_text_fld
+    else:
+        if title_fld != "":
+            columns.append(title_fld)
+        columns.append(raw_text_fld)
+
+    # Remove duplicates, keeping the order
+    return list(dict.fromkeys(columns))
+
+
+def parse_filters(filters: str) -> List[Tuple]:
+    """
+    Parses the row filters given in the command line as a JSON list of [column, op, value] triples (e.g., '[["year", ">=", 2020], ["country", "in", ["ES", "PT"]]]'), all of which must hold
+
+    Parameters
+    ----------
+    filters : str
+        Filters in JSON format, or None
+
+    Returns
+    -------
+    filters : List[Tuple]
+        List of (column, op, value) tuples, or None if no filters are given
+    """
+
+    if not filters:
+        return None
+
+    return [tuple(condition) for condition in json.loads(filters)]
+
+
+def create_pipe(args: argparse.Namespace,
+                raw_txt_flds: List[str],
+                logger: logging.Logger) -> Pipe:
+    """
+    Creates the NLP pipeline according to the command line arguments.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    raw_txt_flds : List[str]
+        Names of the raw text columns
+    logger : logging.Logger
+        Logger object
+
+    Returns
+    -------
+    nlpPipeline : Pipe
+        NLP pipeline
+    """
+
+    from src.pipe import Pipe
+
+    # Get stopword lists
+    stw_lsts = []
+    for entry in pathlib.Path(args.stw_path).joinpath(args.lang).iterdir():
+        # check if it is a file
+        if entry.as_posix().endswith("txt"):
+            stw_lsts.append(entry)
+
+    nlpPipeline = Pipe(stw_files=stw_lsts,
+                       spaCy_model=args.spacy_model,
+                       language=args.lang,
+                       max_length=args.max_doc_length,
+                       raw_text_cols=raw_txt_flds,
+                       acr_files=[pathlib.Path(f) for f in args.acr_files] if args.acr_files else None,
+                       expand_acronyms=not args.no_acronyms,
+                       expand_contractions=not args.no_contractions,
+                       spacy_profile=args.spacy_profile,
+                       spacy_vectors=not args.no_spacy_vectors,
+                       lemma_cache=pathlib.Path(args.lemma_cache) if args.lemma_cache else None,
+                       lemma_cache_max_size=args.lemma_cache_max_size * 1024 ** 2 if args.lemma_cache_max_size else None,
+                       lemma_cache_max_age=args.lemma_cache_max_age,
+                       logger=logger)
+
+    return nlpPipeline
+
+
+def create_embeddings_manager(args: argparse.Namespace,
+                              logger: logging.Logger) -> EmbeddingsManager:
+    """
+    Creates the embeddings manager according to the command line arguments
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    logger : logging.Logger
+        Logger object
+
+    Returns
+    -------
+    em : EmbeddingsManager
+        Embeddings manager
+    """
+
+    from src.embeddings_manager import EmbeddingsManager
+
+    return EmbeddingsManager(
+        logger=logger,
+        embeddings_store=pathlib.Path(args.embeddings_store) if args.embeddings_store else None,
+        embeddings_store_max_size=args.embeddings_store_max_size * 1024 ** 2 if args.embeddings_store_max_size else None,
+        embeddings_store_max_age=args.embeddings_store_max_age)
+
+
+def create_lang_detection(args: argparse.Namespace,
+                          dataset_lang: str,
+                          logger: logging.Logger) -> LanguageDetection:
+    """
+    Creates the language detection stage according to the command line arguments. Detection is skipped (None is returned) if the dataset is declared monolingual in the configuration file in the language under preprocessing; if it is declared in a different language, the application exits.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    dataset_lang : str
+        Language declared for the dataset in the configuration file (None if not declared)
+    logger : logging.Logger
+        Logger object
+
+    Returns
+    -------
+    lang_detection : LanguageDetection
+        Language detection stage, or None if detection is not needed
+    """
+
+    if dataset_lang is not None:
+        if dataset_lang != args.lang:
+            logger.error(
+                f"-- The dataset is declared in {dataset_lang}, but {args.lang} was requested. Exiting... ")
+            sys.exit()
+        logger.info(
+            f"-- -- Dataset declared monolingual ({dataset_lang}). Skipping language detection...")
+        return None
+
+    from src.lang_detection import LanguageDetection
+
+    return LanguageDetection(backend=args.lang_backend,
+                             max_chars=args.lang_max_chars,
+                             n_process=args.lang_n_process,
+                             logger=logger)
+
+
+def get_embeddings_path(destination_path: pathlib.Path) -> pathlib.Path:
+    """
+    Returns the path in which the data with embeddings is saved, given that of the preprocessed data.
+
+    Parameters
+    ----------
+    destination_path : pathlib.Path
+        Path to save the preprocessed data
+
+    Returns
+    -------
+    embeddings_path : pathlib.Path
+        Path to save the data with embeddings
+    """
+
+    if destination_path.as_posix().endswith("parquet"):
+        bare_name = destination_path.as_posix().split(".parquet")[0]
+        return pathlib.Path(bare_name + "_embeddings.parquet")
+    return pathlib.Path(destination_path.as_posix()+"_embeddings")
+
+
+def prepare_corpus(df: Union[dd.DataFrame, pd.DataFrame],
+                   id_fld: str,
+                   raw_text_fld: Union[str, List[str]],
+                   title_fld: str,
+                   lang: str,
+                   use_dask: bool,
+                   logger: logging.Logger,
+                   lang_detection: LanguageDetection = None) -> Tuple[Union[dd.DataFrame, pd.DataFrame], List[str]]:
+    """
+    Filters the documents of the source dataframe by language and builds the raw text columns to be preprocessed, according to the dataset's field mappings.
+
+    Parameters
+    ----------
+    df : Union[dd.DataFrame, pd.DataFrame]
+        Source dataframe
+    id_fld : str
+        Name of the id field
+    raw_text_fld : Union[str, List[str]]
+        Name of the raw text field, or list of fields to be preprocessed separately
+    title_fld : str
+        Name of the title field ("" if not available)
+    lang : str
+        Language of the documents to keep (en/es)
+    use_dask : bool
+        Whether df is a Dask DataFrame
+    logger : logging.Logger
+        Logger object
+    lang_detection : LanguageDetection, optional
+        Language detection stage. If None, detection is skipped and all the documents are kept
+
+    Returns
+    -------
+    corpus_df : Union[dd.DataFrame, pd.DataFrame]
+        Dataframe with the id and raw text columns
+    raw_txt_flds : List[str]
+        Names of the raw text columns
+    """
+
+    import numpy as np
+
+    # Detect abstracts' language and filter out those that are not in the language specified in lang
+    if lang_detection is not None:
+        logger.info(f"-- Detecting language...")
+        fld_lan = raw_text_fld[0] if isinstance(raw_text_fld, list) else raw_text_fld
+        logger.debug(f"-- -- Available columns: {str(list(df.columns))}")
+        logger.debug(f"-- -- Expected language column (fld_lan): {fld_lan}")
+        start_time = time.time()
+        df = df[lang_detection.detect(df[fld_lan], use_dask=use_dask) == lang]
+        logger.info(
+            f'-- -- Language detection finished in {(time.time() - start_time)}')
 
-from src.embeddings_manager import EmbeddingsManager
-from src.pipe import Pipe
-from src.utils import det, max_column_length, save_parquet
+    raw_txt_flds = ['raw_text']
+    # Concatenate title + abstract/summary if title is given
+    if title_fld != "" and not isinstance(raw_text_fld, list):
+        if use_dask:
+            df["raw_text"] = \
+                df[[title_fld, raw_text_fld]].apply(
+                    " ".join, axis=1, meta=('raw_text', 'str'))
+        else:
+            df["raw_text"] = df[title_fld] + " " + df[raw_text_fld]
+    # Only the raw_text field will be used
+    elif not isinstance(raw_text_fld, list):
+        # Rename text field to raw_text
+        df = df.rename(columns={raw_text_fld: 'raw_text'})
+    # If raw_text_fld is a list of fields,  we preprocess each field separately
+    elif isinstance(raw_text_fld, list):
+        raw_mappings = {fld: fld+"_raw_text" for fld in raw_text_fld}
+        df = df.rename(columns=raw_mappings)
+        raw_txt_flds = [value for _,value in raw_mappings.items()]
+    else:
+        logger.error(f"Invalid raw_text field provided. Exiting...")
+        sys.exit()
+      
+    # Keep only necessary columns
+    corpus_df = df[[id_fld,*raw_txt_flds]]
+
+    # Filter out rows with no raw_text
+    corpus_df = corpus_df.replace("nan", np.nan)
+    corpus_df = corpus_df.dropna(subset=[*raw_txt_flds], how="any")
+
+    return corpus_df, raw_txt_flds
+
+
+def stream_pipeline(args: argparse.Namespace,
+                    source_path: pathlib.Path,
+                    destination_path: pathlib.Path,
+                    fields: Tuple[str, Union[str, List[str]], str, str],
+                    logger: logging.Logger) -> None:
+    """
+    Runs the pipeline over a parquet dataset chunk by chunk, with pandas, so that peak memory is bounded by the chunk size rather than by the size of the dataset. Each chunk is read with pyarrow, filtered by language, lemmatized, embedded (if requested) and appended to the output parquet files.
+
+    N-grams detection needs statistics over the whole corpus, so it is carried out in two passes:
+    1. Chunks are lemmatized, their lemmas are fed to the Phrases model (Phrases.add_vocab) and they are spilled to a temporary parquet file next to the destination.
+    2. The Phrases model is frozen, and the spilled chunks are read back, n-grams are substituted and the rest of the stages are carried out.
+    Only the Phrases vocabulary grows with the corpus; it is pruned by gensim according to its max_vocab_size. The I/O of the spilled chunks is recorded under the "spill" stage, so that the "read" and "write" stages count each document once.
+
+    Parameters
+    ----------
+    args : argparse.Namespace
+        Command line arguments
+    source_path : pathlib.Path
+        Path to the source parquet dataset
+    destination_path : pathlib.Path
+        Path to save the preprocessed data
+    fields : Tuple[str, Union[str, List[str]], str, str]
+        Id, raw text and title fields of the dataset, and its declared language (see read_field_mappings). If None, preprocessed data (with lemmas) is read from destination_path and only the embeddings are calculated
+    logger : logging.Logger
+        Logger object
+    """
+
+    from gensim.models.phrases import Phrases
+
+    from src.utils import ParquetChunkWriter, get_parquet_types, iter_parquet_chunks
+
+    input_path = source_path if fields is not None else destination_path
+    columns, filters = None, None
+    if fields is not None:
+        id_fld, raw_text_fld, title_fld, dataset_lang = fields
+        lang_detection = create_lang_detection(args, dataset_lang, logger)
+        columns = get_source_columns(id_fld, raw_text_fld, title_fld)
+        filters = parse_filters(args.source_filters)
+    logger.info(
+        f"-- -- Streaming {input_path.as_posix()} in chunks of {args.chunk_size} rows...")
+
+    # Columns that are all null in the first chunk written take their type from the input dataset
+    input_types = get_parquet_types(input_path)
+    preproc_writer = None if args.no_preproc else ParquetChunkWriter(
+        destination_path, input_types)
+    emb_writer = None
+    em = None
+    if args.do_embeddings:
+        emb_writer = ParquetChunkWriter(
+            get_embeddings_path(destination_path), input_types)
+        em = create_embeddings_manager(args, logger)
+
+    def emit(chunk, raw_txt_flds):
+        # Save preprocessed chunk and, if required, calculate its embeddings
+        if preproc_writer is not None:
+            preproc_writer.write(chunk)
+        if em is not None:
+            chunk = em.bert_embeddings_from_df(
+                df=chunk,
+                text_columns=raw_txt_flds,
+                sbert_model_to_load=args.embeddings_model,
+                batch_size=args.embeddings_batch_size,
+                max_seq_length=args.max_sequence_length,
+                use_dask=False,
+                dtype=args.embeddings_dtype,
+                pooling=args.embeddings_pooling,
+                window_overlap=args.embeddings_overlap)
+            emb_writer.write(chunk, em.get_embeddings_schema())
+
+    nlpPipeline = None
+    phrase_models = {}
+    spill_dir = None
+    spill_writer = None
+    raw_txt_flds = None
+    start_time = time.time()
+    try:
+        for i, chunk in enumerate(iter_parquet_chunks(input_path, args.chunk_size,
+                                                          columns=columns,
+                                                          filters=filters)):
+            logger.info(f"-- -- Processing chunk {i} ({len(chunk)} rows)...")
+            if fields is not None:
+                chunk, raw_txt_flds = prepare_corpus(df=chunk.fillna(""),
+                                                     id_fld=id_fld,
+                                                     raw_text_fld=raw_text_fld,
+                                                     title_fld=title_fld,
+                                                     lang=args.lang,
+                                                     use_dask=False,
+                                                     logger=logger,
+                                                     lang_detection=lang_detection)
+            else:
+                raw_txt_flds = [
+                    col for col in chunk.columns if "raw_text" in col]
+            if len(chunk) == 0:
+                continue
+
+            if not args.no_preproc:
+                if nlpPipeline is None:
+                    nlpPipeline = create_pipe(args, raw_txt_flds, logger)
+
+                chunk = nlpPipeline.lemmatize(chunk,
+                                              batch_size=args.batch_size,
+                                              n_process=args.n_process)
+                lemmas_cols = nlpPipeline.get_lemmas_cols()
+
+                if not args.no_ngrams:
+                    # First pass: gather n-grams statistics and spill lemmas
+                    for col in lemmas_cols:
+                        if col not in phrase_models:
+                            phrase_models[col] = Phrases(
+                                min_count=args.ngrams_min_count,
+                                threshold=args.ngrams_threshold)
+                        with profile_stage("ngrams"):
+                            phrase_models[col].add_vocab(chunk[col])
+                for col in lemmas_cols:
+                    chunk[col] = chunk[col].apply(lambda x: " ".join(x))
+
+                if not args.no_ngrams:
+                    if spill_writer is None:
+                        spill_dir = pathlib.Path(tempfile.mkdtemp(
+                            prefix="nlpipe_", dir=destination_path.parent))
+                        spill_writer = ParquetChunkWriter(
+                            spill_dir.joinpath("lemmas.parquet"), input_types, stage="spill")
+                    spill_writer.write(chunk)
+                    continue
+
+            emit(chunk, raw_txt_flds)
+
+        if spill_writer is not None:
+            # Second pass: n-grams substitution with the frozen models
+            spill_writer.close()
+            logger.info("-- Carrying out n-grams substitution")
+            frozen_models = {col: model.freeze()
+                             for col, model in phrase_models.items()}
+            for chunk in iter_parquet_chunks(spill_dir.joinpath("lemmas.parquet"), args.chunk_size,
+                                             stage="spill"):
+                for col, model in frozen_models.items():
+                    chunk[col] = nlpPipeline.apply_ngrams(
+                        chunk[col].str.split(), model)
+                emit(chunk, raw_txt_flds)
+    finally:
+        for writer in [preproc_writer, emb_writer, spill_writer]:
+            if writer is not None:
+                writer.close()
+        if spill_dir is not None:
+            shutil.rmtree(spill_dir, ignore_errors=True)
+
+    written = preproc_writer.num_rows if preproc_writer is not None else emb_writer.num_rows
+    if not written:
+        logger.warning(f"-- -- No documents left to save after filtering.")
+    logger.info(
+        f'-- -- Streaming finished in {(time.time() - start_time)}: {written} documents saved')
 
-# ########################
-# Main body of application
-# ########################
-def main():
+    return
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    """
+    Parses the command line arguments. Only the standard library is needed to do so, so that invalid arguments and --help are reported without loading any heavy library.
+
+    Parameters
+    ----------
+    argv : List[str], optional
+        Arguments to be parsed. Defaults to sys.argv[1:]
+
+    Returns
+    -------
+    args : argparse.Namespace
+        Parsed arguments
+    """
 
-    # Read input arguments
     parser = argparse.ArgumentParser(
         description="NLPipe")
     parser.add_argument("--source_path", type=str, default=None,
@@ -30,16 +509,38 @@ def main():
                         required=False, help="Source file's format")
     parser.add_argument("--source", type=str, default=None,
                         required=True, help="Name of the dataset to be preprocessed (e.g., cordis, scholar, etc.)")
+    parser.add_argument("--source_filters", type=str, default=None,
+                        required=False, help="Row filters for parquet sources, as a JSON list of [column, op, value] triples")
     parser.add_argument("--destination_path", type=str, default=None,
                         required=True, help="Path to save the preprocessed data")
     parser.add_argument("--stw_path", type=str, default="data/stw_lists",
                         required=False, help="Folder path for stopwords")
+    parser.add_argument("--acr_files", type=str, nargs="*", default=None,
+                        required=False, help="Additional acronyms files, with one 'acronym,expansion' pair per line")
     parser.add_argument("--lang", type=str, default="en",
                         required=False, help="Language of the text to be preprocessed (en/es)")
+    parser.add_argument("--lang_backend", type=str, default="langdetect",
+                        required=False, help="Backend used for language detection")
+    parser.add_argument("--lang_max_chars", type=int, default=1000,
+                        required=False, help="Number of characters of each text used for language detection (0 uses the whole text)")
+    parser.add_argument("--lang_n_process", type=int, default=1,
+                        required=False, help="Number of processes used for language detection with pandas")
     parser.add_argument("--spacy_model", type=str, default="en_core_web_sm",
                         required=False, help="Spacy model to be used for preprocessing")
+    parser.add_argument("--spacy_profile", type=str, default="lemma", choices=["lemma", "full"],
+                        required=False, help="Components of the spaCy model to be loaded: only those needed for lemmatization (lemma) or all but the parser and the NER (full)")
+    parser.add_argument('--no_spacy_vectors', default=False, required=False,
+                        action='store_true', help="Flag to skip loading the word vectors of the spaCy model")
+    parser.add_argument('--no_acronyms', default=False, required=False,
+                        action='store_true', help="Flag to disable acronyms expansion")
+    parser.add_argument('--no_contractions', default=False, required=False,
+                        action='store_true', help="Flag to disable contractions expansion (English only)")
     parser.add_argument('--no_ngrams', default=False, required=False,
                         action='store_true', help="Flag to disable ngrams detection")
+    parser.add_argument("--ngrams_min_count", type=int, default=2,
+                        required=False, help="Minimum count of a bigram to be detected as n-gram")
+    parser.add_argument("--ngrams_threshold", type=float, default=20,
+                        required=False, help="Score threshold of a bigram to be detected as n-gram")
     parser.add_argument('--no_preproc', default=False, required=False,
                         action='store_true', help="Flag to disable NLP preprocessing")
     parser.add_argument('--do_embeddings', default=False, required=False,
@@ -49,14 +550,81 @@ def main():
                         help="Model to be used for calculating the embeddings")
     parser.add_argument("--max_sequence_length", type=int, default=384,
                         required=False, help="Context of the model to be used for calculating the embeddings.")
+    parser.add_argument("--embeddings_batch_size", type=int, default=32,
+                        required=False, help="Number of texts encoded together in each batch when calculating the embeddings")
+    parser.add_argument("--embeddings_dtype", type=str, default="float32",
+                        required=False, choices=["float32", "float16", "int8"],
+                        help="Data type in which the embeddings are saved. With int8, embeddings are quantized and their scale is saved in an additional '_scale' column")
+    parser.add_argument("--embeddings_pooling", type=str, default=None,
+                        required=False, choices=["mean", "max", "weighted"],
+                        help="Split documents longer than the model's context into windows, whose embeddings are pooled with this strategy. By default, they are truncated")
+    parser.add_argument("--embeddings_overlap", type=int, default=32,
+                        required=False, help="Number of tokens shared by consecutive windows of a long document")
+    parser.add_argument("--embeddings_store", type=str, default=None,
+                        required=False, help="Path to the on-disk embeddings store used to skip already embedded documents across runs. Disabled by default")
+    parser.add_argument("--embeddings_store_max_size", type=int, default=None,
+                        required=False, help="Maximum size of the embeddings store in MB")
+    parser.add_argument("--embeddings_store_max_age", type=float, default=None,
+                        required=False, help="Maximum age, in days since last use, of the embeddings store entries")
     parser.add_argument("--use_dask", default=False, required=False,
                         help="Flag to activate processing with Dask. By default, pandas is used")
     parser.add_argument("--nw", type=int, default=0,
                         required=False, help="Number of workers to use with Dask")
+    parser.add_argument("--scheduler", type=str, default="processes",
+                        required=False, choices=["processes", "distributed"], help="Dask scheduler: local processes, or a dask.distributed cluster")
+    parser.add_argument("--scheduler_address", type=str, default=None,
+                        required=False, help="Address of a running dask.distributed scheduler. If not given, a LocalCluster is started")
+    parser.add_argument("--memory_limit", type=str, default="auto",
+                        required=False, help="Memory limit of each worker of the LocalCluster (e.g., 4GB)")
+    parser.add_argument("--dask_checkpoint", type=str, default=None,
+                        required=False, help="Path in which intermediate Dask results are checkpointed (only the subfolder written by the run is removed afterwards). By default, with the processes scheduler they are checkpointed in a temporary folder next to the destination, since persisting them in memory would gather the whole corpus in the main process; with dask.distributed they are persisted in the workers' memory")
+    parser.add_argument("--max_doc_length", type=int, default=100000,
+                        required=False, help="Maximum number of characters processed by spaCy at once; longer documents are split at paragraph or sentence boundaries")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        required=False, help="Number of texts buffered by spaCy in each batch during lemmatization")
+    parser.add_argument("--n_process", type=int, default=1,
+                        required=False, help="Number of processes used by spaCy for lemmatization (pandas only; -1 uses all cores)")
+    parser.add_argument("--lemma_cache", type=str, default=None,
+                        required=False, help="Path to the on-disk lemma cache used to skip unchanged documents across runs. Disabled by default")
+    parser.add_argument("--lemma_cache_max_size", type=int, default=None,
+                        required=False, help="Maximum size of the lemma cache in MB")
+    parser.add_argument("--lemma_cache_max_age", type=float, default=None,
+                        required=False, help="Maximum age, in days since last use, of the lemma cache entries")
+    parser.add_argument("--stream", default=False, required=False,
+                        action='store_true', help="Flag to process a parquet source chunk by chunk with pandas, bounding memory usage")
+    parser.add_argument("--chunk_size", type=int, default=100000,
+                        required=False, help="Number of rows per chunk in streaming mode")
     parser.add_argument("--config_file", type=str, default="config.json",
                         required=False, help="Path to the configuration file")
+    parser.add_argument("--run_report", type=str, default=None,
+                        required=False, help="Path to save a JSON report with the wall time, CPU time, throughput and peak RSS of each stage")
+    parser.add_argument("--profile_stage", type=str, default=None,
+                        required=False, choices=list(STAGES),
+                        help="Stage to be run under cProfile in every process that runs it")
+    parser.add_argument("--profile_output", type=str, default=None,
+                        required=False, help="Path to save the merged cProfile statistics of --profile_stage. Defaults to <profile_stage>.prof")
+
+    return parser.parse_args(argv)
+
+
+def print_banner() -> None:
+    """Prints the name of the application"""
+
+    from pyfiglet import figlet_format
+    from termcolor import cprint
+
+    cprint(figlet_format("NLPipe",
+           font='big'), 'blue', attrs=['bold'])
+    print('\n')
 
-    args = parser.parse_args()
+
+# ########################
+# Main body of application
+# ########################
+def main():
+
+    # Read input arguments
+    args = parse_args()
 
     # Create logger object
     logging.basicConfig(level='INFO')
@@ -83,7 +651,15 @@ def main():
         sys.exit()
 
     destination_path = pathlib.Path(args.destination_path)
-    
+
+    # Check that streaming mode is used with a supported configuration
+    if args.stream and (args.use_dask or args.source_type != 'parquet'):
+        logger.error(
+            f"-- Streaming mode is only available with pandas and parquet sources. Exiting... ")
+        sys.exit()
+
+    print_banner()
+
     # Logging computing library used
     library = "Dask" if args.use_dask else "Pandas" 
     logger.info(
@@ -104,6 +680,7 @@ def main():
                             break
 
                 # Read the schema of the parquet file
+                import pyarrow.parquet as pq
                 schema = pq.read_schema(res)
 
                 # Get the list of column names
@@ -119,175 +696,211 @@ def main():
                         f"-- -- Lemmas in {destination_path.as_posix()}. \
                     Loading from there...")
 
-                    # Load df with lemmas
-                    corpus_df = dd.read_parquet(
-                        destination_path) if args.use_dask else pd.read_parquet(destination_path)
-                    raw_txt_flds = [col for col in corpus_df.columns if "raw_text" in col]
+                    # Load df with lemmas (in streaming mode, it is read chunk by chunk later on)
+                    if not args.stream:
+                        if args.use_dask:
+                            import dask.dataframe as dd
+                            corpus_df = dd.read_parquet(destination_path)
+                        else:
+                            import pandas as pd
+                            corpus_df = pd.read_parquet(destination_path)
+                        raw_txt_flds = [col for col in corpus_df.columns if "raw_text" in col]
 
             except Exception as e:
                 logger.info(
                     f"-- -- No available lemmas in {destination_path.as_posix()}. \
                     Loading from {source_path.as_posix()}...")
 
-    if not args.no_preproc or not from_preproc:
-
-        # Read config file to get the id, title and abstract fields associated with the dataset under preprocessing
-
-        with open(args.config_file) as f:
-            field_mappings = json.load(f)
-
-        if args.source in field_mappings:
-            mapping = field_mappings[args.source]
-            logger.info(f"-- -- Reading from {args.source}...")
-            id_fld = mapping["id"]
-            raw_text_fld = mapping["raw_text"]
-            title_fld = mapping["title"]
-        else:
-            logger.error(f"Unknown source: {args.source}. Exiting...")
-            sys.exit()
-
-        if args.use_dask:
-            readers = {
-                "xlsx": lambda path: dd.from_pandas(pd.read_excel(path), npartitions=3).fillna(""),
-                "csv": lambda path: dd.read_csv(path).fillna(""),
-                "parquet": lambda path: dd.read_parquet(path).fillna("")
-            }
-        else:
-            readers = {
-                "xlsx": lambda path: pd.read_excel(path).fillna(""),
-                "csv": lambda path: pd.read_csv(path).fillna(""),
-                "parquet": lambda path: pd.read_parquet(path).fillna("")
-            }
-
-        # Get reader according to file format
-        if args.source_type in readers:
-            reader = readers[args.source_type]
-            df = reader(source_path)
-        else:
-            logger.error(
-                f"-- Unsupported source type: {args.source_type}. Exiting...")
-            sys.exit()
-
-        # Detect abstracts' language and filter out those that are not in the language specified in args.lang
-        logger.info(f"-- Detecting language...")
-        fld_lan = raw_text_fld[0] if isinstance(raw_text_fld, list) else raw_text_fld
-        start_time = time.time()
-        if args.use_dask:
-            df = \
-                df[df[fld_lan].apply(
-                    det,
-                    meta=('langue', 'str')) == args.lang]
-        else:
-            print("Available columns:", df.columns)
-            print("Expected language column (fld_lan):", fld_lan)
-            df = df[df[fld_lan].apply(det) == args.lang]
-        logger.info(
-            f'-- -- Language detection finished in {(time.time() - start_time)}')
-
-        raw_txt_flds = ['raw_text']
-        # Concatenate title + abstract/summary if title is given
-        if title_fld != "" and not isinstance(raw_text_fld, list):
+    # Every stage records its work (in whichever process it runs) for the run report; the profiler is closed (and its spool folder removed) also if the run fails or exits
+    with RunProfiler(
+            profile_stage=args.profile_stage,
+            profile_output=pathlib.Path(
+                args.profile_output or f"{args.profile_stage}.prof"),
+            logger=logger) as run_profiler:
+
+        # Process the dataset chunk by chunk with bounded memory
+        if args.stream:
+            fields = None
+            if not args.no_preproc or not from_preproc:
+                fields = read_field_mappings(
+                    args.config_file, args.source, logger)
+            stream_pipeline(args, source_path, destination_path, fields, logger)
+            run_profiler.report(args.run_report, vars(args))
+            return
+
+        from src.utils import DaskStageTimer, compute_dask, save_parquet
+
+        # With Dask, expensive stages are materialized once (in checkpoint_dir, or in the workers' memory with dask.distributed), the outputs are written in a single execution, and the time spent in each stage is reported at the end
+        checkpoint_dir = None
+        client = None
+        temp_checkpoint = False
+        stage_timer = None
+        try:
             if args.use_dask:
-                df["raw_text"] = \
-                    df[[title_fld, raw_text_fld]].apply(
-                        " ".join, axis=1, meta=('raw_text', 'str'))
-            else:
-                df["raw_text"] = df[title_fld] + " " + df[raw_text_fld]
-        # Only the raw_text field will be used
-        elif not isinstance(raw_text_fld, list):
-            # Rename text field to raw_text
-            df = df.rename(columns={raw_text_fld: 'raw_text'})
-        # If raw_text_fld is a list of fields,  we preprocess each field separately
-        elif isinstance(raw_text_fld, list):
-            raw_mappings = {fld: fld+"_raw_text" for fld in raw_text_fld}
-            df = df.rename(columns=raw_mappings)
-            raw_txt_flds = [value for _,value in raw_mappings.items()]
-        else:
-            logger.error(f"Invalid raw_text field provided. Exiting...")
-            sys.exit()
-          
-        # Keep only necessary columns
-        corpus_df = df[[id_fld,*raw_txt_flds]]
-
-        # Filter out rows with no raw_text
-        corpus_df = corpus_df.replace("nan", np.nan)
-        corpus_df = corpus_df.dropna(subset=[*raw_txt_flds], how="any")
-        
-    # Carry out NLP preprocessing if flag is not deactivated
-    if not args.no_preproc:
-        # Check max length of raw_text column to pass to the Pipe class
-        logger.info(f"-- Checking max length of 'raw_text' columns ...")
-        lenghts = []
-        for raw_text_col in raw_txt_flds:
-            start_time = time.time()
-            max_len = max_column_length(corpus_df, raw_text_col, args.use_dask)
-            lenghts.append(max_len)
-            logger.info(
-                f'-- -- Max length calculation finished in {(time.time() - start_time)}')
-            logger.info(f"-- Max length of column {raw_text_col} is {max_len}.")
-        lenghts.sort(reverse=True)
-        max_len = lenghts[0]
-
-        # Get stopword lists
-        stw_lsts = []
-        for entry in pathlib.Path(args.stw_path).joinpath(args.lang).iterdir():
-            # check if it is a file
-            if entry.as_posix().endswith("txt"):
-                stw_lsts.append(entry)
-
-        # Create pipeline
-        nlpPipeline = Pipe(stw_files=stw_lsts,
-                           spaCy_model=args.spacy_model,
-                           language=args.lang,
-                           max_length=max_len,
-                           raw_text_cols=raw_txt_flds,
-                           logger=logger)
-
-        logger.info(f'-- -- NLP preprocessing starts...')
-
-        start_time = time.time()
-        corpus_df = nlpPipeline.preproc(corpus_df=corpus_df,
-                                        use_dask=args.use_dask,
-                                        nw=args.nw,
-                                        no_ngrams=args.no_ngrams)
-        logger.info(
-            f'-- -- NLP preprocessing finished in {(time.time() - start_time)}')
-
-        # Save new df in parquet file
-        logger.info(
-            f'-- -- Saving preprocessed data without embeddings in {destination_path.as_posix()}...')
-        save_parquet(outFile=destination_path, df=corpus_df,
-                     use_dask=args.use_dask, nw=args.nw)
+                if args.dask_checkpoint is not None:
+                    checkpoint_dir = pathlib.Path(args.dask_checkpoint)
+                elif args.scheduler != 'distributed' and not args.no_ngrams:
+                    # The processes scheduler persists partitions in the memory of this process, i.e., the whole lemmatized corpus, so they are checkpointed next to the destination instead
+                    checkpoint_dir = pathlib.Path(tempfile.mkdtemp(
+                        prefix="nlpipe_", dir=destination_path.parent))
+                    temp_checkpoint = True
+                stage_timer = DaskStageTimer()
+                stage_timer.register()
+                run_start = time.time()
+
+                if args.scheduler == 'distributed':
+                    # dask.distributed is an optional dependency, only needed by this backend
+                    from src.dask_backend import ModelsPlugin, start_client
+                    from src.pipe import spacy_exclude
+                    plugin = ModelsPlugin(
+                        spacy_model=None if args.no_preproc else args.spacy_model,
+                        spacy_exclude=() if args.no_preproc else spacy_exclude(
+                            args.spacy_model, args.spacy_profile, not args.no_spacy_vectors, logger),
+                        embeddings_model=args.embeddings_model if args.do_embeddings else None,
+                        max_seq_length=args.max_sequence_length)
+                    client = start_client(scheduler_address=args.scheduler_address,
+                                          n_workers=args.nw,
+                                          memory_limit=args.memory_limit,
+                                          plugin=plugin,
+                                          logger=logger)
+
+            if not args.no_preproc or not from_preproc:
+
+                # Read config file to get the id, title and abstract fields associated with the dataset under preprocessing
+                id_fld, raw_text_fld, title_fld, dataset_lang = read_field_mappings(
+                    args.config_file, args.source, logger)
+                lang_detection = create_lang_detection(args, dataset_lang, logger)
+
+                # Only the mapped columns are read; with parquet sources, rows are also filtered during the scan
+                columns = get_source_columns(id_fld, raw_text_fld, title_fld)
+                filters = parse_filters(args.source_filters)
+                if filters and args.source_type != 'parquet':
+                    logger.error(
+                        f"-- Row filters are only available with parquet sources. Exiting... ")
+                    sys.exit()
+                logger.info(f"-- -- Reading columns {columns} from {source_path.as_posix()}...")
+
+                import pandas as pd
+                if args.use_dask:
+                    import dask.dataframe as dd
+                    readers = {
+                        "xlsx": lambda path: dd.from_pandas(pd.read_excel(path, usecols=columns), npartitions=3).fillna(""),
+                        "csv": lambda path: dd.read_csv(path, usecols=columns).fillna(""),
+                        "parquet": lambda path: dd.read_parquet(path, columns=columns, filters=filters).fillna("")
+                    }
+                else:
+                    readers = {
+                        "xlsx": lambda path: pd.read_excel(path, usecols=columns).fillna(""),
+                        "csv": lambda path: pd.read_csv(path, usecols=columns).fillna(""),
+                        "parquet": lambda path: pd.read_parquet(path, columns=columns, filters=filters).fillna("")
+                    }
+
+                # Get reader according to file format
+                if args.source_type in readers:
+                    reader = readers[args.source_type]
+                    if args.use_dask:
+                        # Partitions are read by the tasks that process them
+                        df = reader(source_path)
+                    else:
+                        with profile_stage("read") as profiler:
+                            df = reader(source_path)
+                            profiler.docs = len(df)
+                else:
+                    logger.error(
+                        f"-- Unsupported source type: {args.source_type}. Exiting...")
+                    sys.exit()
+
+                corpus_df, raw_txt_flds = prepare_corpus(df=df,
+                                                         id_fld=id_fld,
+                                                         raw_text_fld=raw_text_fld,
+                                                         title_fld=title_fld,
+                                                         lang=args.lang,
+                                                         use_dask=args.use_dask,
+                                                         logger=logger,
+                                                         lang_detection=lang_detection)
+
+            writes = []
+
+            # Carry out NLP preprocessing if flag is not deactivated
+            if not args.no_preproc:
+                # Create pipeline
+                nlpPipeline = create_pipe(args, raw_txt_flds, logger)
+
+                logger.info(f'-- -- NLP preprocessing starts...')
+
+                start_time = time.time()
+                corpus_df = nlpPipeline.preproc(corpus_df=corpus_df,
+                                                use_dask=args.use_dask,
+                                                nw=args.nw,
+                                                no_ngrams=args.no_ngrams,
+                                                batch_size=args.batch_size,
+                                                n_process=args.n_process,
+                                                ngrams_min_count=args.ngrams_min_count,
+                                                ngrams_threshold=args.ngrams_threshold,
+                                                checkpoint_path=checkpoint_dir and checkpoint_dir.joinpath("lemmas"))
+                logger.info(
+                    f'-- -- NLP preprocessing finished in {(time.time() - start_time)}')
 
-    # Calculate embeddings if flag is activated
-    if args.do_embeddings:
+                # Save new df in parquet file
+                logger.info(
+                    f'-- -- Saving preprocessed data without embeddings in {destination_path.as_posix()}...')
+                writes.append(save_parquet(outFile=destination_path, df=corpus_df,
+                                           use_dask=args.use_dask, nw=args.nw,
+                                           compute=False))
+
+            # Calculate embeddings if flag is activated
+            if args.do_embeddings:
+
+                logger.info(f'-- -- Embeddings calculation starts...')
+                start_time = time.time()
+                em = create_embeddings_manager(args, logger)
+                corpus_df = em.bert_embeddings_from_df(
+                    df=corpus_df,
+                    text_columns=raw_txt_flds,
+                    sbert_model_to_load=args.embeddings_model,
+                    batch_size=args.embeddings_batch_size,
+                    max_seq_length=args.max_sequence_length,
+                    use_dask=args.use_dask,
+                    dtype=args.embeddings_dtype,
+                    pooling=args.embeddings_pooling,
+                    window_overlap=args.embeddings_overlap)
 
-        logger.info(f'-- -- Embeddings calculation starts...')
-        start_time = time.time()
-        em = EmbeddingsManager(logger=logger)
-        corpus_df = em.bert_embeddings_from_df(
-            df=corpus_df,
-            text_columns=raw_txt_flds,
-            sbert_model_to_load=args.embeddings_model,
-            batch_size=32,
-            max_seq_length=args.max_sequence_length,
-            use_dask=args.use_dask)
+                logger.info(
+                    f'-- -- Embeddings calculation finished in {(time.time() - start_time)}')
 
-        logger.info(
-            f'-- -- Embeddings calculation finished in {(time.time() - start_time)}')
+                destination_path = get_embeddings_path(destination_path)
 
-        if destination_path.as_posix().endswith("parquet"):
-            bare_name = destination_path.as_posix().split(".parquet")[0]
-            destination_path = pathlib.Path(bare_name + "_embeddings.parquet")
-        else:
-            destination_path = pathlib.Path(
-                destination_path.as_posix()+"_embeddings")
+                # Save new df in parquet file
+                logger.info(
+                    f'-- -- Saving final preprocessed data in {destination_path.as_posix()}...')
+                writes.append(save_parquet(outFile=destination_path, df=corpus_df,
+                                           use_dask=args.use_dask, nw=args.nw,
+                                           schema=em.get_embeddings_schema(),
+                                           compute=False))
 
-        # Save new df in parquet file
-        logger.info(
-            f'-- -- Saving final preprocessed data in {destination_path.as_posix()}...')
-        save_parquet(outFile=destination_path, df=corpus_df,
-                     use_dask=args.use_dask, nw=args.nw)
+            if args.use_dask:
+                # Both outputs share the n-grams substitution tasks, which are hence run once
+                start_time = time.time()
+                compute_dask(*[write for write in writes if write is not None], nw=args.nw)
+                logger.info(
+                    f'-- -- Outputs written in {(time.time() - start_time)}')
+                if client is not None:
+                    # Tasks run in the cluster are not seen by local callbacks, but recorded by the scheduler
+                    stage_timer.add_task_stream(client.get_task_stream(start=run_start))
+                stage_timer.log(logger)
+                # Reads and writes are fused with the tasks of other stages, so they are reported together with Dask's own overhead
+                run_profiler.add_residual("other", sum(stage_timer.timings.values()))
+        finally:
+            # Also on errors and exits, Dask's callbacks and cluster are stopped and the checkpoints removed: the whole folder if it was created by this run, or only the lemmas if it was given with --dask_checkpoint
+            if stage_timer is not None:
+                stage_timer.unregister()
+            if client is not None:
+                client.close()
+            if checkpoint_dir is not None:
+                shutil.rmtree(checkpoint_dir if temp_checkpoint else checkpoint_dir.joinpath("lemmas"),
+                              ignore_errors=True)
+
+        run_profiler.report(args.run_report, vars(args))
 
     return
 
@@ -296,8 +909,4 @@ def main():
 # Execute main
 if __name__ == '__main__':
 
-    cprint(figlet_format("NLPipe",
-           font='big'), 'blue', attrs=['bold'])
-    print('\n')
-
     main()
@@ -1,3 +1,7 @@
+import pathlib
+import re
+from typing import Dict, Iterable, List, Tuple
+
 en_acronyms_list = [(r'\bMRI\b', 'magnetic resonance image'),
                     (r'\bCT\b', 'computed tomography'),
                     (r'\bPET\b', 'positron emission tomography'),
@@ -95,3 +99,228 @@ es_acronyms_list = [(r'\bADN\b', 'ácido desoxirribonucleico'),
                     (r'\bETSIT\b', 'Escuela Técnica Superior de Ingenieros de Telecomunicación'),
                     (r'\bGREM\b', 'Gestión de Recursos Humanos y Emprendimiento')
                     ]
+
+
+# Characters that cannot surround a contraction, as in the contractions package
+_ASCII_WORD = "A-Za-z0-9_"
+
+
+def _trie_pattern(words: Iterable[str]) -> str:
+    """
+    Compiles a collection of (lowercase) words into a regular expression shaped as a prefix trie, e.g., "do(?:n't|esn't)". Unlike a flat alternation, which Python's re tries branch by branch at every position, the trie is descended one character at a time, so its cost does not grow with the number of words. Optional suffixes are greedy, so the longest word is tried first, and shorter ones are only matched when the longer ones fail.
+    """
+
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[""] = {}
+
+    def build(node: dict) -> str:
+        branches = [re.escape(char) + build(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ""
+        pattern = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        return "(?:" + pattern + ")?" if "" in node else pattern
+
+    return build(trie)
+
+
+def _match_case(word: str, rep: str) -> str:
+    """
+    Gives rep the casing of the matched word (upper, title, lower or sentence case), as the contractions package does
+    """
+
+    if word == word.upper():
+        return rep.upper()
+    if word == word.title():
+        return rep.title()
+    if word == word.lower():
+        return rep.lower()
+    if word == word[:1].upper() + word[1:].lower():
+        return rep[:1].upper() + rep[1:].lower()
+    return rep
+
+
+class AcronymMatcher():
+    """
+    Expands acronyms and, optionally, contractions in a single pass over the text.
+
+    All the (pattern, expansion) pairs are compiled once into one case-insensitive alternation. Patterns of the form r'\\bACRONYM\\b' (as the ones above) are resolved through a lookup table keyed by the lowercased acronym; any other pattern is kept as a named group of its own. As with the former sequential substitution, when several patterns match the same acronym the first one wins, and expansions are not scanned again.
+
+    Contractions (see load_contractions) are matched after the acronyms, as whole words delimited by non-ASCII-word characters, and their expansions take the casing of the matched text, as with contractions.fix. As acronyms used to be expanded before contractions, a contraction that contains an acronym which matches in context (e.g., "it's" and IT) is not expanded, and the acronym is instead.
+    """
+
+    _LITERAL = re.compile(r'\\b(\w+)\\b')
+
+    def __init__(self,
+                 patterns: List[Tuple[str, str]],
+                 contractions: Dict[str, str] = None):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        patterns: List of tuples
+            (regex, expansion) pairs to be replaced
+        contractions: Dict[str, str]
+            Expansions of the contractions to be replaced, indexed by lowercased contraction
+        """
+
+        self._lookup = {}
+        self._group_rep = {}
+        others = []
+        for i, (raw, rep) in enumerate(patterns):
+            literal = self._LITERAL.fullmatch(raw)
+            if literal:
+                key = literal.group(1).lower()
+                if key not in self._lookup:
+                    self._lookup[key] = rep
+            else:
+                group = f"_acr{i}"
+                self._group_rep[group] = rep
+                others.append(f"(?P<{group}>{raw})")
+
+        alternatives = []
+        if self._lookup:
+            alternatives.append(
+                r'\b(?P<_lit>' + _trie_pattern(self._lookup) + r')\b')
+        alternatives.extend(others)
+
+        self._contractions = dict(contractions or {})
+        # Contractions that contain an acronym, which has to be expanded instead when it matches in context
+        self._acr_regex = re.compile(
+            "|".join(alternatives), flags=re.IGNORECASE) if alternatives else None
+        self._guarded = frozenset(
+            key for key in self._contractions
+            if self._acr_regex is not None and self._acr_regex.search(key))
+        if self._contractions:
+            alternatives.append(
+                f"(?<![{_ASCII_WORD}])(?P<_con>" + _trie_pattern(self._contractions) + f")(?![{_ASCII_WORD}])")
+
+        self._regex = re.compile(
+            "|".join(alternatives), flags=re.IGNORECASE) if alternatives else None
+
+    def __len__(self) -> int:
+        return len(self._lookup) + len(self._group_rep)
+
+    @property
+    def n_contractions(self) -> int:
+        """
+        Number of contractions expanded by the matcher
+        """
+
+        return len(self._contractions)
+
+    def _expand(self, match: re.Match) -> str:
+        group = match.lastgroup
+        if group == '_lit':
+            return self._lookup[match.group('_lit').lower()]
+        if group == '_con':
+            word = match.group('_con')
+            if word.lower() in self._guarded:
+                acronyms = self._acronyms_within(match)
+                if acronyms is not None:
+                    return acronyms
+            return _match_case(word, self._contractions[word.lower()])
+        return self._group_rep[group]
+
+    def _acronyms_within(self, match: re.Match) -> str:
+        """
+        Expands the acronyms that match, in context, within a matched contraction, or returns None if there are none
+        """
+
+        start, end = match.span()
+        pieces, last = [], start
+        for acr_match in self._acr_regex.finditer(match.string, start):
+            if acr_match.start() >= end or acr_match.end() > end:
+                break
+            pieces.append(match.string[last:acr_match.start()])
+            pieces.append(self._expand(acr_match))
+            last = acr_match.end()
+        if not pieces:
+            return None
+        pieces.append(match.string[last:end])
+        return "".join(pieces)
+
+    def replace(self, text: str) -> str:
+        """
+        Replaces the acronyms and contractions in a text by their meaning
+
+        Parameters
+        ----------
+        text: str
+            Text in which the acronyms and contractions are going to be replaced
+
+        Returns
+        -------
+        text: str
+            Replaced text
+        """
+
+        if self._regex is None:
+            return text
+        return self._regex.sub(self._expand, text)
+
+
+def load_acronyms(acr_files: List[pathlib.Path]) -> List[Tuple[str, str]]:
+    """
+    Loads (pattern, expansion) pairs from user-supplied files. Each line of a file contains an acronym and its expansion separated by a comma, e.g.:
+
+        MRI,magnetic resonance image
+
+    Parameters
+    ----------
+    acr_files: list of pathlib.Path
+        List of paths to acronyms files
+
+    Returns
+    -------
+    acr_list: List of tuples
+        (regex, expansion) pairs, in the same format as en_acronyms_list
+    """
+
+    acr_list = []
+    for acr_file in acr_files:
+        with open(acr_file, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip() or "," not in line:
+                    continue
+                acronym, expansion = line.split(",", 1)
+                acr_list.append(
+                    (r'\b' + re.escape(acronym.strip()) + r'\b', expansion.strip()))
+
+    return acr_list
+
+
+def load_contractions(lang: str) -> Dict[str, str]:
+    """
+    Returns the contractions of a language and their expansions. For English, these are the tables of the contractions package (contractions, leftovers and slang, as used by contractions.fix); other languages have no contractions to expand.
+
+    Parameters
+    ----------
+    lang: str
+        Language of the text to be preprocessed (en/es)
+
+    Returns
+    -------
+    contractions: Dict[str, str]
+        Expansions indexed by lowercased contraction
+    """
+
+    if lang != 'en':
+        return {}
+
+    import contractions
+
+    # As in contractions.fix, later tables override earlier ones
+    table = {}
+    for contractions_dict in [contractions.contractions_dict,
+                              contractions.leftovers_dict,
+                              contractions.slang_dict]:
+        for contraction, expansion in contractions_dict.items():
+            table[contraction.lower()] = expansion
+
+    return table
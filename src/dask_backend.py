@@ -0,0 +1,98 @@
+import logging
+import time
+from typing import Iterable, Union
+
+from distributed import Client, WorkerPlugin
+
+
+class ModelsPlugin(WorkerPlugin):
+    """
+    Worker plugin that loads the spaCy and sentence-transformer models once per worker, when the worker starts (or when the plugin is registered, for workers already running). The models are kept in the per-process registries of src.pipe.load_nlp and src.embeddings_manager.load_model, which are then hit by every task run by the worker.
+    """
+
+    def __init__(self,
+                 spacy_model: str = None,
+                 spacy_exclude: Iterable[str] = ('parser', 'ner'),
+                 embeddings_model: str = None,
+                 max_seq_length: int = None):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        spacy_model: str
+            Name of the spaCy model to be loaded. If None, no spaCy model is loaded
+        spacy_exclude: Iterable[str]
+            Components of the spaCy model that are not loaded
+        embeddings_model: str
+            Name of the sentence-transformer model to be loaded. If None, no sentence-transformer is loaded
+        max_seq_length: int
+            Context of the sentence-transformer model
+        """
+
+        self._spacy_model = spacy_model
+        self._spacy_exclude = tuple(spacy_exclude)
+        self._embeddings_model = embeddings_model
+        self._max_seq_length = max_seq_length
+
+    def setup(self, worker):
+        logger = logging.getLogger('distributed.worker')
+        # Each worker only imports the libraries of the models it loads
+        if self._spacy_model is not None:
+            from src.pipe import load_nlp
+            load_nlp(self._spacy_model, self._spacy_exclude, logger)
+        if self._embeddings_model is not None:
+            from src.embeddings_manager import load_model
+            load_model(self._embeddings_model, self._max_seq_length, logger)
+
+
+def start_client(scheduler_address: str = None,
+                 n_workers: int = 0,
+                 memory_limit: Union[str, float] = "auto",
+                 plugin: ModelsPlugin = None,
+                 logger=None) -> Client:
+    """
+    Starts a dask.distributed client, which becomes the default scheduler of all the Dask computations of the pipeline (see src.utils.dask_compute_kwargs).
+
+    If no scheduler address is given, a LocalCluster is started with one single-threaded worker process per core (or n_workers), since spaCy and torch tasks hold the GIL. Each worker is limited to memory_limit, and spills data to disk, pauses or is restarted according to the distributed.worker.memory settings of the Dask configuration.
+
+    Parameters
+    ----------
+    scheduler_address: str
+        Address of a running scheduler (e.g., tcp://10.0.0.1:8786). If None, a LocalCluster is started
+    n_workers: int
+        Number of workers of the LocalCluster. If 0, one per core
+    memory_limit: Union[str, float]
+        Memory limit of each worker of the LocalCluster (e.g., "4GB"). With "auto", the system memory is split among the workers
+    plugin: ModelsPlugin
+        Plugin registered in the workers to preload the models
+    logger: Logger object
+        To log the cluster configuration
+
+    Returns
+    -------
+    client: Client
+        Client connected to the cluster. Closing it also closes the LocalCluster, if any
+    """
+
+    logger = logger or logging.getLogger('DaskBackend')
+
+    if scheduler_address:
+        client = Client(scheduler_address)
+    else:
+        # The client starts (and, when closed, stops) its own LocalCluster
+        client = Client(n_workers=n_workers or None,
+                        threads_per_worker=1,
+                        processes=True,
+                        memory_limit=memory_limit)
+
+    logger.info(
+        f"-- -- Dask distributed client connected to {client.scheduler.address} with {len(client.scheduler_info()['workers'])} workers. Dashboard: {client.dashboard_link}")
+
+    # The scheduler records the task stream (used to report the time spent in each stage) from its first request on
+    client.get_task_stream(start=time.time())
+
+    if plugin is not None:
+        client.register_plugin(plugin, name="nlpipe-models")
+
+    return client
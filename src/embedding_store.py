@@ -0,0 +1,376 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sqlite3
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+class EmbeddingStore(object):
+    """
+    Persistent store of document embeddings, so that incremental runs only encode the documents that have not been embedded before.
+
+    Embeddings are saved as float32 matrices in NumPy shards, which are read through memory maps, and indexed in a SQLite database by the hash of the exact text (transformer tokenizers, e.g., byte-level BPE ones, may be sensitive to whitespace) together with a fingerprint of the model configuration (see EmbeddingStore.fingerprint). Shards are written to a temporary file and indexed once complete, and are never modified afterwards, so several processes can read from and add to the store at the same time. Evicted entries are only removed from the index; their space is reclaimed by compact, which also merges the small shards written by each batch. As LemmaCache, the store is opened lazily, so it can be pickled and shipped to worker processes.
+    """
+
+    # Maximum number of host parameters in a SQLite statement
+    _MAX_VARS = 900
+
+    # Shards are only written by writers that index them right away, so unindexed shards older than this (in seconds) are leftovers of interrupted writers
+    _ORPHAN_AGE = 86400
+
+    def __init__(self,
+                 store_path: pathlib.Path,
+                 max_size: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 shard_size: int = 50000,
+                 logger=None):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        store_path: pathlib.Path
+            Folder with the index (index.db) and the shards of the store
+        max_size: int, optional
+            Maximum size of the embeddings in bytes. If exceeded, the least recently used entries are evicted
+        max_age: float, optional
+            Maximum age of the entries in days since their last use
+        shard_size: int
+            Maximum number of embeddings per shard written by compact
+        logger: Logger object
+            To log object activity
+        """
+
+        # Create logger object
+        if logger:
+            self._logger = logger
+        else:
+            logging.basicConfig(level='INFO')
+            self._logger = logging.getLogger('EmbeddingStore')
+
+        self._store_path = pathlib.Path(store_path)
+        self._max_size = max_size
+        self._max_age = max_age
+        self._shard_size = shard_size
+        self._conn = None
+        # Memory maps of the shards read so far, indexed by shard name
+        self._shards = {}
+        self.hits = 0
+        self.misses = 0
+
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        state['_shards'] = {}
+        return state
+
+    @staticmethod
+    def fingerprint(**config) -> str:
+        """
+        Computes a fingerprint of the configuration the embeddings depend on (e.g., model name and max_seq_length). Values must be JSON-serializable.
+
+        Returns
+        -------
+        fingerprint: str
+            Hex digest identifying the configuration
+        """
+
+        payload = json.dumps(config, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _key(fingerprint: str, text: str) -> str:
+        return hashlib.sha1(
+            (fingerprint + "\x00" + text).encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._store_path.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(
+                self._store_path.joinpath("index.db"), timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS shards ("
+                "name TEXT PRIMARY KEY, dim INTEGER NOT NULL, rows INTEGER NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, shard TEXT NOT NULL, row INTEGER NOT NULL, "
+                "accessed REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS configs ("
+                "fingerprint TEXT PRIMARY KEY, dim INTEGER NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings(accessed)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS embeddings_shard ON embeddings(shard)")
+            self._conn.commit()
+        return self._conn
+
+    def _open_shard(self, name: str) -> np.ndarray:
+        if name not in self._shards:
+            self._shards[name] = np.load(
+                self._store_path.joinpath(name), mmap_mode="r")
+        return self._shards[name]
+
+    def _write_shard(self, embeddings: np.ndarray) -> str:
+        """
+        Writes a matrix of embeddings to a new shard, through a temporary file that is renamed once complete, and returns its name
+        """
+
+        name = uuid.uuid4().hex + ".npy"
+        tmpFile = self._store_path.joinpath(name + ".tmp")
+        with tmpFile.open("wb") as fout:
+            np.save(fout, np.ascontiguousarray(embeddings, dtype=np.float32))
+        os.replace(tmpFile, self._store_path.joinpath(name))
+
+        return name
+
+    def get_many(self,
+                 texts: List[str],
+                 fingerprint: str) -> Dict[str, np.ndarray]:
+        """
+        Looks up the embeddings of a collection of texts
+
+        Parameters
+        ----------
+        texts: List[str]
+            Texts to look up
+        fingerprint: str
+            Fingerprint of the model configuration (see EmbeddingStore.fingerprint)
+
+        Returns
+        -------
+        found: Dict[str, np.ndarray]
+            Embeddings of the texts found in the store, indexed by text
+        """
+
+        conn = self._connect()
+        keys = {}
+        for text in texts:
+            keys.setdefault(self._key(fingerprint, text), text)
+        key_list = list(keys)
+
+        locations = defaultdict(list)
+        for i in range(0, len(key_list), self._MAX_VARS):
+            chunk = key_list[i:i + self._MAX_VARS]
+            placeholders = ",".join("?" * len(chunk))
+            for key, shard, row in conn.execute(
+                    f"SELECT key, shard, row FROM embeddings WHERE key IN ({placeholders})",
+                    chunk):
+                locations[shard].append((key, row))
+
+        found = {}
+        hit_keys = []
+        for shard, entries in locations.items():
+            try:
+                matrix = self._open_shard(shard)
+            except FileNotFoundError:
+                # The shard has just been compacted by another process
+                continue
+            vectors = np.asarray(matrix[[row for _, row in entries]])
+            for (key, _), vector in zip(entries, vectors):
+                found[keys[key]] = vector
+                hit_keys.append(key)
+
+        if hit_keys:
+            now = time.time()
+            conn.executemany("UPDATE embeddings SET accessed = ? WHERE key = ?",
+                             [(now, key) for key in hit_keys])
+            conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self,
+                 texts: List[str],
+                 embeddings: np.ndarray,
+                 fingerprint: str) -> None:
+        """
+        Stores the embeddings of a collection of texts in a new shard
+
+        Parameters
+        ----------
+        texts: List[str]
+            Texts whose embeddings are stored
+        embeddings: np.ndarray
+            Matrix with the embedding of each text
+        fingerprint: str
+            Fingerprint of the model configuration (see EmbeddingStore.fingerprint)
+        """
+
+        if not len(texts):
+            return
+
+        conn = self._connect()
+        name = self._write_shard(embeddings)
+        now = time.time()
+        with conn:
+            conn.execute("INSERT INTO shards (name, dim, rows) VALUES (?, ?, ?)",
+                         (name, embeddings.shape[1], len(texts)))
+            conn.execute("INSERT OR REPLACE INTO configs (fingerprint, dim) VALUES (?, ?)",
+                         (fingerprint, embeddings.shape[1]))
+            conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, shard, row, accessed) VALUES (?, ?, ?, ?)",
+                [(self._key(fingerprint, text), name, row, now)
+                 for row, text in enumerate(texts)])
+
+        return
+
+    def dimension(self, fingerprint: str) -> Optional[int]:
+        """
+        Returns the dimension of the embeddings stored for a model configuration, so that it is known without loading the model
+
+        Parameters
+        ----------
+        fingerprint: str
+            Fingerprint of the model configuration (see EmbeddingStore.fingerprint)
+
+        Returns
+        -------
+        dim: int
+            Dimension of the embeddings, or None if none has been stored for the configuration
+        """
+
+        row = self._connect().execute(
+            "SELECT dim FROM configs WHERE fingerprint = ?", (fingerprint,)).fetchone()
+
+        return row[0] if row else None
+
+    def evict(self) -> int:
+        """
+        Removes the entries older than max_age days and, afterwards, the least recently used ones until the embeddings fit in max_size bytes. Their space in the shards is reclaimed by compact
+
+        Returns
+        -------
+        n_evicted: int
+            Number of entries removed
+        """
+
+        conn = self._connect()
+        n_evicted = 0
+
+        if self._max_age is not None:
+            limit = time.time() - self._max_age * 86400
+            n_evicted += conn.execute(
+                "DELETE FROM embeddings WHERE accessed < ?", (limit,)).rowcount
+
+        if self._max_size is not None:
+            sizes = ("SELECT e.key, 4 * s.dim AS size FROM embeddings e "
+                     "JOIN shards s ON e.shard = s.name")
+            total = conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM ({sizes})").fetchone()[0]
+            if total > self._max_size:
+                to_delete = []
+                for key, size in conn.execute(sizes + " ORDER BY e.accessed"):
+                    if total <= self._max_size:
+                        break
+                    to_delete.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM embeddings WHERE key = ?", to_delete)
+                n_evicted += len(to_delete)
+
+        conn.commit()
+
+        self._logger.info(
+            f"-- -- Embeddings store: {n_evicted} entries evicted.")
+
+        return n_evicted
+
+    def compact(self) -> int:
+        """
+        Rewrites the shards in which less than half of the embeddings are still indexed (e.g., after evictions or updates), and merges the shards smaller than shard_size, so that the store does not grow with dead embeddings nor with the number of batches written. Shards are replaced atomically in the index, and removed afterwards; processes that were about to read a removed shard treat its entries as misses. Shards left unindexed by interrupted writers are removed too.
+
+        Returns
+        -------
+        n_shards: int
+            Number of shards removed
+        """
+
+        conn = self._connect()
+        shards = conn.execute(
+            "SELECT s.name, s.dim, s.rows, COUNT(e.key) FROM shards s "
+            "LEFT JOIN embeddings e ON e.shard = s.name GROUP BY s.name").fetchall()
+
+        # Shards to rewrite, grouped by dimension
+        candidates = defaultdict(list)
+        small = defaultdict(list)
+        removed = []
+        for name, dim, rows, live in shards:
+            if live == 0:
+                removed.append(name)
+            elif live < rows / 2:
+                candidates[dim].append(name)
+            elif rows < self._shard_size:
+                small[dim].append(name)
+        for dim, names in small.items():
+            if len(names) + len(candidates[dim]) > 1:
+                candidates[dim].extend(names)
+
+        for dim, names in candidates.items():
+            placeholders = ",".join("?" * len(names))
+            entries = conn.execute(
+                f"SELECT key, shard, row FROM embeddings WHERE shard IN ({placeholders}) "
+                "ORDER BY shard, row", names).fetchall()
+            for start in range(0, len(entries), self._shard_size):
+                batch = entries[start:start + self._shard_size]
+                by_shard = defaultdict(list)
+                for key, shard, row in batch:
+                    by_shard[shard].append(row)
+                embeddings = np.concatenate(
+                    [np.asarray(self._open_shard(shard)[rows]) for shard, rows in by_shard.items()])
+                name = self._write_shard(embeddings)
+                with conn:
+                    conn.execute("INSERT INTO shards (name, dim, rows) VALUES (?, ?, ?)",
+                                 (name, dim, len(batch)))
+                    # Entries re-indexed by another process in the meantime are left as they are
+                    conn.executemany(
+                        "UPDATE embeddings SET shard = ?, row = ? WHERE key = ? AND shard = ? AND row = ?",
+                        [(name, new_row, key, shard, row)
+                         for new_row, (key, shard, row) in enumerate(batch)])
+            removed.extend(names)
+
+        if removed:
+            with conn:
+                conn.executemany("DELETE FROM shards WHERE name = ?",
+                                 [(name,) for name in removed])
+        for name in removed:
+            self._shards.pop(name, None)
+            self._store_path.joinpath(name).unlink(missing_ok=True)
+
+        # Leftovers of interrupted writers
+        indexed = {name for name, in conn.execute("SELECT name FROM shards")}
+        limit = time.time() - self._ORPHAN_AGE
+        for path in list(self._store_path.glob("*.npy")) + list(self._store_path.glob("*.npy.tmp")):
+            if path.name not in indexed and path.stat().st_mtime < limit:
+                path.unlink(missing_ok=True)
+                removed.append(path.name)
+
+        self._logger.info(
+            f"-- -- Embeddings store: {len(removed)} shards compacted, {len(indexed)} shards left.")
+
+        return len(removed)
+
+    def log_stats(self) -> None:
+        """
+        Logs the hit/miss statistics gathered since the last call
+        """
+
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        self._logger.info(
+            f"-- -- Embeddings store: {self.hits} hits, {self.misses} misses (hit ratio {ratio:.2%}).")
+        self.hits = 0
+        self.misses = 0
+
+        return
@@ -1,26 +1,184 @@
+from __future__ import annotations
+
 import argparse
+import json
 import logging
+import multiprocessing
 import os
+import resource
+import shutil
+import sys
+import time
 import warnings
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from typing import List, Union
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
 
+import dask
 import dask.array as da
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dask.diagnostics import ProgressBar
-from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
+# The module can also be run as a script (python src/embeddings_manager.py), in which case the root of the repository is not in the import path (of the script nor of the processes it spawns)
+if not __package__:
+    sys.path.insert(0, Path(__file__).resolve().parents[1].as_posix())
+
+from src.embedding_store import EmbeddingStore  # noqa: E402
+from src.profiling import profile_stage  # noqa: E402
+from src.utils import dask_compute_kwargs, deduplicate  # noqa: E402
+
+# sentence-transformers (and torch) is imported when a model is loaded, so that runs and processes that do not encode any text (e.g., when every embedding is in the store, or in the Dask client process) do not load it
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# Data types in which the embeddings can be saved
+EMBEDDINGS_DTYPES = {"float32": pa.float32(),
+                     "float16": pa.float16(),
+                     "int8": pa.int8()}
+
+# Strategies to pool the embeddings of the windows of a long document
+POOLING_STRATEGIES = ("mean", "max", "weighted")
+
+# Models loaded in the current process, indexed by (model name, max_seq_length)
+_MODELS: Dict[Tuple[str, int], SentenceTransformer] = {}
+
+
+def load_model(model_name: str,
+               max_seq_length: int = None,
+               logger=None) -> SentenceTransformer:
+    """
+    Returns the SentenceTransformer for the given model name and context, loading it only the first time it is requested in the current process. This way, each worker process (e.g., under Dask's process scheduler) loads each model once and reuses it across partitions and files, instead of receiving a pickled copy with every task.
+
+    Parameters
+    ----------
+    model_name: str
+        Model (e.g. paraphrase-distilroberta-base-v1) to be loaded
+    max_seq_length: int
+        Context of the transformer model. If None, the model's default is kept
+    logger: Logger object
+        To log the load time and memory of the model
+
+    Returns
+    -------
+    model: SentenceTransformer
+        Loaded model
+    """
+
+    key = (model_name, max_seq_length)
+    if key not in _MODELS:
+        logger = logger or logging.getLogger('EmbeddingsManager')
+        start_time = time.time()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(model_name)
+        if max_seq_length is not None:
+            model.max_seq_length = max_seq_length
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        params_mb = sum(param.numel() * param.element_size()
+                        for param in model.parameters()) / 1024 ** 2
+        logger.info(
+            f"-- -- Model {model_name} (max_seq_length={max_seq_length}) loaded in process {os.getpid()} in {(time.time() - start_time):.2f}s: "
+            f"{params_mb:.1f} MB of parameters, peak RSS +{(rss_after - rss_before) / 1024:.1f} MB")
+        _MODELS[key] = model
+
+    return _MODELS[key]
+
+
+def _model_dimension(model_name: str,
+                     max_seq_length: int = None) -> int:
+    """
+    Returns the dimension of the embeddings of a model, loading it in the current process (see load_model)
+    """
+
+    return load_model(model_name, max_seq_length).get_sentence_embedding_dimension()
+
+
+def _read_model_file(model_name: str, filename: str) -> Optional[dict]:
+    """
+    Reads a JSON file of a SentenceTransformer model, from its folder if model_name is a path, or otherwise from the Hugging Face Hub (through its local cache). Returns None if it cannot be read
+    """
+
+    if Path(model_name).is_dir():
+        path = Path(model_name).joinpath(filename)
+        return json.loads(path.read_text(encoding="utf8")) if path.is_file() else None
+
+    try:
+        from huggingface_hub import hf_hub_download
+    except ImportError:
+        return None
+    # As in SentenceTransformer, names without an organization may refer to the sentence-transformers one
+    repo_ids = [model_name] if "/" in model_name else ["sentence-transformers/" + model_name, model_name]
+    for repo_id in repo_ids:
+        try:
+            with open(hf_hub_download(repo_id, filename), encoding="utf8") as fin:
+                return json.load(fin)
+        except Exception:
+            continue
+
+    return None
+
+
+def _config_dimension(model_name: str) -> Optional[int]:
+    """
+    Returns the dimension of the embeddings of a SentenceTransformer model from its configuration files, without loading it: modules.json lists its modules, and the dimension is given by the last Pooling (word embedding dimension times the number of pooling modes) or Dense (output features) one. Returns None if the files cannot be read, or if the model has other modules that may change the dimension
+    """
+
+    modules = _read_model_file(model_name, "modules.json")
+    if not modules:
+        return None
+
+    dim = None
+    for module in sorted(modules, key=lambda module: module.get("idx", 0)):
+        module_type = module.get("type", "").rsplit(".", 1)[-1]
+        if module_type in ("Transformer", "Normalize"):
+            continue
+        if module_type not in ("Pooling", "Dense"):
+            return None
+        config = _read_model_file(model_name, f"{module['path']}/config.json")
+        if config is None:
+            return None
+        if module_type == "Pooling":
+            modes = sum(1 for key, value in config.items()
+                        if key.startswith("pooling_mode_") and value is True)
+            dim = config["word_embedding_dimension"] * modes
+        else:
+            dim = config["out_features"]
+
+    return dim
+
+
+def _init_worker(model_name: str,
+                 max_seq_length: int = None,
+                 num_threads: int = None) -> None:
+    """
+    Initializer of the worker processes of add_embeddins_to_parquet: limits the number of intra-op threads of torch, so that the workers do not oversubscribe the cores, and loads the model once
+    """
+
+    logging.basicConfig(level='INFO')
+    if num_threads:
+        import torch
+        torch.set_num_threads(num_threads)
+    load_model(model_name, max_seq_length)
+
+    return
+
 
 class EmbeddingsManager(object):
     """Class to manage embeddings generation"""
 
     def __init__(self,
-                 logger=None):
+                 logger=None,
+                 embeddings_store: Path = None,
+                 embeddings_store_max_size: int = None,
+                 embeddings_store_max_age: float = None):
         """
         Initilization Method
 
@@ -28,6 +186,12 @@ class EmbeddingsManager(object):
         ----------
         logger: Logger object
             To log object activity
+        embeddings_store: Path
+            Folder of the on-disk embeddings store (see EmbeddingStore), in which the embeddings of each text are looked up before encoding it. If None, embeddings are not stored
+        embeddings_store_max_size: int
+            Maximum size of the embeddings store in bytes
+        embeddings_store_max_age: float
+            Maximum age (in days since last use) of the embeddings store entries
         """
 
         # Create logger object
@@ -37,32 +201,441 @@ class EmbeddingsManager(object):
             logging.basicConfig(level='INFO')
             self._logger = logging.getLogger('EmbeddingsManager')
 
-    def _check_max_local_length(self,
-                                max_seq_length: int,
-                                texts: List[str]) -> None:
+        self._schema = {}
+        # Last row group read by _embed_chunk, as (source, row group, table)
+        self._row_group = (None, None, None)
+
+        # Open embeddings store, evicting expired entries and reclaiming their space
+        self._store = None
+        if embeddings_store is not None:
+            self._store = EmbeddingStore(embeddings_store,
+                                         max_size=embeddings_store_max_size,
+                                         max_age=embeddings_store_max_age,
+                                         logger=self._logger)
+            self._store.evict()
+            self._store.compact()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_row_group'] = (None, None, None)
+        return state
+
+    @staticmethod
+    def _format_embeddings(embeddings: np.ndarray,
+                           col_emb: str,
+                           dtype: str = "float32") -> dict:
         """
-        Checks if the longest document in the collection is longer than the maximum sequence length allowed by the model
+        Converts a matrix of embeddings (one row per document) into the columns in which they are saved. Each embedding is kept as a NumPy vector of the given dtype, so that it is written as a FixedSizeList column in parquet. With int8, vectors are quantized symmetrically, and the scale of each one is saved in an additional column named col_emb + "_scale" (embedding ~= quantized * scale).
 
         Parameters
         ----------
-        max_seq_length: int
-            Context of the transformer model used for the embeddings generation
+        embeddings: np.ndarray
+            Matrix with the embeddings of each document
+        col_emb: str
+            Name of the embeddings column
+        dtype: str
+            Data type of the saved embeddings (float32, float16 or int8)
+
+        Returns
+        -------
+        columns: dict
+            Columns with the formatted embeddings, indexed by name
+        """
+
+        if dtype not in EMBEDDINGS_DTYPES:
+            raise ValueError(
+                f"Unsupported embeddings dtype: {dtype}. Available: {', '.join(EMBEDDINGS_DTYPES)}")
+
+        if dtype == "int8":
+            scale = np.abs(embeddings).max(axis=1) / 127 if len(
+                embeddings) else np.zeros(0)
+            scale = np.where(scale > 0, scale, 1).astype(np.float32)
+            values = np.round(embeddings / scale[:, None]).astype(np.int8)
+            return {col_emb: list(values), col_emb + "_scale": scale}
+
+        return {col_emb: list(embeddings.astype(dtype, copy=False))}
+
+    @staticmethod
+    def _embeddings_schema(col_emb: str,
+                           dim: int,
+                           dtype: str = "float32") -> dict:
+        """
+        Returns the parquet (pyarrow) types of the columns created by _format_embeddings
+        """
+
+        schema = {col_emb: pa.list_(EMBEDDINGS_DTYPES[dtype], dim)}
+        if dtype == "int8":
+            schema[col_emb + "_scale"] = pa.float32()
+        return schema
+
+    def get_embeddings_schema(self) -> dict:
+        """
+        Returns the parquet (pyarrow) types of the embeddings columns created in the last call to bert_embeddings_from_df, to be given to save_parquet
+
+        Returns
+        -------
+        schema: dict
+            pyarrow types indexed by column name
+        """
+
+        return self._schema
+
+    @staticmethod
+    def _encode(model: SentenceTransformer,
+                texts: List[str],
+                batch_size: int = 32,
+                show_progress_bar: bool = True,
+                dim: int = None,
+                lengths: List[int] = None) -> np.ndarray:
+        """
+        Encodes a list of texts in batches. Texts are sorted by decreasing length before being split into batches, so that texts of similar length are padded together, and the embeddings are scattered back to the original order.
+
+        Parameters
+        ----------
+        model: SentenceTransformer
+            Model used for generating the embeddings
         texts: list[str]
             The sentences to embed
+        batch_size: int (default=32)
+            The batch size used for the computation
+        show_progress_bar: bool (default=True)
+            Whether to show a progress bar over the batches
+        dim: int
+            Dimension of the embeddings, needed to build the (empty) result if texts is empty
+        lengths: list[int], optional
+            Number of tokens of each text, by which texts are sorted. If not given, texts are sorted by their number of characters
+
+        Returns
+        -------
+        embeddings: np.ndarray
+            Matrix with the embeddings of each text, in the same order as texts
+        """
+
+        if not texts:
+            dim = dim or model.get_sentence_embedding_dimension()
+            return np.zeros((0, dim), dtype=np.float32)
+
+        if lengths is None:
+            lengths = [len(text) for text in texts]
+        order = np.argsort(-np.asarray(lengths), kind="stable")
+        sorted_embeddings = model.encode([texts[i] for i in order],
+                                         batch_size=batch_size,
+                                         show_progress_bar=show_progress_bar,
+                                         convert_to_numpy=True)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+
+        return embeddings
+
+    @staticmethod
+    def _token_lengths(model: SentenceTransformer,
+                       texts: List[str],
+                       max_length: int) -> List[int]:
+        """
+        Returns the number of tokens of each text, without special tokens, counting up to max_length tokens
+        """
+
+        return [len(ids) for ids in model.tokenizer(texts,
+                                                    add_special_tokens=False,
+                                                    truncation=True,
+                                                    max_length=max_length,
+                                                    return_attention_mask=False,
+                                                    return_token_type_ids=False,
+                                                    verbose=False)["input_ids"]]
+
+    @staticmethod
+    def _token_spans(model: SentenceTransformer,
+                     texts: List[str]) -> List[List[Tuple[int, int]]]:
+        """
+        Tokenizes a list of texts with the model's (fast) tokenizer, without special tokens nor truncation, and returns the character span of each token of each text
         """
 
-        max_local_length = np.max([len(t.split()) for t in texts])
-        if max_local_length > max_seq_length:
-            warnings.simplefilter('always', DeprecationWarning)
-            warnings.warn(f"the longest document in your collection has {max_local_length} words, the model instead "
-                          f"truncates to {max_seq_length} tokens.")
+        return model.tokenizer(texts,
+                               add_special_tokens=False,
+                               return_offsets_mapping=True,
+                               return_attention_mask=False,
+                               return_token_type_ids=False,
+                               verbose=False)["offset_mapping"]
+
+    @staticmethod
+    def _max_tokens(model: SentenceTransformer) -> int:
+        """
+        Returns the number of tokens of a text that fit in the model's context, i.e., its max_seq_length minus the special tokens added by the tokenizer
+        """
+
+        max_seq_length = model.max_seq_length or model.tokenizer.model_max_length
+        return max_seq_length - model.tokenizer.num_special_tokens_to_add(pair=False)
+
+    @staticmethod
+    def _windows(num_tokens: int,
+                 window_size: int,
+                 overlap: int = 0) -> List[Tuple[int, int]]:
+        """
+        Splits a sequence of num_tokens tokens into [start, end) windows of at most window_size tokens, each of which starts overlap tokens before the end of the previous one
+        """
+
+        bounds = [(0, min(window_size, num_tokens))]
+        while bounds[-1][1] < num_tokens:
+            start = bounds[-1][1] - overlap
+            bounds.append((start, min(start + window_size, num_tokens)))
+
+        return bounds
+
+    @staticmethod
+    def _pool(embeddings: np.ndarray,
+              doc_starts: np.ndarray,
+              lengths: np.ndarray,
+              pooling: str) -> np.ndarray:
+        """
+        Pools the embeddings of the windows of each document, given the index of the first window of each document and the number of tokens of each window
+        """
+
+        if pooling == "max":
+            return np.maximum.reduceat(embeddings, doc_starts, axis=0)
+
+        if pooling == "weighted":
+            weights = np.maximum(lengths, 1).astype(embeddings.dtype)
+        else:
+            weights = np.ones(len(embeddings), dtype=embeddings.dtype)
+        sums = np.add.reduceat(embeddings * weights[:, None], doc_starts, axis=0)
+
+        return sums / np.add.reduceat(weights, doc_starts)[:, None]
+
+    def _check_max_local_length(self,
+                                max_tokens: int,
+                                lengths: List[int],
+                                pooling: str = None) -> None:
+        """
+        Reports the documents of the collection that are longer than the context of the model, which are truncated or, if a pooling strategy is used, split into windows
+
+        Parameters
+        ----------
+        max_tokens: int
+            Number of tokens that fit in the context of the model (see _max_tokens)
+        lengths: list[int]
+            Number of tokens of each document
+        pooling: str
+            Pooling strategy of the windows of long documents, or None if they are truncated
+        """
+
+        lengths = np.asarray(lengths)
+        num_long = int((lengths > max_tokens).sum())
+        if num_long:
+            if pooling is None:
+                # Lengths are only counted up to one token beyond the context (see _encode_pooled)
+                warnings.warn(
+                    f"{num_long} of {len(lengths)} documents exceed the context of the model ({max_tokens} tokens) and are truncated. Use a pooling strategy to embed them whole.")
+            else:
+                self._logger.info(
+                    f"-- -- {num_long} of {len(lengths)} documents (mean length: {lengths.mean():.1f} tokens, the longest: {lengths.max()} tokens) exceed the context of the model ({max_tokens} tokens) and are split into windows with {pooling} pooling")
         return
 
+    def _encode_pooled(self,
+                       model: SentenceTransformer,
+                       texts: List[str],
+                       batch_size: int = 32,
+                       show_progress_bar: bool = True,
+                       dim: int = None,
+                       pooling: str = None,
+                       window_overlap: int = 0) -> np.ndarray:
+        """
+        Encodes a list of texts with the given model. Texts are tokenized once with the model's tokenizer, and their token lengths are used both to report those that exceed the model's context and to sort them into batches (see _encode).
+
+        If pooling is None, texts longer than the context are truncated by the model, so they are only tokenized up to one token beyond it. Otherwise, they are tokenized whole and split into windows that fill the context and overlap by window_overlap tokens; the windows of all the texts are encoded together, and the embedding of each text is obtained by pooling those of its windows: their mean ("mean"), their element-wise maximum ("max"), or their mean weighted by the number of tokens of each window ("weighted"), so that a short trailing window weighs less. Texts that fit in the context are embedded as they are with any strategy. Windows are cut at the character offsets of their tokens or, with slow tokenizers, which do not return them, rebuilt from their tokens.
+
+        Parameters
+        ----------
+        model: SentenceTransformer
+            Model used for generating the embeddings
+        texts: list[str]
+            The sentences to embed
+        batch_size: int (default=32)
+            The batch size used for the computation
+        show_progress_bar: bool (default=True)
+            Whether to show a progress bar over the batches
+        dim: int
+            Dimension of the embeddings
+        pooling: str, optional
+            Pooling strategy of the windows of long texts (mean, max or weighted). If None, long texts are truncated
+        window_overlap: int (default=0)
+            Number of tokens shared by consecutive windows
+
+        Returns
+        -------
+        embeddings: np.ndarray
+            Matrix with the embeddings of each text, in the same order as texts
+        """
+
+        with profile_stage("embeddings") as profiler:
+            max_tokens = self._max_tokens(model)
+            profiler.docs = len(texts)
+
+            if pooling is None:
+                lengths = self._token_lengths(model, texts, max_tokens + 1)
+                self._check_max_local_length(max_tokens, lengths, pooling)
+                profiler.tokens = sum(min(length, max_tokens) for length in lengths)
+                return self._encode(model, texts, batch_size=batch_size,
+                                    show_progress_bar=show_progress_bar, dim=dim,
+                                    lengths=lengths)
+
+            if not 0 <= window_overlap < max_tokens:
+                raise ValueError(
+                    f"The window overlap must be between 0 and {max_tokens - 1} tokens, but {window_overlap} was given")
+
+            if model.tokenizer.is_fast:
+                spans = self._token_spans(model, texts)
+                doc_lengths = [len(text_spans) for text_spans in spans]
+
+                def window_text(i, start, end):
+                    return texts[i][spans[i][start][0]:spans[i][end - 1][1]]
+            else:
+                tokens = [model.tokenizer.tokenize(text) for text in texts]
+                doc_lengths = [len(text_tokens) for text_tokens in tokens]
+
+                def window_text(i, start, end):
+                    return model.tokenizer.convert_tokens_to_string(tokens[i][start:end])
+
+            self._check_max_local_length(max_tokens, doc_lengths, pooling)
+            profiler.tokens = sum(doc_lengths)
+
+            windows, lengths, doc_starts = [], [], []
+            for i, (text, length) in enumerate(zip(texts, doc_lengths)):
+                doc_starts.append(len(windows))
+                if length <= max_tokens:
+                    windows.append(text)
+                    lengths.append(length)
+                    continue
+                for start, end in self._windows(length, max_tokens, window_overlap):
+                    windows.append(window_text(i, start, end))
+                    lengths.append(end - start)
+
+            embeddings = self._encode(model, windows, batch_size=batch_size,
+                                      show_progress_bar=show_progress_bar, dim=dim,
+                                      lengths=lengths)
+
+            return self._pool(embeddings, np.array(doc_starts), np.array(lengths), pooling)
+
+    @staticmethod
+    def _fingerprint(model_name: str,
+                     max_seq_length: int = None,
+                     pooling: str = None,
+                     window_overlap: int = 0) -> str:
+        """
+        Returns the fingerprint of the configuration the embeddings depend on, under which they are kept in the embeddings store
+        """
+
+        return EmbeddingStore.fingerprint(model=model_name,
+                                          max_seq_length=max_seq_length,
+                                          pooling=pooling,
+                                          window_overlap=window_overlap if pooling else None)
+
+    def _embeddings_dimension(self,
+                              model_name: str,
+                              max_seq_length: int = None,
+                              pooling: str = None,
+                              window_overlap: int = 0,
+                              use_dask: bool = False) -> int:
+        """
+        Returns the dimension of the embeddings of a model configuration. It is read from the embeddings store if it holds any of them or, otherwise, from the configuration files of the model (see _config_dimension), so that the model is not loaded just to know it. Only if both fail is the model loaded: with Dask, in a worker process (an extra load, but it keeps torch out of the client process)
+        """
+
+        if self._store is not None:
+            dim = self._store.dimension(self._fingerprint(
+                model_name, max_seq_length, pooling, window_overlap))
+            if dim is not None:
+                return dim
+
+        dim = _config_dimension(model_name)
+        if dim is not None:
+            return dim
+
+        self._logger.info(
+            f"-- -- Dimension of the embeddings of {model_name} not found in its configuration; loading the model")
+        if use_dask:
+            return dask.delayed(_model_dimension)(model_name, max_seq_length).compute(
+                **dask_compute_kwargs())
+
+        return load_model(model_name, max_seq_length,
+                          self._logger).get_sentence_embedding_dimension()
+
+    def _embed_texts(self,
+                     texts: List[str],
+                     model_name: str,
+                     max_seq_length: int = None,
+                     batch_size: int = 32,
+                     show_progress_bar: bool = True,
+                     dim: int = None,
+                     pooling: str = None,
+                     window_overlap: int = 0) -> np.ndarray:
+        """
+        Computes the embeddings of a list of texts. Duplicate texts are encoded once, and their embedding is broadcast back to all the duplicates. If the manager has an embeddings store, distinct texts are looked up in it first, and only the missing ones are encoded (with _encode_pooled) and added to it; the model is not even loaded if all of them are found.
+
+        Parameters
+        ----------
+        texts: list[str]
+            The sentences to embed
+        model_name: str
+            Model used for generating the embeddings (see load_model)
+        max_seq_length: int
+            Context of the transformer model
+        batch_size: int (default=32)
+            The batch size used for the computation
+        show_progress_bar: bool (default=True)
+            Whether to show a progress bar over the batches
+        dim: int, optional
+            Dimension of the embeddings. It is only needed if texts is empty; if not given, it is then taken from the store or the model (see _embeddings_dimension)
+        pooling: str, optional
+            Pooling strategy of the windows of long texts (mean, max or weighted, see _encode_pooled). If None, long texts are truncated
+        window_overlap: int (default=0)
+            Number of tokens shared by consecutive windows
+
+        Returns
+        -------
+        embeddings: np.ndarray
+            Matrix with the embeddings of each text, in the same order as texts
+        """
+
+        if pooling is not None and pooling not in POOLING_STRATEGIES:
+            raise ValueError(
+                f"Unsupported pooling strategy: {pooling}. Available: {', '.join(POOLING_STRATEGIES)}")
+
+        if not texts:
+            dim = dim or self._embeddings_dimension(model_name, max_seq_length,
+                                                    pooling, window_overlap)
+            return np.zeros((0, dim), dtype=np.float32)
+
+        texts, inverse = deduplicate(texts, logger=self._logger)
+        encode_kwargs = dict(batch_size=batch_size,
+                             show_progress_bar=show_progress_bar,
+                             dim=dim,
+                             pooling=pooling,
+                             window_overlap=window_overlap)
+
+        if self._store is None:
+            model = load_model(model_name, max_seq_length, self._logger)
+            embeddings = self._encode_pooled(model, texts, **encode_kwargs)
+            return embeddings[inverse]
+
+        fingerprint = self._fingerprint(model_name, max_seq_length, pooling, window_overlap)
+        found = self._store.get_many(texts, fingerprint)
+        self._store.log_stats()
+        missing = [text for text in texts if text not in found]
+        if missing:
+            model = load_model(model_name, max_seq_length, self._logger)
+            computed = self._encode_pooled(model, missing, **encode_kwargs)
+            self._store.put_many(missing, computed, fingerprint)
+            found.update(zip(missing, computed))
+        embeddings = np.stack([found[text] for text in texts])
+
+        return embeddings[inverse]
+
     def bert_embeddings_from_list(self,
                                   texts: List[str],
                                   sbert_model_to_load: str,
                                   batch_size=32,
-                                  max_seq_length=None) -> np.ndarray:
+                                  max_seq_length=None,
+                                  pooling: str = None,
+                                  window_overlap: int = 0) -> np.ndarray:
         """
         Creates SBERT Embeddings from a list
 
@@ -76,6 +649,10 @@ class EmbeddingsManager(object):
             The batch size used for the computation
         max_seq_length: int
             Context of the transformer model used for the embeddings generation
+        pooling: str, optional
+            Pooling strategy of the windows of the documents longer than the context (mean, max or weighted, see _embed_texts). If None, they are truncated
+        window_overlap: int (default=0)
+            Number of tokens shared by consecutive windows
 
         Returns
         -------
@@ -83,14 +660,10 @@ class EmbeddingsManager(object):
             List with the embeddings for each document
         """
 
-        model = SentenceTransformer(sbert_model_to_load)
-
-        if max_seq_length is not None:
-            model.max_seq_length = max_seq_length
-
-        self._check_max_local_length(max_seq_length, texts)
-        embeddings = model.encode(
-            texts, show_progress_bar=True, batch_size=batch_size).tolist()
+        embeddings = self._embed_texts(
+            texts, sbert_model_to_load, max_seq_length, batch_size=batch_size,
+            show_progress_bar=True, pooling=pooling,
+            window_overlap=window_overlap).tolist()
 
         return embeddings
     
@@ -100,7 +673,10 @@ class EmbeddingsManager(object):
                                 sbert_model_to_load: str,
                                 batch_size:int = 32,
                                 max_seq_length=None,
-                                use_dask=False) -> Union[dd.DataFrame, pd.DataFrame]:
+                                use_dask=False,
+                                dtype: str = "float32",
+                                pooling: str = None,
+                                window_overlap: int = 0) -> Union[dd.DataFrame, pd.DataFrame]:
         """
         Creates SBERT Embeddings for each row in a dask dataframe and saves the embeddings in a new column
 
@@ -116,45 +692,302 @@ class EmbeddingsManager(object):
             The batch size used for the computation
         max_seq_length : int
             Context of the transformer model used for the embeddings generation
+        use_dask : bool
+            Whether df is a Dask DataFrame
+        dtype : str (default="float32")
+            Data type in which the embeddings are saved (float32, float16 or int8, see _format_embeddings)
+        pooling : str, optional
+            Pooling strategy of the windows of the documents longer than the context (mean, max or weighted, see _embed_texts). If None, they are truncated
+        window_overlap : int (default=0)
+            Number of tokens shared by consecutive windows
 
         Returns
         -------
         df: Union[dd.DataFrame, pd.DataFrame]
-            The dataframe with the original data and the generated embeddings
+            The dataframe with the original data and the generated embeddings. The parquet types of the embeddings columns are given by get_embeddings_schema
         """
-        
-        model = SentenceTransformer(sbert_model_to_load)
 
-        if max_seq_length is not None:
-            model.max_seq_length = max_seq_length
+        # The dimension of the embeddings is needed beforehand to build the Dask graph; with pandas, it is taken from the computed embeddings, so that the model is not loaded if they are all in the store
+        dim = None
+        if use_dask:
+            dim = self._embeddings_dimension(sbert_model_to_load, max_seq_length,
+                                             pooling, window_overlap, use_dask=True)
 
-        def encode_text(text):
-            embedding = model.encode(text,
-                                     show_progress_bar=True, batch_size=batch_size)
-            # Convert to string
-            embedding = ' '.join(str(x) for x in embedding)
-            return embedding
-        
+        self._schema = {}
         for col in text_columns:
-            self._check_max_local_length(max_seq_length, df[col])
-            
             col_emb = col.split("_")[0]+"_embeddings" if len(text_columns) > 1 else "embeddings"
 
+            # Only the model name travels with the tasks; each worker process loads the model once
+            encode_kwargs = dict(model_name=sbert_model_to_load,
+                                 max_seq_length=max_seq_length,
+                                 col_emb=col_emb,
+                                 dim=dim,
+                                 batch_size=batch_size,
+                                 dtype=dtype,
+                                 show_progress_bar=not use_dask,
+                                 pooling=pooling,
+                                 window_overlap=window_overlap)
             if use_dask:
-                df[col_emb] = df[col].apply(
-                    encode_text, meta=('x', 'str'))
+                meta = self._encode_partition(
+                    pd.Series([], dtype=object), **encode_kwargs)
+                embeddings = df[col].map_partitions(
+                    self._encode_partition, **encode_kwargs, meta=meta)
             else:
-                df[col_emb] = df[col].apply(encode_text)
+                embeddings = self._encode_partition(df[col], **encode_kwargs)
+                if dim is None:
+                    dim = len(embeddings[col_emb].iloc[0]) if len(embeddings) else \
+                        self._embeddings_dimension(sbert_model_to_load, max_seq_length,
+                                                   pooling, window_overlap)
+            for col_out in embeddings.columns:
+                df[col_out] = embeddings[col_out]
+
+            self._schema.update(self._embeddings_schema(col_emb, dim, dtype))
         
         return df
 
+    def _encode_partition(self,
+                          texts: pd.Series,
+                          model_name: str,
+                          max_seq_length: int,
+                          col_emb: str,
+                          dim: int,
+                          batch_size: int = 32,
+                          dtype: str = "float32",
+                          show_progress_bar: bool = True,
+                          pooling: str = None,
+                          window_overlap: int = 0) -> pd.DataFrame:
+        """
+        Encodes a text column (or a Dask partition of it) in a single batched call, with the model of the current process (see load_model), and returns the formatted embeddings columns
+        """
+
+        embeddings = self._embed_texts(texts.tolist(), model_name, max_seq_length,
+                                       batch_size=batch_size,
+                                       show_progress_bar=show_progress_bar,
+                                       dim=dim,
+                                       pooling=pooling,
+                                       window_overlap=window_overlap)
+
+        return pd.DataFrame(self._format_embeddings(embeddings, col_emb, dtype),
+                            index=texts.index)
+
+    # Version of the layout of the manifest of add_embeddins_to_parquet
+    _MANIFEST_VERSION = 1
+
+    @staticmethod
+    def _atomic_write_table(table: pa.Table, outFile: Path) -> None:
+        """
+        Writes a pyarrow Table in parquet format through a temporary file that is renamed once complete, so that outFile either does not exist or is complete
+        """
+
+        tmpFile = outFile.with_name(outFile.name + ".tmp")
+        pq.write_table(table, tmpFile)
+        os.replace(tmpFile, outFile)
+
+        return
+
+    @staticmethod
+    def _atomic_write_json(data: dict, outFile: Path) -> None:
+        """
+        Writes a JSON file through a temporary file that is renamed once complete
+        """
+
+        tmpFile = outFile.with_name(outFile.name + ".tmp")
+        with tmpFile.open("w", encoding="utf8") as fout:
+            json.dump(data, fout, indent=2)
+        os.replace(tmpFile, outFile)
+
+        return
+
+    @staticmethod
+    def _plan_chunks(parquet_file: Path, chunk_size: int) -> List[List[int]]:
+        """
+        Splits the rows of a parquet file into [start, end) ranges of at most chunk_size rows. Ranges never span two row groups, so that each chunk is read by decoding a single row group.
+        """
+
+        metadata = pq.ParquetFile(parquet_file).metadata
+        chunks = []
+        rg_start = 0
+        for rg in range(metadata.num_row_groups):
+            rg_end = rg_start + metadata.row_group(rg).num_rows
+            for start in range(rg_start, rg_end, chunk_size):
+                chunks.append([start, min(start + chunk_size, rg_end)])
+            rg_start = rg_end
+
+        return chunks
+
+    def _build_manifest(self,
+                        sources: List[Path],
+                        config: dict,
+                        chunk_size: int) -> dict:
+        """
+        Builds the manifest of an embeddings job: the configuration, and the input files with their row ranges and output part
+        """
+
+        files = []
+        for i, source in enumerate(sources):
+            stat = source.stat()
+            files.append({
+                "source": source.resolve().as_posix(),
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "num_rows": pq.ParquetFile(source).metadata.num_rows,
+                "output": "parquet_embeddings_part_" + str(i) + ".parquet",
+                "chunks": self._plan_chunks(source, chunk_size)})
+
+        return {"version": self._MANIFEST_VERSION,
+                "config": config,
+                "files": files}
+
+    def _check_manifest(self, manifest: dict, config: dict) -> None:
+        """
+        Checks that a job can be resumed from a manifest, i.e., that neither its configuration nor its input files have changed
+        """
+
+        if manifest.get("version") != self._MANIFEST_VERSION or manifest.get("config") != config:
+            raise ValueError(
+                f"Cannot resume: the job was started with {manifest.get('config')}, but {config} was requested")
+        for entry in manifest["files"]:
+            source = Path(entry["source"])
+            if not source.is_file():
+                raise ValueError(f"Cannot resume: {source} no longer exists")
+            stat = source.stat()
+            if stat.st_size != entry["size"] or stat.st_mtime != entry["mtime"]:
+                raise ValueError(
+                    f"Cannot resume: {source} has changed since the job was started")
+
+        return
+
+    def _embed_table(self,
+                     table: pa.Table,
+                     embeddins_model: str,
+                     max_seq_length: int,
+                     batch_size: int,
+                     dtype: str,
+                     pooling: str = None,
+                     window_overlap: int = 0) -> pa.Table:
+        """
+        Returns a copy of table with the embeddings of its 'raw_text' column as FixedSizeList columns
+        """
+
+        texts = table.column('raw_text').to_pylist()
+        embeddings = self._embed_texts(texts, embeddins_model, max_seq_length,
+                                       batch_size=batch_size,
+                                       show_progress_bar=False,
+                                       pooling=pooling,
+                                       window_overlap=window_overlap)
+
+        types = self._embeddings_schema('embeddings', embeddings.shape[1], dtype)
+        for col, values in self._format_embeddings(embeddings, 'embeddings', dtype).items():
+            field = pa.field(col, types[col])
+            column = pa.array(values, type=types[col])
+            idx = table.schema.get_field_index(col)
+            table = table.set_column(idx, field, column) if idx >= 0 \
+                else table.append_column(field, column)
+
+        return table
+
+    @staticmethod
+    def _row_group_starts(source: str) -> np.ndarray:
+        """
+        Returns the index of the first row of each row group of a parquet file, followed by its number of rows
+        """
+
+        metadata = pq.ParquetFile(source).metadata
+        return np.cumsum([0] + [metadata.row_group(rg).num_rows
+                                for rg in range(metadata.num_row_groups)])
+
+    def _group_chunks(self,
+                      tasks: List[tuple],
+                      n_workers: int) -> List[List[tuple]]:
+        """
+        Groups the pending chunks (see add_embeddins_to_parquet) by row group, so that each row group is decoded by a single worker, as in the serial path. Only if there are fewer row groups than workers, the largest groups are split, so that every worker has work
+        """
+
+        rg_starts = {}
+        groups = defaultdict(list)
+        for task in tasks:
+            source, start = task[2], task[3]
+            if source not in rg_starts:
+                rg_starts[source] = self._row_group_starts(source)
+            rg = int(np.searchsorted(rg_starts[source], start, side="right")) - 1
+            groups[(task[0], rg)].append(task)
+        groups = list(groups.values())
+
+        while len(groups) < n_workers:
+            largest = max(groups, key=len)
+            if len(largest) < 2:
+                break
+            groups.remove(largest)
+            half = len(largest) // 2
+            groups += [largest[:half], largest[half:]]
+
+        return groups
+
+    def _embed_chunks(self,
+                      chunks: List[tuple],
+                      *chunk_args) -> List[int]:
+        """
+        Runs _embed_chunk on a list of (source, start, end, chunk_file) chunks, so that the chunks of a row group share its decoded table when they are run by a worker process
+
+        Returns
+        -------
+        num_rows: List[int]
+            Number of rows of each chunk
+        """
+
+        num_rows = [self._embed_chunk(*chunk, *chunk_args) for chunk in chunks]
+        self._row_group = (None, None, None)
+
+        return num_rows
+
+    def _embed_chunk(self,
+                     source: str,
+                     start: int,
+                     end: int,
+                     chunk_file: Path,
+                     embeddins_model: str,
+                     max_seq_length: int,
+                     batch_size: int,
+                     dtype: str,
+                     pooling: str = None,
+                     window_overlap: int = 0) -> int:
+        """
+        Computes the embeddings of the rows [start, end) of a parquet file, and checkpoints them in chunk_file. Chunks do not span row groups, and the last row group read is kept, so consecutive chunks of the same row group decode it once.
+
+        Returns
+        -------
+        num_rows: int
+            Number of rows of the chunk
+        """
+
+        rg_starts = self._row_group_starts(source)
+        rg = int(np.searchsorted(rg_starts, start, side="right")) - 1
+        if self._row_group[:2] != (source, rg):
+            self._row_group = (source, rg, pq.ParquetFile(source).read_row_group(rg))
+        table = self._row_group[2].slice(start - rg_starts[rg], end - start)
+        table = self._embed_table(table, embeddins_model, max_seq_length,
+                                  batch_size, dtype, pooling, window_overlap)
+        self._atomic_write_table(table, chunk_file)
+
+        return table.num_rows
+
     def add_embeddins_to_parquet(self,
                                  parquet_file: Path,
                                  parquet_new: Path,
                                  embeddins_model: str,
-                                 max_seq_length: int) -> Path:
+                                 max_seq_length: int,
+                                 dtype: str = "float32",
+                                 chunk_size: int = 10000,
+                                 batch_size: int = 32,
+                                 resume: bool = False,
+                                 n_workers: int = 1,
+                                 threads_per_worker: int = None,
+                                 pooling: str = None,
+                                 window_overlap: int = 0) -> Path:
         """Generates the embeddings for a set of files given in parquet format, and saves them in a new parquet file that containing the original data plus an additional column named 'embeddings'.
 
+        The job is described by a manifest (parquet_new/_manifest.json) listing the input files, their row ranges (chunks) and the output part of each of them. The embeddings of each chunk are checkpointed in parquet_new/_checkpoints as soon as they are computed, and the output parts are assembled from the checkpoints once all the chunks of a file are done. All files are written atomically, so with resume=True an interrupted job only recomputes the chunks that were being processed when it stopped. Chunks, rather than whole files, can be distributed among n_workers processes, so that the work is balanced even if the files differ in size; the chunks of each row group are run by the same worker, so that it is decoded once (see _group_chunks).
+
         Parameters
         ----------
         parquet_file : Path
@@ -165,6 +998,22 @@ class EmbeddingsManager(object):
             Model to be used for generating the embeddings
         max_seq_length: int
             Context of the transformer model used for the embeddings generation
+        dtype: str (default="float32")
+            Data type in which the embeddings are saved (float32, float16 or int8)
+        chunk_size: int (default=10000)
+            Maximum number of rows per checkpoint
+        batch_size: int (default=32)
+            The batch size used for the computation
+        resume: bool (default=False)
+            Whether to resume the job previously started in parquet_new. The model, max_seq_length, dtype, chunk_size, pooling, window_overlap and input files must be the same. If False, any previous job in parquet_new is discarded
+        n_workers: int (default=1)
+            Number of worker processes among which the chunks are distributed. Each worker loads the model once
+        threads_per_worker: int, optional
+            Number of intra-op threads of torch in each worker. By default, the cores are split evenly among the workers
+        pooling: str, optional
+            Pooling strategy of the windows of the documents longer than the context (mean, max or weighted, see _embed_texts). If None, they are truncated
+        window_overlap: int (default=0)
+            Number of tokens shared by consecutive windows
 
         Returns
         -------
@@ -173,44 +1022,123 @@ class EmbeddingsManager(object):
         """
 
         path_parquet = Path(parquet_file)
+        parquet_new = Path(parquet_new)
+        parquet_new.mkdir(parents=True, exist_ok=True)
+        manifest_file = parquet_new.joinpath("_manifest.json")
+        checkpoints = parquet_new.joinpath("_checkpoints")
+
+        config = {"embeddings_model": embeddins_model,
+                  "max_seq_length": max_seq_length,
+                  "dtype": dtype,
+                  "chunk_size": chunk_size,
+                  "pooling": pooling,
+                  "window_overlap": window_overlap}
 
-        res = []
-        if path_parquet.is_file():
-            res.append(path_parquet)
-        elif path_parquet.is_dir():
-            for entry in path_parquet.iterdir():
-                # check if it is a file
-                if entry.as_posix().endswith("parquet"):
-                    res.append(entry)
-
-        process_entries = []
-        for entry in parquet_new.iterdir():
-            # check if it is a file
-            if entry.as_posix().endswith("parquet"):
-                s = entry.as_posix().split("/")[7].split("_")[3].split(".")[0]
-                process_entries.append(int(s))
+        if resume and manifest_file.is_file():
+            with manifest_file.open("r", encoding="utf8") as fin:
+                manifest = json.load(fin)
+            self._check_manifest(manifest, config)
+            self._logger.info(
+                f"-- -- Resuming the embeddings job described in {manifest_file.as_posix()}")
+        else:
+            res = []
+            if path_parquet.is_file():
+                res.append(path_parquet)
+            elif path_parquet.is_dir():
+                res = sorted(entry for entry in path_parquet.iterdir()
+                             if entry.as_posix().endswith("parquet"))
+            shutil.rmtree(checkpoints, ignore_errors=True)
+            manifest = self._build_manifest(res, config, chunk_size)
+            self._atomic_write_json(manifest, manifest_file)
 
         self._logger.info(
-            f"-- -- Number of parquet to process: {str(len(res))}")
+            f"-- -- Number of parquet to process: {str(len(manifest['files']))}")
 
-        for i, f in enumerate(tqdm(res)):
-            if i not in process_entries:
-                self._logger.info(f"-- -- Processing now: {str(i)}")
-                df = pd.read_parquet(f)  # .fillna("")
+        # Pending chunks, and number of them left in each part
+        tasks = []
+        remaining = {}
+        for i, entry in enumerate(manifest["files"]):
+            outFile = parquet_new.joinpath(entry["output"])
+            part_dir = checkpoints.joinpath(f"part_{i}")
+            if resume and outFile.is_file():
+                shutil.rmtree(part_dir, ignore_errors=True)
+                continue
+            part_dir.mkdir(parents=True, exist_ok=True)
+            remaining[i] = 0
+            for j, (start, end) in enumerate(entry["chunks"]):
+                chunk_file = part_dir.joinpath(f"chunk_{j:06d}.parquet")
+                if not chunk_file.is_file():
+                    tasks.append((i, j, entry["source"], start, end, chunk_file))
+                    remaining[i] += 1
 
-                raw = df['raw_text'].values.tolist()
-                embeddings = self.bert_embeddings_from_list(
-                    texts=raw,
-                    sbert_model_to_load=embeddins_model,
-                    max_seq_length=max_seq_length)
-                df['embeddings'] = embeddings
+        self._logger.info(
+            f"-- -- {len(tasks)} chunks to process in {len(remaining)} parts with {n_workers} worker(s)...")
 
-                # Save new df in parquet file
-                new_name = "parquet_embeddings_part_" + str(i) + ".parquet"
-                outFile = parquet_new.joinpath(new_name)
-                df.to_parquet(outFile)
+        chunk_args = (embeddins_model, max_seq_length, batch_size, dtype,
+                      pooling, window_overlap)
 
-        return
+        def assemble(i):
+            # Assemble the part from its checkpoints
+            entry = manifest["files"][i]
+            part_dir = checkpoints.joinpath(f"part_{i}")
+            chunk_files = [part_dir.joinpath(f"chunk_{j:06d}.parquet")
+                           for j in range(len(entry["chunks"]))]
+            if chunk_files:
+                table = pa.concat_tables(
+                    [pq.read_table(chunk_file) for chunk_file in chunk_files])
+            else:
+                table = self._embed_table(pq.read_schema(entry["source"]).empty_table(),
+                                          *chunk_args)
+            if table.num_rows != entry["num_rows"]:
+                raise RuntimeError(
+                    f"Part {i} has {table.num_rows} rows, but {entry['num_rows']} were expected")
+            self._atomic_write_table(table, parquet_new.joinpath(entry["output"]))
+            shutil.rmtree(part_dir, ignore_errors=True)
+            self._logger.info(f"-- -- Part {i} saved")
+
+        for i in [i for i, left in remaining.items() if left == 0]:
+            assemble(i)
+
+        start_time = time.time()
+        num_docs = 0
+        with tqdm(total=len(tasks)) as pbar:
+            if n_workers > 1 and len(tasks) > 1:
+                if threads_per_worker is None:
+                    threads_per_worker = max(1, (os.cpu_count() or 1) // n_workers)
+                # Workers are spawned rather than forked, as forking a process in which torch is already running is not safe
+                with ProcessPoolExecutor(max_workers=n_workers,
+                                         mp_context=multiprocessing.get_context("spawn"),
+                                         initializer=_init_worker,
+                                         initargs=(embeddins_model, max_seq_length, threads_per_worker)) as executor:
+                    futures = {executor.submit(self._embed_chunks,
+                                               [task[2:] for task in group], *chunk_args): group
+                               for group in self._group_chunks(tasks, n_workers)}
+                    for future in as_completed(futures):
+                        for (i, *_), num_rows in zip(futures[future], future.result()):
+                            num_docs += num_rows
+                            pbar.update(1)
+                            remaining[i] -= 1
+                            if remaining[i] == 0:
+                                assemble(i)
+            else:
+                if threads_per_worker:
+                    import torch
+                    torch.set_num_threads(threads_per_worker)
+                for i, j, *task in tasks:
+                    num_docs += self._embed_chunk(*task, *chunk_args)
+                    pbar.update(1)
+                    remaining[i] -= 1
+                    if remaining[i] == 0:
+                        assemble(i)
+                self._row_group = (None, None, None)
+
+        elapsed = time.time() - start_time
+        self._logger.info(
+            f"-- -- Embeddings of {num_docs} documents computed in {elapsed:.2f}s ({num_docs / elapsed if elapsed else 0:.1f} docs/sec)")
+
+        shutil.rmtree(checkpoints, ignore_errors=True)
+
+        return parquet_new
 
     def generate_embeddings(self,
                             corpus_df: dd.DataFrame,
@@ -290,6 +1218,30 @@ if __name__ == "__main__":
                         help="Model to be used for calculating the embeddings")
     parser.add_argument("--max_sequence_length", type=int, default=384,
                         required=False, metavar=("max_sequence_length"), help="Model's context")
+    parser.add_argument("--embeddings_dtype", type=str, default="float32",
+                        required=False, choices=list(EMBEDDINGS_DTYPES),
+                        help="Data type in which the embeddings are saved")
+    parser.add_argument("--chunk_size", type=int, default=10000,
+                        required=False, help="Maximum number of rows per checkpoint")
+    parser.add_argument("--batch_size", type=int, default=32,
+                        required=False, help="Batch size used for computing the embeddings")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume the job previously started in path_new from its last checkpoint")
+    parser.add_argument("--n_workers", type=int, default=1,
+                        required=False, help="Number of worker processes")
+    parser.add_argument("--threads_per_worker", type=int, default=None,
+                        required=False, help="Number of torch threads per worker process")
+    parser.add_argument("--embeddings_pooling", type=str, default=None,
+                        required=False, choices=list(POOLING_STRATEGIES),
+                        help="Split documents longer than the model's context into windows, whose embeddings are pooled with this strategy. By default, they are truncated")
+    parser.add_argument("--embeddings_overlap", type=int, default=32,
+                        required=False, help="Number of tokens shared by consecutive windows of a long document")
+    parser.add_argument("--embeddings_store", type=str, default=None,
+                        required=False, help="Path to an on-disk store of embeddings, reused across runs")
+    parser.add_argument("--embeddings_store_max_size", type=int, default=None,
+                        required=False, help="Maximum size of the embeddings store in MB")
+    parser.add_argument("--embeddings_store_max_age", type=float, default=None,
+                        required=False, help="Maximum age in days of unused embeddings store entries")
 
     args = parser.parse_args()
 
@@ -297,9 +1249,17 @@ if __name__ == "__main__":
     logging.basicConfig(level='INFO')
     logger = logging.getLogger('EmbeddingsManager')
 
-    em = EmbeddingsManager(logger=logger)
+    em = EmbeddingsManager(
+        logger=logger,
+        embeddings_store=Path(args.embeddings_store) if args.embeddings_store else None,
+        embeddings_store_max_size=args.embeddings_store_max_size * 1024 ** 2 if args.embeddings_store_max_size else None,
+        embeddings_store_max_age=args.embeddings_store_max_age)
 
     parquet_path = Path(args.path_parquet)
     parquet_new = Path(args.path_new)
     em.add_embeddins_to_parquet(
-        parquet_path, parquet_new, args.embeddings_model, args.max_sequence_length)
+        parquet_path, parquet_new, args.embeddings_model, args.max_sequence_length,
+        dtype=args.embeddings_dtype, chunk_size=args.chunk_size,
+        batch_size=args.batch_size, resume=args.resume,
+        n_workers=args.n_workers, threads_per_worker=args.threads_per_worker,
+        pooling=args.embeddings_pooling, window_overlap=args.embeddings_overlap)
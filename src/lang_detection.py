@@ -0,0 +1,226 @@
+import abc
+import inspect
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Type, Union
+
+import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+from langdetect import DetectorFactory
+from langdetect import detect as langdetect_detect
+from langdetect.lang_detect_exception import LangDetectException
+
+from src.profiling import profile_stage
+
+
+class LanguageDetector(abc.ABC):
+    """
+    Interface of the language detection backends. A backend only needs to implement detect; detect_batch can be overridden by backends able to process several texts at once.
+
+    Backends are pickled to the worker processes, so they should load any heavy resource lazily.
+    """
+
+    @abc.abstractmethod
+    def detect(self, text: str) -> str:
+        """
+        Detects the language of a given text
+
+        Parameters
+        ----------
+        text : str
+            Text whose language is to be detected
+
+        Returns
+        -------
+        lang : str
+            ISO 639-1 code of the language of the text, or 'Other' if it cannot be detected
+        """
+
+    def detect_batch(self, texts: List[str]) -> List[str]:
+        """
+        Detects the language of a list of texts
+
+        Parameters
+        ----------
+        texts : List[str]
+            Texts whose language is to be detected
+
+        Returns
+        -------
+        langs : List[str]
+            Language of each text
+        """
+
+        return [self.detect(text) for text in texts]
+
+
+class LangdetectDetector(LanguageDetector):
+    """
+    Backend based on langdetect. The random generator of langdetect is seeded, so results are deterministic.
+    """
+
+    def __init__(self, seed: int = 0):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        seed : int
+            Seed of langdetect's random generator
+        """
+
+        self._seed = seed
+
+    def detect(self, text: str) -> str:
+        # The seed is a class attribute of the factory, so it is set on every call to cover new worker processes
+        DetectorFactory.seed = self._seed
+        try:
+            lang = langdetect_detect(text)
+        except LangDetectException:
+            lang = 'Other'
+        return lang
+
+
+_BACKENDS: Dict[str, Type[LanguageDetector]] = {
+    'langdetect': LangdetectDetector,
+}
+
+
+def register_backend(name: str, backend: Type[LanguageDetector]) -> None:
+    """
+    Registers a language detection backend, so that it can be selected by name (e.g., with nlpipe.py's --lang_backend)
+
+    Parameters
+    ----------
+    name : str
+        Name of the backend
+    backend : Type[LanguageDetector]
+        Class implementing the LanguageDetector interface. It is instantiated without arguments
+    """
+
+    if not (inspect.isclass(backend) and issubclass(backend, LanguageDetector)) or inspect.isabstract(backend):
+        raise TypeError(
+            f"Language detection backend {name} must be a subclass of LanguageDetector implementing detect")
+    _BACKENDS[name] = backend
+
+    return
+
+
+def get_backend(name: str) -> LanguageDetector:
+    """
+    Instantiates a registered language detection backend
+
+    Parameters
+    ----------
+    name : str
+        Name of the backend
+
+    Returns
+    -------
+    backend : LanguageDetector
+        Language detection backend
+    """
+
+    if name not in _BACKENDS:
+        raise ValueError(
+            f"Unknown language detection backend: {name}. Available: {', '.join(_BACKENDS)}")
+    return _BACKENDS[name]()
+
+
+class LanguageDetection(object):
+    """
+    Language detection stage of the pipeline. Texts are truncated to a prefix of max_chars characters before detection, and processed per Dask partition or, with pandas, in a pool of n_process processes.
+    """
+
+    def __init__(self,
+                 backend: Union[str, LanguageDetector] = 'langdetect',
+                 max_chars: int = 1000,
+                 n_process: int = 1,
+                 logger=None):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        backend : Union[str, LanguageDetector]
+            Name of a registered backend, or backend instance
+        max_chars : int
+            Number of characters of each text used for detection. If None or 0, the whole text is used
+        n_process : int
+            Number of processes used with pandas
+        logger: Logger object
+            To log object activity
+        """
+
+        # Create logger object
+        if logger:
+            self._logger = logger
+        else:
+            logging.basicConfig(level='INFO')
+            self._logger = logging.getLogger('LanguageDetection')
+
+        self._backend = get_backend(backend) if isinstance(
+            backend, str) else backend
+        self._max_chars = max_chars
+        self._n_process = n_process
+
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_logger'] = None
+        return state
+
+    def _detect_list(self, texts: List[str]) -> List[str]:
+        with profile_stage("language_detection") as profiler:
+            texts = [text if isinstance(text, str) else "" for text in texts]
+            if self._max_chars:
+                texts = [text[:self._max_chars] for text in texts]
+            langs = self._backend.detect_batch(texts)
+            profiler.docs = len(texts)
+        return langs
+
+    def _detect_series(self, texts: pd.Series) -> pd.Series:
+        return pd.Series(self._detect_list(texts.tolist()),
+                         index=texts.index,
+                         name=texts.name,
+                         dtype=object)
+
+    def detect(self,
+               texts: Union[dd.Series, pd.Series],
+               use_dask: bool = False) -> Union[dd.Series, pd.Series]:
+        """
+        Detects the language of each text in a column
+
+        Parameters
+        ----------
+        texts : Union[dd.Series, pd.Series]
+            Column with the texts whose language is to be detected
+        use_dask : bool
+            Whether texts is a Dask Series
+
+        Returns
+        -------
+        langs : Union[dd.Series, pd.Series]
+            Column with the language of each text
+        """
+
+        self._logger.info(
+            f"-- -- Detecting language with {type(self._backend).__name__} over the first {self._max_chars or 'all'} characters of each text...")
+
+        if use_dask:
+            return texts.map_partitions(self._detect_series,
+                                        meta=(texts.name, 'str'))
+
+        if self._n_process <= 1 or len(texts) < 2 * self._n_process:
+            return self._detect_series(texts)
+
+        chunks = np.array_split(np.array(texts.tolist(), dtype=object),
+                                self._n_process)
+        with ProcessPoolExecutor(max_workers=self._n_process) as executor:
+            langs = [lang for chunk_langs in executor.map(
+                self._detect_list, [chunk.tolist() for chunk in chunks])
+                for lang in chunk_langs]
+
+        return pd.Series(langs, index=texts.index, name=texts.name, dtype=object)
@@ -0,0 +1,218 @@
+import hashlib
+import json
+import logging
+import pathlib
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional
+
+
+class LemmaCache(object):
+    """
+    Persistent, content-addressed cache of lemmatized documents.
+
+    Entries are stored in a SQLite database and keyed by the hash of the raw text together with a fingerprint of the pipeline configuration (spaCy model, stopwords, acronyms, contractions and language), so that any change in the pipeline inputs results in cache misses rather than in stale lemmas. The database is opened lazily, which makes the object picklable and allows it to be shipped to Dask workers, each of which opens its own connection.
+    """
+
+    # Maximum number of host parameters in a SQLite statement
+    _MAX_VARS = 900
+
+    def __init__(self,
+                 cache_path: pathlib.Path,
+                 fingerprint: str,
+                 max_size: Optional[int] = None,
+                 max_age: Optional[float] = None,
+                 logger=None):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        cache_path: pathlib.Path
+            Path to the SQLite file backing the cache
+        fingerprint: str
+            Fingerprint of the pipeline configuration (see LemmaCache.fingerprint)
+        max_size: int, optional
+            Maximum size of the cache in bytes. If exceeded, the least recently used entries are evicted
+        max_age: float, optional
+            Maximum age of the entries in days since their last use
+        logger: Logger object
+            To log object activity
+        """
+
+        # Create logger object
+        if logger:
+            self._logger = logger
+        else:
+            logging.basicConfig(level='INFO')
+            self._logger = logging.getLogger('LemmaCache')
+
+        self._cache_path = pathlib.Path(cache_path)
+        self._fingerprint = fingerprint
+        self._max_size = max_size
+        self._max_age = max_age
+        self._conn = None
+        self.hits = 0
+        self.misses = 0
+
+        return
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_conn'] = None
+        return state
+
+    @staticmethod
+    def fingerprint(**inputs) -> str:
+        """
+        Computes a fingerprint of the pipeline inputs. Values must be JSON-serializable; sets should be given sorted.
+
+        Returns
+        -------
+        fingerprint: str
+            Hex digest identifying the pipeline configuration
+        """
+
+        payload = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha1(
+            (self._fingerprint + "\x00" + text).encode("utf-8")).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._cache_path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self._cache_path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lemmas ("
+                "key TEXT PRIMARY KEY, lemmas TEXT NOT NULL, "
+                "size INTEGER NOT NULL, accessed REAL NOT NULL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lemmas_accessed ON lemmas(accessed)")
+            self._conn.commit()
+        return self._conn
+
+    def get_many(self, texts: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Looks up a collection of texts in the cache
+
+        Parameters
+        ----------
+        texts: Iterable[str]
+            Raw texts to look up
+
+        Returns
+        -------
+        found: Dict[str, List[str]]
+            Lemmas of the texts found in the cache, indexed by raw text
+        """
+
+        conn = self._connect()
+        keys = {}
+        for text in texts:
+            keys.setdefault(self._key(text), text)
+        key_list = list(keys)
+
+        found = {}
+        for i in range(0, len(key_list), self._MAX_VARS):
+            chunk = key_list[i:i + self._MAX_VARS]
+            placeholders = ",".join("?" * len(chunk))
+            rows = conn.execute(
+                f"SELECT key, lemmas FROM lemmas WHERE key IN ({placeholders})",
+                chunk).fetchall()
+            for key, lemmas in rows:
+                found[keys[key]] = lemmas.split(" ") if lemmas else []
+            if rows:
+                now = time.time()
+                conn.executemany("UPDATE lemmas SET accessed = ? WHERE key = ?",
+                                 [(now, key) for key, _ in rows])
+        conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self, items: Dict[str, List[str]]) -> None:
+        """
+        Stores the lemmas of a collection of texts in the cache
+
+        Parameters
+        ----------
+        items: Dict[str, List[str]]
+            Lemmas indexed by raw text
+        """
+
+        if not items:
+            return
+
+        conn = self._connect()
+        now = time.time()
+        rows = []
+        for text, lemmas in items.items():
+            key = self._key(text)
+            value = " ".join(lemmas)
+            rows.append((key, value, len(key) + len(value.encode("utf-8")), now))
+        conn.executemany(
+            "INSERT OR REPLACE INTO lemmas (key, lemmas, size, accessed) VALUES (?, ?, ?, ?)",
+            rows)
+        conn.commit()
+
+        return
+
+    def evict(self) -> int:
+        """
+        Removes the entries older than max_age days and, afterwards, the least recently used ones until the cache fits in max_size bytes
+
+        Returns
+        -------
+        n_evicted: int
+            Number of entries removed
+        """
+
+        conn = self._connect()
+        n_evicted = 0
+
+        if self._max_age is not None:
+            limit = time.time() - self._max_age * 86400
+            n_evicted += conn.execute(
+                "DELETE FROM lemmas WHERE accessed < ?", (limit,)).rowcount
+
+        if self._max_size is not None:
+            total = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM lemmas").fetchone()[0]
+            if total > self._max_size:
+                to_delete = []
+                for key, size in conn.execute(
+                        "SELECT key, size FROM lemmas ORDER BY accessed"):
+                    if total <= self._max_size:
+                        break
+                    to_delete.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM lemmas WHERE key = ?", to_delete)
+                n_evicted += len(to_delete)
+
+        conn.commit()
+        if n_evicted:
+            conn.execute("VACUUM")
+
+        self._logger.info(
+            f"-- -- Lemma cache: {n_evicted} entries evicted.")
+
+        return n_evicted
+
+    def log_stats(self) -> None:
+        """
+        Logs the hit/miss statistics gathered since the last call
+        """
+
+        total = self.hits + self.misses
+        ratio = self.hits / total if total else 0.0
+        self._logger.info(
+            f"-- -- Lemma cache: {self.hits} hits, {self.misses} misses (hit ratio {ratio:.2%}).")
+        self.hits = 0
+        self.misses = 0
+
+        return
@@ -1,16 +1,149 @@
+import importlib.util
 import logging
 import pathlib
 import re
-from typing import List, Union
+import resource
+import time
+from typing import Dict, Iterable, List, Tuple, Union
 
-import contractions
+import dask
 import dask.dataframe as dd
 import pandas as pd
-from dask.diagnostics import ProgressBar
-from gensim.models.phrases import Phrases
+from gensim.models.phrases import FrozenPhrases, Phrases
+from gensim.utils import prune_vocab
+from spacy.strings import get_string_id
+from spacy.symbols import ADJ, NOUN, PROPN, VERB
+from spacy.cli import download
+from spacy.language import Language
+from spacy.util import load_meta
 from spacy_download import load_spacy
 
 import src.acronyms as acronyms
+from src.lemma_cache import LemmaCache
+from src.profiling import StageProfiler, profile_stage
+from src.utils import compute_dask, deduplicate, persist_dataframe
+
+# spaCy models loaded in the current process, indexed by (model name, excluded components)
+_NLP_MODELS: Dict[Tuple[str, Tuple[str, ...]], Language] = {}
+
+# Profiles of the components of a spaCy model that are loaded: "full" excludes the parser and the NER only, while "lemma" keeps only the components that do_pipeline needs (POS tags, morphology and lemmas, and the embedding layers they listen to)
+SPACY_PROFILES = ("lemma", "full")
+_FULL_EXCLUDE = ('parser', 'ner')
+_LEMMA_COMPONENTS = frozenset(['transformer', 'tok2vec', 'tagger', 'morphologizer',
+                               'attribute_ruler', 'lemmatizer', 'trainable_lemmatizer'])
+
+
+def _model_components(spacy_model: str) -> List[str]:
+    """
+    Returns the names of all the components of a spaCy model package (including those disabled by default), as listed in its meta.json, downloading the package if it is not installed yet (as load_spacy does)
+    """
+
+    spec = importlib.util.find_spec(spacy_model)
+    if spec is None:
+        download(spacy_model)
+        importlib.invalidate_caches()
+        spec = importlib.util.find_spec(spacy_model)
+    meta = load_meta(pathlib.Path(spec.origin).parent.joinpath("meta.json"))
+    return meta.get('components', meta.get('pipeline', []))
+
+
+def spacy_exclude(spacy_model: str,
+                  profile: str = "lemma",
+                  vectors: bool = True,
+                  logger=None) -> Tuple[str, ...]:
+    """
+    Returns the components of a spaCy model that are not loaded with a profile (see SPACY_PROFILES)
+
+    Parameters
+    ----------
+    spacy_model: str
+        Name of the spaCy model
+    profile: str
+        "lemma" to load only the components needed for lemmatization, or "full" to exclude only the parser and the NER
+    vectors: bool
+        If False, the word vectors of the model are not loaded either (see load_nlp)
+    logger: Logger object
+        To log the excluded components
+
+    Returns
+    -------
+    exclude: Tuple[str, ...]
+        Names of the excluded components (and "vectors", if they are excluded)
+    """
+
+    if profile not in SPACY_PROFILES:
+        raise ValueError(
+            f"Unsupported spaCy profile: {profile}. Available: {', '.join(SPACY_PROFILES)}")
+
+    logger = logger or logging.getLogger('Pipe')
+    exclude = _FULL_EXCLUDE
+    if profile == "lemma":
+        try:
+            exclude = tuple(component for component in _model_components(spacy_model)
+                            if component not in _LEMMA_COMPONENTS)
+        except (OSError, ValueError) as e:
+            logger.warning(
+                f"-- -- Components of spaCy model {spacy_model} could not be read ({e}); only {', '.join(_FULL_EXCLUDE)} are excluded")
+    if not vectors:
+        exclude = exclude + ('vectors',)
+
+    logger.info(
+        f"-- -- spaCy model {spacy_model} with profile {profile}: excluding {', '.join(exclude) or 'no components'}")
+
+    return exclude
+
+
+def _uses_static_vectors(nlp: Language) -> bool:
+    """
+    Checks whether any component of a spaCy model uses the word vectors as features (e.g., the tok2vec of the _md and _lg models)
+    """
+
+    for _, component in nlp.pipeline:
+        model = getattr(component, 'model', None)
+        if hasattr(model, 'walk') and any(node.name == 'static_vectors' for node in model.walk()):
+            return True
+    return False
+
+
+def load_nlp(spacy_model: str,
+             exclude: Iterable[str] = _FULL_EXCLUDE,
+             logger=None) -> Language:
+    """
+    Returns the spaCy model with the given name and excluded components, loading it only the first time it is requested in the current process, so that every Pipe (or Dask task) run by a worker process shares the same model.
+
+    If "vectors" is among the excluded components, the word vectors of the model are not loaded, unless any of the loaded components uses them as features, in which case the model is loaded again with them.
+
+    Parameters
+    ----------
+    spacy_model: str
+        Name of the spaCy model to be loaded
+    exclude: Iterable[str]
+        Components of the model that are not loaded (see spacy_exclude)
+    logger: Logger object
+        To log the load time and memory of the model
+
+    Returns
+    -------
+    nlp: Language
+        Loaded model
+    """
+
+    key = (spacy_model, tuple(exclude))
+    if key not in _NLP_MODELS:
+        logger = logger or logging.getLogger('Pipe')
+        start_time = time.time()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        nlp = load_spacy(spacy_model, exclude=list(exclude))
+        if 'vectors' in exclude and _uses_static_vectors(nlp):
+            logger.warning(
+                f"-- -- spaCy model {spacy_model} uses its word vectors as features; loading them anyway")
+            nlp = load_spacy(spacy_model, exclude=[c for c in exclude if c != 'vectors'])
+        _NLP_MODELS[key] = nlp
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        logger.info(
+            f"-- -- spaCy model {spacy_model} loaded in {(time.time() - start_time):.2f}s with components {', '.join(nlp.pipe_names)} and {nlp.vocab.vectors.shape[0]} vectors: peak RSS +{(rss_after - rss_before) / 1024:.1f} MB")
+
+    return _NLP_MODELS[key]
 
 
 class Pipe():
@@ -22,12 +155,32 @@ class Pipe():
     - Ngrams detection
     """
 
+    # POS tags kept after lemmatization, as spaCy symbol IDs
+    _VALID_POS = frozenset([VERB, NOUN, ADJ, PROPN])
+
+    # Bump whenever the output of do_pipeline changes, so that cached lemmas are invalidated
+    _LEMMAS_VERSION = 2
+
+    # Boundaries at which texts longer than max_length are split, from the most to the least preferred: paragraphs, lines, sentences and words
+    _SPLIT_PATTERNS = (re.compile(r"\n\s*\n"),
+                       re.compile(r"\n"),
+                       re.compile(r"(?<=[.!?])\s+"),
+                       re.compile(r"\s+"))
+
     def __init__(self,
                  stw_files: List[pathlib.Path],
                  spaCy_model: str,
                  language: str,
                  max_length: int,
                  raw_text_cols: List[str],
+                 acr_files: List[pathlib.Path] = None,
+                 expand_acronyms: bool = True,
+                 expand_contractions: bool = True,
+                 spacy_profile: str = "lemma",
+                 spacy_vectors: bool = True,
+                 lemma_cache: pathlib.Path = None,
+                 lemma_cache_max_size: int = None,
+                 lemma_cache_max_age: float = None,
                  logger=None):
         """
         Initilization Method
@@ -42,9 +195,25 @@ class Pipe():
         language: str
             Language of the text to be preprocessed (en/es)
         max_length: int
-            Maximum length of the text to be processed
+            Maximum number of characters processed by spaCy at once. Longer texts are split into pieces at paragraph or sentence boundaries (see _split_text), so that spaCy's memory is capped regardless of outliers
         raw_text_cols : List[str]
             List of columns containing the raw text to be preprocessed
+        acr_files: list of pathlib.Path
+            List of paths to additional acronyms files (one "acronym,expansion" pair per line)
+        expand_acronyms: bool
+            Whether acronyms are replaced by their meaning
+        expand_contractions: bool
+            Whether contractions are expanded. Only English has contractions to expand (see acronyms.load_contractions)
+        spacy_profile: str
+            Components of the spaCy model that are loaded: "lemma" (only those needed for lemmatization) or "full" (all but the parser and the NER), see spacy_exclude
+        spacy_vectors: bool
+            Whether the word vectors of the spaCy model are loaded
+        lemma_cache: pathlib.Path
+            Path to the on-disk lemma cache. If None, lemmas are not cached
+        lemma_cache_max_size: int
+            Maximum size of the lemma cache in bytes
+        lemma_cache_max_age: float
+            Maximum age (in days since last use) of the lemma cache entries
         logger: Logger object
             To log object activity
         """
@@ -56,20 +225,60 @@ class Pipe():
             logging.basicConfig(level='INFO')
             self._logger = logging.getLogger('nlpPipeline')
 
-        # Load stopwords and acronyms
+        # Load stopwords, acronyms and contractions
         self._loadSTW(stw_files)
-        self._loadACR(language)
-
-        # Download spaCy model if not already downloaded and load
-        self._nlp = load_spacy(spaCy_model, exclude=['parser', 'ner'])
-        self._nlp.max_length = max_length + round(0.1 * max_length)
+        self._loadACR(language, acr_files, expand_acronyms, expand_contractions)
+
+        # Download spaCy model if not already downloaded and load. Only its name, excluded components and max_length are pickled (see __getstate__)
+        self._spacy_model = spaCy_model
+        self._spacy_exclude = spacy_exclude(spaCy_model, spacy_profile, spacy_vectors, self._logger)
+        self._max_length = max_length
+        self._nlp = load_nlp(spaCy_model, self._spacy_exclude, self._logger)
+        self._nlp.max_length = self._max_length
         self._raw_text_cols = raw_text_cols
 
+        # Open lemma cache, keyed by everything the lemmas depend on
+        self._lemma_cache = None
+        if lemma_cache is not None:
+            fingerprint = LemmaCache.fingerprint(
+                version=self._LEMMAS_VERSION,
+                spacy_model=spaCy_model,
+                spacy_model_version=self.nlp.meta.get('version'),
+                spacy_pipeline=self.nlp.pipe_names,
+                stopwords=sorted(stw for stw in self._stw_set if isinstance(stw, str)),
+                acronyms=self._acr_list,
+                contractions=sorted(self._contractions.items()),
+                language=language,
+                max_length=self._max_length)
+            self._lemma_cache = LemmaCache(lemma_cache,
+                                           fingerprint,
+                                           max_size=lemma_cache_max_size,
+                                           max_age=lemma_cache_max_age,
+                                           logger=self._logger)
+            self._lemma_cache.evict()
+
         return
 
+    def __getstate__(self):
+        # The Pipe is pickled as a lightweight spec (e.g., into every Dask task), without its spaCy model
+        state = self.__dict__.copy()
+        state['_nlp'] = None
+        return state
+
+    @property
+    def nlp(self) -> Language:
+        """
+        spaCy model of the pipeline. When the Pipe has been unpickled in another process, the model is loaded there on first use, once for all the tasks of the process (see load_nlp)
+        """
+
+        if self._nlp is None:
+            self._nlp = load_nlp(self._spacy_model, self._spacy_exclude, self._logger)
+            self._nlp.max_length = self._max_length
+        return self._nlp
+
     def _loadSTW(self, stw_files: List[pathlib.Path]) -> None:
         """
-        Loads stopwords as list from files provided in the argument
+        Loads stopwords as a set from files provided in the argument. Besides the set of strings, the set of their spaCy string IDs (hashes) is kept, so token filtering can be carried out by comparing integers (i.e., token.lemma) instead of strings.
 
         Parameters
         ----------
@@ -82,41 +291,160 @@ class Pipe():
                          skiprows=3) for stw_file in stw_files]
         stw_list = \
             [stopword for stw_df in stw_list for stopword in stw_df['stopwords']]
-        self._stw_list = list(dict.fromkeys(stw_list))  # remove duplicates
+        self._stw_set = frozenset(stw_list)  # remove duplicates
+        self._stw_hashes = frozenset(
+            get_string_id(stopword) for stopword in self._stw_set
+            if isinstance(stopword, str))
         self._logger.info(
             f"-- -- Stopwords list created with {len(stw_list)} items.")
 
         return
 
-    def _loadACR(self, lang: str) -> None:
+    def _loadACR(self,
+                 lang: str,
+                 acr_files: List[pathlib.Path] = None,
+                 expand_acronyms: bool = True,
+                 expand_contractions: bool = True) -> None:
         """
-        Loads list of acronyms
+        Loads list of acronyms and the contractions of the language, and compiles them into a single matcher, so that both are expanded in one scan of each text
+
+        Parameters
+        ----------
+        lang: str
+            Language of the text to be preprocessed (en/es)
+        acr_files: list of pathlib.Path
+            List of paths to additional, user-supplied acronyms files
+        expand_acronyms: bool
+            Whether acronyms are expanded
+        expand_contractions: bool
+            Whether contractions are expanded
         """
 
-        self._acr_list = acronyms.en_acronyms_list if lang == 'en' else acronyms.es_acronyms_list
+        self._acr_list = []
+        if expand_acronyms:
+            self._acr_list = acronyms.en_acronyms_list if lang == 'en' else acronyms.es_acronyms_list
+            if acr_files:
+                self._acr_list = self._acr_list + acronyms.load_acronyms(acr_files)
+        self._contractions = acronyms.load_contractions(lang) if expand_contractions else {}
+        self._acr_matcher = acronyms.AcronymMatcher(self._acr_list, self._contractions)
+        self._logger.info(
+            f"-- -- Acronyms matcher created with {len(self._acr_matcher)} acronyms and {self._acr_matcher.n_contractions} contractions.")
 
         return
 
-    def _replace(self, text, patterns) -> str:
+    def _replace(self, text) -> str:
         """
-        Replaces patterns in strings.
+        Replaces acronyms and contractions in strings by their meaning.
 
         Parameters
         ----------
         text: str
-            Text in which the patterns are going to be replaced
-        patterns: List of tuples
-            Replacement to be carried out
+            Text in which the acronyms and contractions are going to be replaced
 
         Returns
         -------
         text: str
             Replaced text
         """
-        for (raw, rep) in patterns:
-            regex = re.compile(raw, flags=re.IGNORECASE)
-            text = regex.sub(rep, text)
-        return text
+
+        return self._acr_matcher.replace(text)
+
+    def _prepare_text(self, rawtext: str) -> str:
+        """
+        Carries out the text-level steps of the pipeline that take place before spaCy processing, in a single scan of the text (see acronyms.AcronymMatcher):
+        - Acronyms replacement
+        - Expansion of English contractions
+
+        Parameters
+        ----------
+        rawtext: str
+            Text to prepare
+
+        Returns
+        -------
+        text: str
+            Text ready to be processed by spaCy
+        """
+
+        return self._replace(rawtext)
+
+    def _filter_doc(self, doc) -> List[str]:
+        """
+        Carries out the token-level steps of the pipeline over a spaCy Doc:
+        - Lemmatization according to POS
+        - Removal of non-alphanumerical tokens
+        - Removal of stopwords
+        - Lowercase conversion
+
+        Parameters
+        ----------
+        doc: spacy.tokens.Doc
+            Document processed by spaCy
+
+        Returns
+        -------
+        final_tokenized: List[str]
+            List of tokens (strings) with the preprocessed text
+        """
+
+        valid_POS = self._VALID_POS
+        stw_hashes = self._stw_hashes
+
+        lemmatized = [token.lemma_ for token in doc
+                      if token.is_alpha
+                      and token.pos in valid_POS
+                      and not token.is_stop
+                      and token.lemma not in stw_hashes]
+
+        # Convert to lowercase
+        final_tokenized = [token.lower() for token in lemmatized]
+
+        return final_tokenized
+
+    def _split_text(self, text: str, level: int = 0) -> List[str]:
+        """
+        Splits a text longer than max_length characters into pieces that are not, cutting at the most preferred boundaries possible (see _SPLIT_PATTERNS). Pieces are packed greedily, so that as few of them as possible are created, and concatenating them gives back the text.
+
+        Parameters
+        ----------
+        text: str
+            Text to split
+        level: int
+            Index of the first boundary pattern to try
+
+        Returns
+        -------
+        pieces: List[str]
+            Pieces of the text, in order
+        """
+
+        limit = self._max_length
+        if len(text) <= limit:
+            return [text]
+        if level == len(self._SPLIT_PATTERNS):
+            # No boundary is left; cut at the limit
+            return [text[i:i + limit] for i in range(0, len(text), limit)]
+
+        cuts = [m.end() for m in self._SPLIT_PATTERNS[level].finditer(text)]
+        segments = [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)]) if j > i]
+
+        pieces = []
+        current = ""
+        for segment in segments:
+            if len(current) + len(segment) <= limit:
+                current += segment
+                continue
+            if current:
+                pieces.append(current)
+            if len(segment) <= limit:
+                current = segment
+            else:
+                current = ""
+                pieces.extend(self._split_text(segment, level + 1))
+        if current:
+            pieces.append(current)
+
+        return pieces
 
     def do_pipeline(self, rawtext) -> str:
         """
@@ -141,37 +469,279 @@ class Pipe():
             List of tokens (strings) with the preprocessed text
         """
 
-        # Change acronyms by their meaning
-        text = self._replace(rawtext, self._acr_list)
+        # Over-long texts are lemmatized piece by piece
+        return [lemma
+                for piece in self._split_text(self._prepare_text(rawtext))
+                for lemma in self._filter_doc(self.nlp(piece))]
 
-        # Expand contractions
-        try:
-            text = contractions.fix(text)
-        except:
-            text = text  # this is only for SS
+    def do_pipeline_batch(self,
+                          rawtexts: Iterable[str],
+                          batch_size: int = 1000,
+                          n_process: int = 1) -> List[List[str]]:
+        """
+        Batched version of do_pipeline. Texts are streamed through spaCy's nlp.pipe, so the model processes them in batches (and, optionally, in several processes) instead of one document at a time. As in do_pipeline, texts longer than max_length are split into pieces, whose lemmas are joined afterwards. The output is the same as calling do_pipeline on every text.
 
-        valid_POS = set(['VERB', 'NOUN', 'ADJ', 'PROPN'])
+        Parameters
+        ----------
+        rawtexts: Iterable[str]
+            Texts to preprocess
+        batch_size: int (default=1000)
+            Number of texts buffered by spaCy in each batch
+        n_process: int (default=1)
+            Number of processes used by spaCy. If -1, all available cores are used
 
-        doc = self._nlp(text)
-        lemmatized = [token.lemma_ for token in doc
-                      if token.is_alpha
-                      and token.pos_ in valid_POS
-                      and not token.is_stop
-                      and token.lemma_ not in self._stw_list]
+        Returns
+        -------
+        final_tokenized: List[List[str]]
+            List with the preprocessed tokens of each text, in the same order as rawtexts
+        """
 
-        # Convert to lowercase
-        final_tokenized = [token.lower() for token in lemmatized]
+        # Number of pieces of each text, filled in as spaCy consumes them
+        n_pieces = []
+
+        # The text-level steps run as spaCy consumes the texts, so their time is accumulated per text and discounted from spaCy's
+        exp_profiler = StageProfiler("expansions")
+        spacy_profiler = StageProfiler("spacy")
+
+        def pieces():
+            for rawtext in rawtexts:
+                with exp_profiler:
+                    text = self._prepare_text(rawtext)
+                text_pieces = self._split_text(text)
+                n_pieces.append(len(text_pieces))
+                yield from text_pieces
+
+        lemmas = []
+        with spacy_profiler:
+            for doc in self.nlp.pipe(pieces(), batch_size=batch_size, n_process=n_process):
+                lemmas.append(self._filter_doc(doc))
+                spacy_profiler.tokens += len(doc)
+        spacy_profiler.exclude(exp_profiler)
+        for profiler in [exp_profiler, spacy_profiler]:
+            profiler.docs = len(n_pieces)
+            profiler.record()
+
+        final_tokenized = []
+        start = 0
+        for n in n_pieces:
+            final_tokenized.append(lemmas[start] if n == 1 else
+                                   [lemma for piece in lemmas[start:start + n] for lemma in piece])
+            start += n
 
         return final_tokenized
 
+    def _lemmatize_series(self,
+                          texts: pd.Series,
+                          batch_size: int = 1000,
+                          n_process: int = 1) -> pd.Series:
+        """
+        Lemmatizes a pandas Series (or a Dask partition) with do_pipeline_batch, preserving its index. Each distinct text is lemmatized (or looked up in the lemma cache) once, and its lemmas are shared by all its duplicates.
+
+        Parameters
+        ----------
+        texts: pd.Series
+            Series with the texts to preprocess
+        batch_size: int (default=1000)
+            Number of texts buffered by spaCy in each batch
+        n_process: int (default=1)
+            Number of processes used by spaCy
+
+        Returns
+        -------
+        lemmas: pd.Series
+            Series with the preprocessed tokens of each text
+        """
+
+        # Duplicates are lemmatized once. Texts are compared exactly, since whitespace tokens may change spaCy's tags
+        rawtexts, inverse = deduplicate(texts.tolist(), logger=self._logger)
+
+        if self._lemma_cache is None:
+            lemmas = self.do_pipeline_batch(rawtexts,
+                                            batch_size=batch_size,
+                                            n_process=n_process)
+        else:
+            # Only cache misses go through spaCy
+            found = self._lemma_cache.get_many(rawtexts)
+            missing = [text for text in rawtexts if text not in found]
+            computed = dict(zip(missing,
+                                self.do_pipeline_batch(missing,
+                                                       batch_size=batch_size,
+                                                       n_process=n_process)))
+            self._lemma_cache.put_many(computed)
+            self._lemma_cache.log_stats()
+            found.update(computed)
+            lemmas = [found[text] for text in rawtexts]
+
+        return pd.Series([lemmas[i] for i in inverse],
+                         index=texts.index,
+                         name=texts.name,
+                         dtype=object)
+
+    def get_lemmas_cols(self) -> List[str]:
+        """
+        Returns the names of the columns in which the lemmas of each raw text column are saved
+
+        Returns
+        -------
+        lemmas_cols: List[str]
+            List of lemmas columns, in the same order as raw_text_cols
+        """
+
+        if len(self._raw_text_cols) > 1:
+            return [col.split("_")[0] + "_lemmas" for col in self._raw_text_cols]
+        return ["lemmas"]
+
+    def lemmatize(self,
+                  corpus_df: Union[dd.DataFrame, pd.DataFrame],
+                  use_dask: bool = False,
+                  batch_size: int = 1000,
+                  n_process: int = 1) -> Union[dd.DataFrame, pd.DataFrame]:
+        """
+        Lemmatizes the raw text columns, saving the tokens of each document as a list in the corresponding lemmas column (see get_lemmas_cols). N-grams detection is not carried out.
+
+        Parameters
+        ----------
+        corpus_df: Union[dd.DataFrame, pd.DataFrame]
+            Dataframe representation of the corpus to be lemmatized
+        use_dask: bool
+            Whether corpus_df is a Dask DataFrame
+        batch_size: int
+            Number of texts buffered by spaCy in each batch
+        n_process: int
+            Number of processes used by spaCy for lemmatization (pandas only)
+
+        Returns
+        -------
+        corpus_df: Union[dd.DataFrame, pd.DataFrame]
+            DataFrame with the lemmas columns added
+        """
+
+        for col, new_col in zip(self._raw_text_cols, self.get_lemmas_cols()):
+            self._logger.info(f"-- Lemmatizing text of {col}")
+            if use_dask:
+                corpus_df[new_col] = corpus_df[col].map_partitions(
+                    self._lemmatize_series,
+                    batch_size=batch_size,
+                    n_process=1,
+                    meta=(new_col, 'object'))
+            else:
+                corpus_df[new_col] = self._lemmatize_series(
+                    corpus_df[col],
+                    batch_size=batch_size,
+                    n_process=n_process)
+
+        return corpus_df
+
+    @staticmethod
+    def _learn_ngrams(lemmas: Iterable[List[str]],
+                      min_count: int,
+                      threshold: float) -> Phrases:
+        """
+        Collects the unigram and bigram counts of a collection of tokenized documents (e.g., a Dask partition)
+        """
+
+        # Documents are counted when n-grams are substituted
+        with profile_stage("ngrams"):
+            phrase_model = Phrases(min_count=min_count, threshold=threshold)
+            phrase_model.add_vocab(lemmas)
+
+        return phrase_model
+
+    @staticmethod
+    def merge_ngrams(phrase_models: List[Phrases]) -> Phrases:
+        """
+        Merges the vocabularies of several Phrases models trained over disjoint parts of a corpus, the same way Phrases.add_vocab merges the counts of new sentences.
+
+        Parameters
+        ----------
+        phrase_models: List[Phrases]
+            Phrases models to merge. All of them must have been created with the same parameters
+
+        Returns
+        -------
+        phrase_model: Phrases
+            Phrases model with the counts of the whole corpus
+        """
+
+        merged = phrase_models[0]
+        for phrase_model in phrase_models[1:]:
+            merged.corpus_word_count += phrase_model.corpus_word_count
+            merged.min_reduce = max(merged.min_reduce, phrase_model.min_reduce)
+            for word, count in phrase_model.vocab.items():
+                merged.vocab[word] = merged.vocab.get(word, 0) + count
+            if len(merged.vocab) > merged.max_vocab_size:
+                prune_vocab(merged.vocab, merged.min_reduce)
+                merged.min_reduce += 1
+
+        return merged
+
+    def train_ngrams(self,
+                     lemmas: Union[dd.Series, pd.Series],
+                     use_dask: bool = False,
+                     nw: int = 0,
+                     min_count: int = 2,
+                     threshold: float = 20) -> FrozenPhrases:
+        """
+        Trains the n-grams detection model over a column of tokenized documents. With Dask, the counts are collected per partition and merged in the driver, so the lemmas are never materialized in a single process.
+
+        Parameters
+        ----------
+        lemmas: Union[dd.Series, pd.Series]
+            Column with the tokens (lists of strings) of each document
+        use_dask: bool
+            Whether lemmas is a Dask Series
+        nw: int
+            Number of workers for Dask computations
+        min_count: int
+            Minimum count of a bigram to be detected as n-gram
+        threshold: float
+            Score threshold of a bigram to be detected as n-gram
+
+        Returns
+        -------
+        phrase_model: FrozenPhrases
+            Frozen n-grams detection model, ready to be applied
+        """
+
+        if use_dask:
+            partial_models = [
+                dask.delayed(self._learn_ngrams)(part, min_count, threshold)
+                for part in lemmas.to_delayed()]
+            partial_models = compute_dask(*partial_models, nw=nw)
+            phrase_model = self.merge_ngrams(list(partial_models))
+        else:
+            phrase_model = self._learn_ngrams(lemmas, min_count, threshold)
+
+        return phrase_model.freeze()
+
+    @staticmethod
+    def apply_ngrams(lemmas: pd.Series,
+                      phrase_model: FrozenPhrases) -> pd.Series:
+        """
+        Substitutes the n-grams detected by phrase_model in a column of tokenized documents (or a Dask partition of it), joining the tokens of each document with spaces
+        """
+
+        with profile_stage("ngrams") as profiler:
+            lemmas = lemmas.apply(lambda doc: " ".join(phrase_model[doc]))
+            profiler.docs = len(lemmas)
+
+        return lemmas
+
     def preproc(self,
                 corpus_df: Union[dd.DataFrame, pd.DataFrame],
                 use_dask: bool = False,
                 nw: int = 0,
-                no_ngrams: bool = False) -> Union[dd.DataFrame, pd.DataFrame]:
+                no_ngrams: bool = False,
+                batch_size: int = 1000,
+                n_process: int = 1,
+                ngrams_min_count: int = 2,
+                ngrams_threshold: float = 20,
+                checkpoint_path: pathlib.Path = None) -> Union[dd.DataFrame, pd.DataFrame]:
         """
         Invokes NLP pipeline and carries out, in addition, n-gram detection.
 
+        With Dask, n-grams training computes the lemmas, which are needed again afterwards to substitute the n-grams. Lemmatized partitions are hence materialized once (see utils.persist_dataframe), instead of being lemmatized twice.
+
         Parameters
         ----------
         corpus_df: Union[dd.DataFrame, pd.DataFrame]
@@ -182,6 +752,16 @@ class Pipe():
             Number of workers for Dask computations
         no_grams: Bool
             If True, calculation of ngrams will be skipped
+        batch_size: int
+            Number of texts buffered by spaCy in each batch
+        n_process: int
+            Number of processes used by spaCy for lemmatization. Only used with pandas; with Dask, each partition is lemmatized in a single process, since parallelism is already provided by the Dask workers
+        ngrams_min_count: int
+            Minimum count of a bigram to be detected as n-gram
+        ngrams_threshold: float
+            Score threshold of a bigram to be detected as n-gram
+        checkpoint_path: pathlib.Path
+            With Dask, path in which the lemmatized partitions are checkpointed in parquet format before n-grams detection. If None, they are persisted in memory (see utils.persist_dataframe)
 
         Returns
         -------
@@ -192,56 +772,39 @@ class Pipe():
             - lemmas
         """
         
-        if len(self._raw_text_cols) > 1:
-            new_raw_text_cols = [col.split("_")[0] + "_lemmas" for col in self._raw_text_cols]
-        else:
-            new_raw_text_cols = ["lemmas"]
-                        
-        for col, new_col in zip(self._raw_text_cols, new_raw_text_cols):
-            # Lemmatize text
-            self._logger.info(f"-- Lemmatizing text of {col}")
-            if use_dask:
-                corpus_df[new_col] = corpus_df[col].apply(
-                    self.do_pipeline,
-                    meta=('x', 'str'))
-            else:
-                corpus_df[new_col] = corpus_df[col].apply(
-                    self.do_pipeline)
-            
+        new_raw_text_cols = self.get_lemmas_cols()
+        corpus_df = self.lemmatize(corpus_df,
+                                   use_dask=use_dask,
+                                   batch_size=batch_size,
+                                   n_process=n_process)
+
+        if use_dask and not no_ngrams:
+            self._logger.info("-- Materializing lemmatized partitions")
+            corpus_df = persist_dataframe(corpus_df, nw=nw,
+                                          checkpoint_path=checkpoint_path)
+
+        for new_col in new_raw_text_cols:
             # If no_ngrams is False, carry out n-grams detection
             if not no_ngrams:
 
-                def get_ngram(doc):
-                    return " ".join(phrase_model[doc])
-
-                # Create corpus from tokenized lemmas
-                self._logger.info(
-                    "-- Creating corpus from lemmas for n-grams detection")
-                if use_dask:
-                    with ProgressBar():
-                        if nw > 0:
-                            lemmas = corpus_df[new_col].compute(
-                                scheduler='processes', num_workers=nw)
-                        else:
-                            # Use Dask default number of workers (i.e., number of cores)
-                            lemmas = corpus_df[new_col].compute(
-                                scheduler='processes')
-                else:
-                    lemmas = corpus_df[new_col]
-
                 # Create Phrase model for n-grams detection
                 self._logger.info("-- Creating Phrase model")
-                phrase_model = Phrases(lemmas, min_count=2, threshold=20)
+                phrase_model = self.train_ngrams(corpus_df[new_col],
+                                                 use_dask=use_dask,
+                                                 nw=nw,
+                                                 min_count=ngrams_min_count,
+                                                 threshold=ngrams_threshold)
 
                 # Carry out n-grams substitution
                 self._logger.info("-- Carrying out n-grams substitution")
 
                 if use_dask:
                     corpus_df[new_col] = \
-                        corpus_df[new_col].apply(
-                            get_ngram, meta=('x', 'str'))
+                        corpus_df[new_col].map_partitions(
+                            self.apply_ngrams, phrase_model, meta=('x', 'str'))
                 else:
-                    corpus_df[new_col] = corpus_df[new_col].apply(get_ngram)
+                    corpus_df[new_col] = self.apply_ngrams(
+                        corpus_df[new_col], phrase_model)
 
             else:
                 if use_dask:
@@ -0,0 +1,331 @@
+import cProfile
+import json
+import logging
+import os
+import pathlib
+import pstats
+import resource
+import shutil
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List
+
+# Stages of the pipeline, in the order in which they are reported
+STAGES = ("read", "language_detection", "expansions", "spacy", "ngrams",
+          "spill", "embeddings", "write")
+
+# Environment variables through which the run's spool folder and the stage to be profiled reach the worker processes (Dask, spaCy or language detection pools), which inherit them
+_SPOOL_ENV = "NLPIPE_PROFILE_SPOOL"
+_PROFILE_ENV = "NLPIPE_PROFILE_STAGE"
+
+
+def peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the current process in MB
+    """
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def record_stage(stage: str,
+                 wall_time: float,
+                 cpu_time: float = None,
+                 docs: int = 0,
+                 tokens: int = 0) -> None:
+    """
+    Records the work done by the current process in a stage. Records are appended to a file of the run's spool folder per process, and gathered by RunProfiler at the end of the run; if no RunProfiler has been started, nothing is recorded.
+
+    Parameters
+    ----------
+    stage: str
+        Name of the stage (see STAGES)
+    wall_time: float
+        Elapsed time in seconds
+    cpu_time: float
+        CPU time of the process in seconds, or None if unknown
+    docs: int
+        Number of documents processed
+    tokens: int
+        Number of tokens processed, if known
+    """
+
+    spool = os.environ.get(_SPOOL_ENV)
+    if not spool:
+        return
+
+    record = {"stage": stage,
+              "pid": os.getpid(),
+              "end": time.time(),
+              "wall_time": wall_time,
+              "cpu_time": cpu_time,
+              "docs": docs,
+              "tokens": tokens,
+              "peak_rss_mb": peak_rss_mb()}
+    with pathlib.Path(spool).joinpath(f"{os.getpid()}.jsonl").open("a", encoding="utf8") as fout:
+        fout.write(json.dumps(record) + "\n")
+
+    return
+
+
+class StageProfiler(object):
+    """
+    Accumulates the wall time, CPU time, documents and tokens of a stage over one or several timed blocks (with StageProfiler(...) as profiler: ...), until they are recorded (see record_stage). Accumulating over several blocks allows timing steps that are interleaved with others, e.g., the acronyms and contractions expansion of each document while spaCy consumes them.
+
+    If the stage is the one selected for profiling in RunProfiler, the timed blocks are also run under cProfile, and the statistics are saved to the run's spool folder when recorded.
+    """
+
+    def __init__(self, stage: str):
+        """
+        Initilization Method
+
+        Parameters
+        ----------
+        stage: str
+            Name of the stage (see STAGES)
+        """
+
+        self.stage = stage
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.docs = 0
+        self.tokens = 0
+        self._profiler = cProfile.Profile() \
+            if os.environ.get(_PROFILE_ENV) == stage else None
+
+    def __enter__(self):
+        self._start = (time.perf_counter(), time.process_time())
+        if self._profiler is not None:
+            self._profiler.enable()
+        return self
+
+    def __exit__(self, *exc):
+        if self._profiler is not None:
+            self._profiler.disable()
+        self.wall_time += time.perf_counter() - self._start[0]
+        self.cpu_time += time.process_time() - self._start[1]
+        return False
+
+    def exclude(self, *others: "StageProfiler") -> None:
+        """
+        Discounts the time of other stages that were run within the timed blocks of this one
+        """
+
+        for other in others:
+            self.wall_time -= other.wall_time
+            self.cpu_time -= other.cpu_time
+
+        return
+
+    def record(self) -> None:
+        """
+        Records the accumulated work (see record_stage) and, if the stage is profiled, saves its cProfile statistics
+        """
+
+        record_stage(self.stage, self.wall_time, self.cpu_time,
+                     self.docs, self.tokens)
+        spool = os.environ.get(_SPOOL_ENV)
+        if self._profiler is not None and spool:
+            self._profiler.dump_stats(pathlib.Path(spool).joinpath(
+                f"{self.stage}_{os.getpid()}_{uuid.uuid4().hex}.prof"))
+
+        return
+
+
+@contextmanager
+def profile_stage(stage: str) -> Iterator[StageProfiler]:
+    """
+    Times a block of code as a stage of the pipeline, and records it when the block finishes. The number of documents and tokens can be set on the yielded StageProfiler
+
+    Parameters
+    ----------
+    stage: str
+        Name of the stage (see STAGES)
+    """
+
+    profiler = StageProfiler(stage)
+    with profiler:
+        yield profiler
+    profiler.record()
+
+
+class RunProfiler(object):
+    """
+    Gathers the stage records of all the processes of a run, and summarizes them by stage: wall time and CPU time (summed over processes, so that they measure the work done even if the stages of Dask's lazy graphs are run interleaved), documents and tokens per second of wall time, and peak RSS of the processes that ran the stage.
+
+    It can be used as a context manager (with RunProfiler(...) as run_profiler: ...), so that it is closed even if the run fails or exits.
+    """
+
+    def __init__(self,
+                 profile_stage: str = None,
+                 profile_output: pathlib.Path = None,
+                 logger=None):
+        """
+        Initilization Method. The run's spool folder is created, and exported to the environment so that the worker processes started from now on record their stages in it.
+
+        Parameters
+        ----------
+        profile_stage: str
+            Stage to be run under cProfile, if any
+        profile_output: pathlib.Path
+            File in which the cProfile statistics of profile_stage, merged over all processes, are saved (they can be read with pstats or snakeviz)
+        logger: Logger object
+            To log object activity
+        """
+
+        # Create logger object
+        if logger:
+            self._logger = logger
+        else:
+            logging.basicConfig(level='INFO')
+            self._logger = logging.getLogger('RunProfiler')
+
+        self._spool = pathlib.Path(tempfile.mkdtemp(prefix="nlpipe_profile_"))
+        os.environ[_SPOOL_ENV] = self._spool.as_posix()
+        self._profile_stage = profile_stage
+        self._profile_output = profile_output
+        if profile_stage:
+            os.environ[_PROFILE_ENV] = profile_stage
+        self._started = time.time()
+        self._start = (time.perf_counter(), time.process_time())
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def _records(self) -> List[dict]:
+        records = []
+        for spool_file in self._spool.glob("*.jsonl"):
+            with spool_file.open("r", encoding="utf8") as fin:
+                records.extend(json.loads(line) for line in fin if line.strip())
+        return records
+
+    def add_residual(self, stage: str, total_time: float) -> None:
+        """
+        Records as stage the part of total_time (e.g., the summed duration of all the tasks of a Dask execution) not accounted for by the stages recorded by worker processes, such as the reads and writes fused with them
+
+        Parameters
+        ----------
+        stage: str
+            Name under which the residual time is recorded
+        total_time: float
+            Total time in seconds
+        """
+
+        accounted = sum(record["wall_time"] for record in self._records()
+                        if record["pid"] != os.getpid())
+        record_stage(stage, max(total_time - accounted, 0.0))
+
+        return
+
+    def summary(self) -> Dict[str, dict]:
+        """
+        Summarizes the records of the run by stage
+
+        Returns
+        -------
+        summary: Dict[str, dict]
+            Metrics of the run as a whole ("run") and of each stage ("stages")
+        """
+
+        stages = defaultdict(lambda: {"wall_time": 0.0, "cpu_time": 0.0, "calls": 0,
+                                      "processes": set(), "docs": 0, "tokens": 0,
+                                      "peak_rss_mb": 0.0})
+        for record in self._records():
+            stage = stages[record["stage"]]
+            stage["wall_time"] += record["wall_time"]
+            stage["cpu_time"] = None if record["cpu_time"] is None or stage["cpu_time"] is None \
+                else stage["cpu_time"] + record["cpu_time"]
+            stage["calls"] += 1
+            stage["processes"].add(record["pid"])
+            stage["docs"] += record["docs"]
+            stage["tokens"] += record["tokens"]
+            stage["peak_rss_mb"] = max(stage["peak_rss_mb"], record["peak_rss_mb"])
+
+        order = {stage: i for i, stage in enumerate(STAGES)}
+        summary = {}
+        for name in sorted(stages, key=lambda name: order.get(name, len(order))):
+            stage = stages[name]
+            wall_time = stage["wall_time"]
+            stage["processes"] = len(stage["processes"])
+            stage["docs_per_sec"] = stage["docs"] / wall_time if wall_time and stage["docs"] else None
+            stage["tokens_per_sec"] = stage["tokens"] / wall_time if wall_time and stage["tokens"] else None
+            summary[name] = stage
+
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        run = {"started": self._started,
+               "wall_time": time.perf_counter() - self._start[0],
+               "cpu_time": time.process_time() - self._start[1] + children.ru_utime + children.ru_stime,
+               "peak_rss_mb": max([peak_rss_mb(), children.ru_maxrss / 1024] +
+                                  [stage["peak_rss_mb"] for stage in summary.values()])}
+
+        return {"run": run, "stages": summary}
+
+    def report(self,
+               report_path: pathlib.Path = None,
+               config: dict = None) -> dict:
+        """
+        Logs the summary of the run and, if report_path is given, saves it as a JSON report together with the configuration of the run
+
+        Parameters
+        ----------
+        report_path: pathlib.Path
+            Path of the JSON report
+        config: dict
+            Configuration of the run (e.g., the command line arguments)
+
+        Returns
+        -------
+        report: dict
+            Summary of the run (see summary)
+        """
+
+        report = self.summary()
+        for name, stage in report["stages"].items():
+            cpu = f"{stage['cpu_time']:.2f}s CPU" if stage["cpu_time"] is not None else "CPU n/a"
+            docs = f", {stage['docs']} docs ({stage['docs_per_sec']:.1f} docs/sec)" if stage["docs_per_sec"] else ""
+            tokens = f", {stage['tokens']} tokens ({stage['tokens_per_sec']:.1f} tokens/sec)" if stage["tokens_per_sec"] else ""
+            self._logger.info(
+                f"-- -- Stage {name}: {stage['wall_time']:.2f}s wall, {cpu}{docs}{tokens}, peak RSS {stage['peak_rss_mb']:.1f} MB in {stage['processes']} process(es)")
+        run = report["run"]
+        self._logger.info(
+            f"-- -- Run: {run['wall_time']:.2f}s wall, {run['cpu_time']:.2f}s CPU, peak RSS {run['peak_rss_mb']:.1f} MB")
+
+        if report_path is not None:
+            report["config"] = config or {}
+            report_path = pathlib.Path(report_path)
+            report_path.parent.mkdir(parents=True, exist_ok=True)
+            with report_path.open("w", encoding="utf8") as fout:
+                json.dump(report, fout, indent=2, default=str)
+            self._logger.info(
+                f"-- -- Run report saved in {report_path.as_posix()}")
+
+        return report
+
+    def close(self) -> None:
+        """
+        Merges the cProfile statistics of the profiled stage into profile_output, and removes the run's spool folder
+        """
+
+        profiles = [path.as_posix() for path in self._spool.glob("*.prof")]
+        if self._profile_stage and self._profile_output is not None:
+            if profiles:
+                pstats.Stats(*profiles).dump_stats(self._profile_output)
+                self._logger.info(
+                    f"-- -- cProfile statistics of stage {self._profile_stage} ({len(profiles)} blocks) saved in {pathlib.Path(self._profile_output).as_posix()}")
+            else:
+                self._logger.warning(
+                    f"-- -- Stage {self._profile_stage} was not run in any process; no profile saved")
+
+        os.environ.pop(_SPOOL_ENV, None)
+        os.environ.pop(_PROFILE_ENV, None)
+        shutil.rmtree(self._spool, ignore_errors=True)
+
+        return
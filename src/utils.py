@@ -1,9 +1,24 @@
 import pathlib
 import shutil
+import time
+from collections import defaultdict
+from typing import Dict, Iterator, List, Tuple
 
+import dask
 import dask.dataframe as dd
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from dask.callbacks import Callback
 from dask.diagnostics import ProgressBar
-from langdetect import detect
+from dask.utils import key_split
+
+from src.lang_detection import LangdetectDetector
+from src.profiling import profile_stage
+
+_detector = LangdetectDetector()
 
 
 def det(x: str) -> str:
@@ -22,46 +37,147 @@ def det(x: str) -> str:
     """
 
     try:
-        lang = detect(x)
+        lang = _detector.detect(x)
     except:
         lang = 'Other'
     return lang
 
 
-def max_column_length(df, col_name, use_dask=False):
+def dask_compute_kwargs(nw: int = 0) -> dict:
     """
-    Returns the maximum length of values in a DataFrame column.
+    Returns the arguments with which Dask computations are run: the process scheduler with nw workers (Dask's default number, i.e., the number of cores, if nw is 0) or, if a dask.distributed client has been started (see src.dask_backend), no arguments, so that its cluster is used
 
     Parameters
     ----------
-    df : DataFrame
-        DataFrame (pandas or Dask)
-    col_name : str
-        Name of the column whose length is to be calculated
-    use_dask : bool, optional
-        Flag to indicate whether the DataFrame is Dask or not
+    nw : int, optional
+        Number of workers to use with the process scheduler
 
     Returns
     -------
-    max_length: int
-        Maximum length of the values in the column
+    compute_kwargs : dict
+        Keyword arguments for compute / persist
     """
 
-    if use_dask:
-        lengths = df[col_name].str.len()
-        with ProgressBar():
-            max_length = lengths.max().compute(scheduler='processes')
-    else:
-        lengths = df[col_name].str.len()
-        max_length = lengths.max()
+    if dask.config.get("scheduler", None) == "dask.distributed":
+        return {}
+
+    compute_kwargs = {'scheduler': 'processes'}
+    if nw > 0:
+        compute_kwargs['num_workers'] = nw
+    return compute_kwargs
+
+
+def deduplicate(texts: List[str],
+                logger=None) -> Tuple[List[str], np.ndarray]:
+    """
+    Finds the distinct texts of a list, so that they can be processed once and their results broadcast back to all their duplicates (e.g., results = [unique_results[i] for i in inverse])
+
+    Parameters
+    ----------
+    texts : List[str]
+        Texts to deduplicate
+    logger : Logger object
+        To log the ratio of duplicates
+
+    Returns
+    -------
+    unique_texts : List[str]
+        First occurrence of each distinct text, in order of appearance
+    inverse : np.ndarray
+        Index in unique_texts of each text
+    """
+
+    inverse, _ = pd.factorize(pd.Series(texts, dtype=object),
+                              use_na_sentinel=False)
+    _, first = np.unique(inverse, return_index=True)
+    unique_texts = [texts[i] for i in first]
+
+    if logger and len(texts):
+        logger.info(
+            f"-- -- {len(texts) - len(unique_texts)} of {len(texts)} texts are duplicates (dedup ratio: {1 - len(unique_texts) / len(texts):.1%}); {len(unique_texts)} are processed")
+
+    return unique_texts, inverse
+
+
+def to_arrow_table(df: pd.DataFrame,
+                   schema: Dict[str, pa.DataType] = None,
+                   preserve_index: bool = None) -> pa.Table:
+    """
+    Converts a pandas DataFrame into a pyarrow Table, overriding the inferred types of some columns (e.g., to save embeddings as FixedSizeList columns instead of variable-length lists).
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DataFrame to be converted
+    schema : Dict[str, pa.DataType], optional
+        pyarrow types of the columns whose inferred type is overridden
+    preserve_index : bool, optional
+        Whether the index is saved as a column (see pyarrow.Table.from_pandas)
+
+    Returns
+    -------
+    table : pa.Table
+        Table with the data of df
+    """
+
+    arrow_schema = pa.Schema.from_pandas(df, preserve_index=preserve_index)
+    for name, col_type in (schema or {}).items():
+        idx = arrow_schema.get_field_index(name)
+        if idx >= 0:
+            arrow_schema = arrow_schema.set(idx, pa.field(name, col_type))
 
-    return max_length
+    return pa.Table.from_pandas(df, schema=arrow_schema, preserve_index=preserve_index)
+
+
+def load_embeddings(path: pathlib.Path,
+                    column: str = "embeddings",
+                    dequantize: bool = True) -> np.ndarray:
+    """
+    Loads the embeddings saved in a parquet file (or directory) as a NumPy matrix with one row per document. For single-chunk FixedSizeList columns, the matrix is a zero-copy view of the Arrow buffer (and thus read-only).
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Path to the parquet file or directory
+    column : str
+        Name of the embeddings column
+    dequantize : bool
+        If the embeddings were saved as int8, whether to multiply them by their scale (column + "_scale") to recover float32 vectors
+
+    Returns
+    -------
+    embeddings : np.ndarray
+        Matrix of embeddings
+    """
+
+    dataset = ds.dataset(path, format="parquet")
+    scale_col = column + "_scale"
+    columns = [column]
+    if dequantize and scale_col in dataset.schema.names:
+        columns.append(scale_col)
+    table = dataset.to_table(columns=columns)
+
+    embeddings = table.column(column).combine_chunks()
+    if not pa.types.is_fixed_size_list(embeddings.type):
+        raise ValueError(
+            f"Column {column} is not a FixedSizeList column, but {embeddings.type}")
+    dim = embeddings.type.list_size
+    matrix = embeddings.flatten().to_numpy(
+        zero_copy_only=False).reshape(-1, dim)
+
+    if scale_col in columns:
+        scale = table.column(scale_col).to_numpy()
+        matrix = matrix.astype(np.float32) * scale[:, None]
+
+    return matrix
 
 
 def save_parquet(outFile: pathlib.Path,
                  df: dd.DataFrame,
                  use_dask=False,
-                 nw=0) -> None:
+                 nw=0,
+                 schema: Dict[str, pa.DataType] = None,
+                 compute: bool = True):
     """
     Saves a Dask DataFrame in a parquet file.
 
@@ -75,6 +191,15 @@ def save_parquet(outFile: pathlib.Path,
         Flag to indicate whether the DataFrame is Dask or not
     nw : int, optional
         Number of workers to use with Dask
+    schema : Dict[str, pa.DataType], optional
+        pyarrow types of the columns whose inferred type is overridden (e.g., the embeddings columns given by EmbeddingsManager.get_embeddings_schema)
+    compute : bool, optional
+        With Dask, whether to write the file right away. If False, the lazy write is returned, so that it can be computed together with others sharing the same graph (see compute_dask)
+
+    Returns
+    -------
+    write : Delayed
+        Lazy write of the file if use_dask and not compute; None otherwise
     """
     if outFile.is_file():
         outFile.unlink()
@@ -82,16 +207,297 @@ def save_parquet(outFile: pathlib.Path,
         shutil.rmtree(outFile)
 
     if use_dask:
+        if not compute:
+            return df.to_parquet(outFile, write_index=False, schema=schema or "infer", compute=False)
         with ProgressBar():
-            if nw > 0:
-                df.to_parquet(outFile, write_index=False, schema="infer", compute_kwargs={
-                    'scheduler': 'processes', 'num_workers': nw})
-            else:
-                # Use Dask default number of workers (i.e., number of cores)
-                df.to_parquet(outFile, write_index=False, schema="infer", compute_kwargs={
-                    'scheduler': 'processes'})
+            df.to_parquet(outFile, write_index=False, schema=schema or "infer",
+                          compute_kwargs=dask_compute_kwargs(nw))
     else:
-        df.to_parquet(outFile)
+        with profile_stage("write") as profiler:
+            pq.write_table(to_arrow_table(df, schema), outFile)
+            profiler.docs = len(df)
         #df.to_parquet(outFile, write_index=False)
 
     return
+
+
+def compute_dask(*collections, nw: int = 0):
+    """
+    Computes several Dask collections (e.g., the lazy writes returned by save_parquet) in a single execution, so that the tasks they share are run only once.
+
+    Parameters
+    ----------
+    *collections
+        Dask collections or delayed objects to be computed
+    nw : int, optional
+        Number of workers to use with Dask. If 0, Dask's default (i.e., number of cores) is used
+
+    Returns
+    -------
+    results : tuple
+        Results of each collection
+    """
+
+    with ProgressBar():
+        return dask.compute(*collections, **dask_compute_kwargs(nw))
+
+
+def persist_dataframe(df: dd.DataFrame,
+                      nw: int = 0,
+                      checkpoint_path: pathlib.Path = None) -> dd.DataFrame:
+    """
+    Materializes a Dask DataFrame, so that the stages that produced it (e.g., language detection or lemmatization) are run once instead of every time a later stage computes the DataFrame.
+
+    Parameters
+    ----------
+    df : dd.DataFrame
+        DataFrame to be materialized
+    nw : int, optional
+        Number of workers to use with Dask. If 0, Dask's default (i.e., number of cores) is used
+    checkpoint_path : pathlib.Path, optional
+        If given, the partitions are written to a parquet dataset in this path and read back, so that they are kept on disk rather than in memory. Otherwise, they are persisted in memory: in the workers with dask.distributed, but in the calling process with the processes scheduler, which then holds every partition
+
+    Returns
+    -------
+    df : dd.DataFrame
+        DataFrame backed by the materialized partitions
+    """
+
+    compute_kwargs = dask_compute_kwargs(nw)
+
+    with ProgressBar():
+        if checkpoint_path is None:
+            return df.persist(**compute_kwargs)
+
+        if checkpoint_path.exists():
+            shutil.rmtree(checkpoint_path)
+        # The schema of each partition is inferred from its data, since Dask infers object columns (e.g., lists of lemmas) as strings
+        df.to_parquet(checkpoint_path, write_index=False, schema=None,
+                      compute_kwargs=compute_kwargs)
+
+    # Restore the original dtypes (e.g., object columns read back as pyarrow strings)
+    return dd.read_parquet(checkpoint_path).astype(df.dtypes.to_dict())
+
+
+class DaskStageTimer(Callback):
+    """
+    Dask scheduler callback that accumulates the time spent in the tasks of each stage, identified by the name of the task (e.g., '_lemmatize_series' or 'to_parquet'), over all the computations run while it is active. Tasks of different stages fused together by Dask's optimizer are accounted for under the name of the fused task.
+    """
+
+    def __init__(self):
+        """
+        Initilization Method
+        """
+
+        super().__init__()
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._task_start = {}
+
+    def _pretask(self, key, dsk, state):
+        self._task_start[key] = time.perf_counter()
+
+    def _posttask(self, key, result, dsk, state, worker_id):
+        start = self._task_start.pop(key, None)
+        if start is not None:
+            stage = key_split(key)
+            self.timings[stage] += time.perf_counter() - start
+            self.counts[stage] += 1
+
+    def add_task_stream(self, records: List[dict]) -> None:
+        """
+        Accumulates the time of the tasks run by a dask.distributed cluster, as recorded in its task stream (see distributed.Client.get_task_stream), since they are not seen by the scheduler callbacks
+
+        Parameters
+        ----------
+        records: List[dict]
+            Task stream records
+        """
+
+        for record in records:
+            stage = key_split(record["key"])
+            self.timings[stage] += sum(startstop["stop"] - startstop["start"]
+                                       for startstop in record["startstops"]
+                                       if startstop["action"] == "compute")
+            self.counts[stage] += 1
+
+        return
+
+    def log(self, logger) -> None:
+        """
+        Logs the accumulated time of each stage, from the most to the least expensive
+
+        Parameters
+        ----------
+        logger: Logger object
+            Logger in which the timings are reported
+        """
+
+        for stage, elapsed in sorted(self.timings.items(), key=lambda item: -item[1]):
+            logger.info(
+                f"-- -- Dask stage {stage}: {elapsed:.2f}s in {self.counts[stage]} tasks")
+
+        return
+
+
+def get_parquet_types(path: pathlib.Path) -> Dict[str, pa.DataType]:
+    """
+    Returns the pyarrow type of each column of a parquet file (or a directory of parquet files), without reading its data
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Path to the parquet file or directory
+
+    Returns
+    -------
+    types : Dict[str, pa.DataType]
+        Type of each column
+    """
+
+    schema = ds.dataset(path, format="parquet").schema
+    return dict(zip(schema.names, schema.types))
+
+
+def iter_parquet_chunks(path: pathlib.Path,
+                        chunk_size: int,
+                        columns: List[str] = None,
+                        filters: List[Tuple] = None,
+                        stage: str = "read") -> Iterator[pd.DataFrame]:
+    """
+    Reads a parquet file (or a directory of parquet files) as a stream of pandas DataFrames with at most chunk_size rows each, so that the whole dataset is never loaded in memory.
+
+    Parameters
+    ----------
+    path : pathlib.Path
+        Path to the parquet file or directory
+    chunk_size : int
+        Maximum number of rows per chunk
+    columns : List[str], optional
+        Columns to read. If None, all columns are read
+    filters : List[Tuple], optional
+        Row filters as (column, op, value) tuples, all of which must hold (see pyarrow.parquet.filters_to_expression). They are pushed down to the scan, so row groups whose statistics rule them out are skipped
+    stage : str
+        Stage under which the reads are recorded (see profiling.STAGES)
+
+    Yields
+    ------
+    chunk : pd.DataFrame
+        Next chunk of the dataset
+    """
+
+    dataset = ds.dataset(path, format="parquet")
+    expression = pq.filters_to_expression(filters) if filters else None
+    batches = dataset.to_batches(columns=columns, filter=expression,
+                                 batch_size=chunk_size)
+    while True:
+        with profile_stage(stage) as profiler:
+            batch = next(batches, None)
+            chunk = batch.to_pandas() if batch is not None else None
+            profiler.docs = len(chunk) if chunk is not None else 0
+        if chunk is None:
+            return
+        if len(chunk):
+            yield chunk
+
+
+class ParquetChunkWriter(object):
+    """
+    Appends pandas DataFrames with the same columns to a single parquet file. The schema of the file is taken from the first chunks written; the following ones are cast to it.
+
+    Columns whose values are all null in a chunk are inferred as null-typed by pyarrow, and a parquet file cannot change its schema once it is opened. The type of such columns is thus taken from types (e.g., the types of the dataset the chunks are read from, see get_parquet_types) or, if they are not given, from the next chunks: chunks are kept in memory until every column has a non-null type (or the file is closed), and are then written with the unified schema.
+    """
+
+    def __init__(self,
+                 outFile: pathlib.Path,
+                 types: Dict[str, pa.DataType] = None,
+                 stage: str = "write"):
+        """
+        Initilization Method. If outFile already exists, it is removed.
+
+        Parameters
+        ----------
+        outFile : pathlib.Path
+            Path to the parquet file to be saved
+        types : Dict[str, pa.DataType], optional
+            pyarrow types of the columns that are null-typed in the first chunk
+        stage : str
+            Stage under which the writes are recorded (see profiling.STAGES)
+        """
+
+        if outFile.is_file():
+            outFile.unlink()
+        elif outFile.is_dir():
+            shutil.rmtree(outFile)
+
+        self._outFile = outFile
+        self._types = types or {}
+        self._stage = stage
+        self._writer = None
+        self._pending = []
+        self.num_rows = 0
+
+    def write(self,
+              df: pd.DataFrame,
+              schema: Dict[str, pa.DataType] = None) -> None:
+        """
+        Appends a chunk to the parquet file
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Chunk to be saved
+        schema : Dict[str, pa.DataType], optional
+            pyarrow types of the columns whose inferred type is overridden (see to_arrow_table)
+        """
+
+        with profile_stage(self._stage) as profiler:
+            table = to_arrow_table(df, schema, preserve_index=False)
+            if self._writer is None:
+                self._pending.append(table)
+                self._open(force=False)
+            else:
+                self._writer.write_table(table.cast(self._writer.schema))
+            profiler.docs = len(df)
+        self.num_rows += len(df)
+
+        return
+
+    def _open(self, force: bool) -> None:
+        """
+        Opens the parquet file with the unified schema of the pending chunks and writes them, unless some column is still null-typed and force is False
+
+        Parameters
+        ----------
+        force : bool
+            Whether the file is opened even if some column is null-typed
+        """
+
+        arrow_schema = pa.unify_schemas([table.schema for table in self._pending])
+        for idx, field in enumerate(arrow_schema):
+            if pa.types.is_null(field.type) and field.name in self._types:
+                arrow_schema = arrow_schema.set(
+                    idx, field.with_type(self._types[field.name]))
+        if not force and any(pa.types.is_null(field.type) for field in arrow_schema):
+            return
+
+        self._writer = pq.ParquetWriter(self._outFile, arrow_schema)
+        for table in self._pending:
+            self._writer.write_table(table.cast(arrow_schema))
+        self._pending = []
+
+        return
+
+    def close(self) -> None:
+        """
+        Closes the parquet file
+        """
+
+        with profile_stage(self._stage):
+            if self._writer is None and self._pending:
+                self._open(force=True)
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+
+        return